@@ -0,0 +1,243 @@
+import os, json, signal, time, threading, traceback, contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+import pandas as pd
+
+from SCIEX.process_UVPD_5500 import process_UVPD_5500
+from workflows.reporting import TerminalReporter, process_events
+
+#A batch queue is a list of QTRAP 5500 UVPD analyses (jobs) that run one after another, or a few at a time, without anyone at the computer.
+#Each job holds the keyword arguments of process_UVPD_5500 (its spec) and an answer to the yes/no questions asked during the analysis ('ask' answers with the default).
+#The queue is saved to a .json file after every change, so that a crash or a closed GUI never loses the jobs that have finished: they are skipped when the queue is run again,
+#and jobs that were running at the time are queued again. A summary table of the jobs is written next to it (queue basename + '_summary.csv').
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+SUMMARY_COLUMNS = ['Job', 'Name', 'State', 'Directory', 'Parent m/z', 'Mode', 'Sweep', 'Submitted', 'Started', 'Finished', 'Run time (s)', 'Message']
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+class BatchQueue:
+    '''
+    The jobs of a batch queue and their state, backed by a .json file. Every method that changes a job saves the queue. The queue can be changed from any thread
+    (e.g., jobs added in the GUI while the queue is running).
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.summary_path = f'{os.path.splitext(self.path)[0]}_summary.csv'
+        self.log_directory = f'{os.path.splitext(self.path)[0]}_logs'
+        self.jobs = []
+        self._lock = threading.RLock()
+        self._read()
+
+    def _read(self):
+        '''Loads the jobs of the queue file, if there is one. Jobs that were running when the queue was last saved have been interrupted and are queued again.'''
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r') as opf:
+            self.jobs = json.load(opf).get('jobs', [])
+
+        interrupted = [job for job in self.jobs if job['state'] == 'running']
+        for job in interrupted:
+            job.update(state='queued', started=None, message='Interrupted, queued again')
+        if interrupted:
+            print(f'{len(interrupted)} job(s) of {os.path.basename(self.path)} were interrupted and have been queued again.')
+            process_events()
+            self.save()
+
+    def save(self):
+        '''Writes the queue file and the summary table. The queue is written to a temporary file first so that a crash while saving never leaves a corrupt queue behind.'''
+        with self._lock:
+            temp_file = f'{self.path}.tmp'
+            try:
+                with open(temp_file, 'w') as opf:
+                    json.dump({'jobs': self.jobs}, opf, indent=1)
+                os.replace(temp_file, self.path)
+                self.summary().to_csv(self.summary_path, index=False)
+
+            #the queue keeps running if its file can't be written; only the record of it is lost
+            except OSError as e:
+                print(f'Could not save the batch queue to {self.path} ({e}).')
+                process_events()
+
+    def add(self, spec, name=None, answer='ask'):
+        '''
+        Adds a job with the keyword arguments spec of process_UVPD_5500 to the end of the queue and returns it.
+        A job with the same spec and answer that is still in the queue (in any state) is not added twice, so that adding the same jobs again to resume a queue is harmless; None is returned instead.
+        '''
+        spec = json.loads(json.dumps(spec)) #same form as the saved jobs (e.g., tuples become lists), so that specs can be compared
+        with self._lock:
+            if any(job['spec'] == spec and job['answer'] == answer for job in self.jobs):
+                return None
+
+            job_id = max((job['id'] for job in self.jobs), default=0) + 1
+            if name is None:
+                name = f'{os.path.basename(os.path.normpath(spec["directory"]))} {spec["parent_mz"]}' + (' (peak sweep)' if spec.get('sweep_values') else '')
+
+            job = {'id': job_id, 'name': name, 'spec': spec, 'answer': answer, 'state': 'queued', 'submitted': _now(), 'started': None, 'finished': None, 'run_time': None,
+                   'message': '', 'log_file': os.path.join(self.log_directory, f'job_{job_id}.log')}
+            self.jobs.append(job)
+            self.save()
+            return job
+
+    def remove(self, job_id):
+        '''Removes a job that isn't running. Returns False if it is running.'''
+        with self._lock:
+            job = self.job(job_id)
+            if job['state'] == 'running':
+                return False
+            self.jobs.remove(job)
+            self.save()
+            return True
+
+    def requeue(self, job_id):
+        '''Queues a job that has finished (done, failed or cancelled) again. Returns False if it is queued or running.'''
+        with self._lock:
+            job = self.job(job_id)
+            if job['state'] in ('queued', 'running'):
+                return False
+            job.update(state='queued', started=None, finished=None, run_time=None, message='')
+            self.save()
+            return True
+
+    def job(self, job_id):
+        with self._lock:
+            return next(job for job in self.jobs if job['id'] == job_id)
+
+    def next_queued(self):
+        '''Marks the first queued job as running and returns it, or returns None if no job is queued'''
+        with self._lock:
+            job = next((job for job in self.jobs if job['state'] == 'queued'), None)
+            if job is not None:
+                job.update(state='running', started=_now(), finished=None, run_time=None, message='')
+                self.save()
+            return job
+
+    def finish(self, job, state, run_time, message=''):
+        with self._lock:
+            job.update(state=state, finished=_now(), run_time=round(run_time, 1), message=message)
+            self.save()
+
+    def unqueue_running(self, job):
+        '''Puts a running job back in the queue (e.g., the process running the queue was stopped), so that it runs again next time'''
+        with self._lock:
+            job.update(state='queued', started=None)
+            self.save()
+
+    def counts(self):
+        '''Number of jobs in each state'''
+        with self._lock:
+            return {state: sum(job['state'] == state for job in self.jobs) for state in JOB_STATES}
+
+    def summary(self):
+        '''Table of the jobs: what they ran, their state, when they ran and for how long'''
+        with self._lock:
+            rows = [[job['id'], job['name'], job['state'], job['spec']['directory'], job['spec']['parent_mz'], job['spec'].get('integration_mode', 'full'), bool(job['spec'].get('sweep_values')),
+                     job['submitted'], job['started'], job['finished'], job['run_time'], job['message']] for job in self.jobs]
+        return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+#set in each worker process by _init_job_process: the queue's cancel event, shared with the process that runs the queue
+_queue_cancel_event = None
+
+def _init_job_process(cancel_event):
+    global _queue_cancel_event
+    _queue_cancel_event = cancel_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C in a terminal reaches every process; only the process running the queue handles it, and cancels the jobs through the event
+
+class _JobReporter(TerminalReporter):
+    '''Reporter of a job running in a worker process: answers questions like the command line (never waits for input), and is cancelled when the queue is'''
+    def cancelled(self):
+        return super().cancelled() or (_queue_cancel_event is not None and _queue_cancel_event.is_set())
+
+def _run_job(spec, answer, log_file):
+    '''Runs one job in a worker process with its output written to log_file. Returns (succeeded, message).'''
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, 'a', buffering=1) as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print(f'{_now()} Starting job: {json.dumps(spec)}')
+        reporter = _JobReporter(answer={'ask': None, 'yes': True, 'no': False}[answer])
+        try:
+            succeeded = process_UVPD_5500(reporter, **spec)
+        except Exception as e:
+            print(f'An unexpected error occured during the analysis:\n{e}\nTraceback: {traceback.format_exc()}')
+            return False, f'Unexpected error: {e}'
+
+        if succeeded:
+            return True, ''
+        if reporter.cancelled():
+            return False, 'Cancelled by user'
+        return False, 'Analysis stopped, see the log'
+
+def run_batch_queue(queue, max_parallel=1, reporter=None):
+    '''
+    Runs the queued jobs of a BatchQueue, max_parallel at a time, each in its own worker process. Jobs added to the queue while it is running are picked up as well.
+    The output of each job is written to its log file instead of the terminal/status window.
+    Keep in mind that every job can use n_workers integration processes (and n_converters msconvert processes) of its own.
+    reporter: Optional workflows.reporting.Reporter that receives progress after every job and is polled for cancellation. On cancel, the running jobs stop at their
+        next opportunity and the jobs that haven't started stay queued.
+    Returns True if every job that ran succeeded, False otherwise.
+    '''
+    stage = 'Batch queue'
+    mp_context = multiprocessing.get_context('spawn') #same behaviour on every OS, and a fresh interpreter for every job (no Qt/stdout of the GUI inherited)
+    cancel_event = mp_context.Event()
+    cancelled = reporter.cancelled if reporter is not None else (lambda: False)
+
+    #a new worker process for every job, so that nothing (memory, plotting state) carries over from one long analysis to the next
+    executor = ProcessPoolExecutor(max_workers=max(int(max_parallel), 1), mp_context=mp_context, initializer=_init_job_process, initargs=(cancel_event,), max_tasks_per_child=1)
+    running = {} #future -> (job, start time)
+    n_done, all_succeeded = 0, True
+    last_progress = None
+
+    print(f'Running the batch queue {queue.path} ({queue.counts()["queued"]} queued jobs, up to {max_parallel} at a time). The output of each job is written to {queue.log_directory}.')
+    process_events()
+
+    try:
+        while True:
+            #fill the free slots with the next queued jobs
+            while not cancelled() and len(running) < max_parallel:
+                job = queue.next_queued()
+                if job is None:
+                    break
+                running[executor.submit(_run_job, job['spec'], job['answer'], job['log_file'])] = (job, time.time())
+                print(f'{_now()} Started job {job["id"]}: {job["name"]}')
+                process_events()
+
+            progress = (n_done, n_done + len(running) + queue.counts()['queued'])
+            if reporter is not None and progress != last_progress:
+                reporter.progress(*progress, stage)
+                last_progress = progress
+
+            if not running:
+                break
+
+            done, _ = wait(list(running), timeout=0.25, return_when=FIRST_COMPLETED)
+
+            if cancelled() and not cancel_event.is_set():
+                cancel_event.set()
+                print('Cancelling the batch queue. The running jobs will stop at their next opportunity; queued jobs stay in the queue.')
+                process_events()
+
+            for future in done:
+                job, start = running.pop(future)
+                try:
+                    succeeded, message = future.result()
+                except Exception as e: #the worker process died (e.g., out of memory)
+                    succeeded, message = False, f'Job process failed: {e}'
+
+                state = 'done' if succeeded else ('cancelled' if cancel_event.is_set() else 'failed')
+                queue.finish(job, state, time.time() - start, message)
+                n_done += 1
+                all_succeeded = all_succeeded and succeeded
+                print(f'{_now()} Job {job["id"]} ({job["name"]}) {state} after {time.time() - start:.1f} s.' + (f' {message}.' if message else ''))
+                process_events()
+
+    finally:
+        #only reached with jobs still running if the loop above raised; they are recorded as queued so that they run again next time
+        for job, start in running.values():
+            queue.unqueue_running(job)
+        executor.shutdown(wait=not running, cancel_futures=True)
+
+    counts = queue.counts()
+    print(f'Batch queue finished: {counts["done"]} done, {counts["failed"]} failed, {counts["cancelled"]} cancelled, {counts["queued"]} queued. Summary written to {queue.summary_path}.')
+    process_events()
+    return all_succeeded and not cancel_event.is_set()
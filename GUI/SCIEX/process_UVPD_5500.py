@@ -1,31 +1,68 @@
 import os, re, time, time
 import numpy as np
 import pandas as pd
-from PyQt6.QtWidgets import QApplication, QMessageBox
 
-from workflows.calc_PE import PE_calc, PE_calc_noNorm
-from workflows.integrate_mzml import integrate_spectra
+from workflows.calc_PE import PE_calc_vectorized, PE_calc_noNorm_vectorized
+from workflows.convert_and_integrate import convert_and_integrate
+from workflows.experiment_store import open_experiment_store, update_experiment_store
+from workflows.integrate_mzml import integrate_mzml_files
+from workflows.peak_param_sweep import sweep_peak_parameters, sweep_total_PE
 from workflows.preprocessing_5500 import preprocessing_5500
-from workflows.RawData_from_mzml import extract_RawData
-from workflows.wiff2mzml import convert_wiff_to_mzml
+from workflows.qc import MIN_PARENT_INTEGRAL, run_qc_checks, apply_qc_policy
+from workflows.reporting import Reporter, process_events
+from workflows.RawData_from_mzml import extract_RawData, RAW_DATA_FORMATS
+from workflows.result_writers import UVPDResults, RESULT_FORMATS, unique_output_base, write_results
+from workflows.wiff2mzml import ConversionCheckpoint, convert_wiff_files
 
 
-def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file, extract_mzml_flag, PowerNorm_flag, power_file, extract_raw_data_flag, plot_flag, height, threshold, prominence, width, adj_avg_smoothing_size, out_basename):
+def process_UVPD_5500(reporter, directory, parent_mz, search_window, frag_list_file, extract_mzml_flag, PowerNorm_flag, power_file, extract_raw_data_flag, plot_flag, height, threshold, prominence, width, adj_avg_smoothing_size, out_basename, integration_mode='full', n_workers=1, sweep_values=None, n_converters=1, msconvert_path='msconvert', mz_window_filter=False, zlib_compression=False, intensity_32bit=False, experiment_store_flag=False, qc_action='flag', min_parent_integral=MIN_PARENT_INTEGRAL, raw_data_format='csv', raw_data_float32=False, output_formats=('excel',), window_margin=None):
     '''
     Main function for processing UVPD data taken on the QTRAP 5500 from the Hopkins lab. Inputs:
+    reporter: workflows.reporting.Reporter that receives progress updates, answers the yes/no questions asked during the analysis, and signals when the user cancels. None prints progress and answers No.
     Directory: Directory containing .wiff files OR \\mzml_directory, which contains extracts mzML files
     base_peak: the m/z of the parent ion
     frag_list_file: A file containing a list of fragment ions and their respective adundances due to background fragmentation in the ion trap
     extract_mzml_flag: True/False variable for whether to use pyteomics to extract mzML files from .wiff. If False, code looks for directory/mzml_directory, which must be popluated w/ mzml files
+        If an earlier extraction with the same msconvert settings was interrupted, it is resumed: only the .wiff files that hadn't been converted yet are converted.
     PowerNorm_flag: True/False variable for whether to normalize Photofragmentation efficiency to laser power. If true, requires a power data file (power_file).
     power_file: directory/power_file.csv (or whatever filename you want) that contains power data. Format 3 numerical, comma-separated values: Wavelength(in nm), power(in mJ), stdev in measured power(mJ)
     extract_raw_data_flag: True/False variable for whether to print raw data to an excel file. 
     plot_flag: True/False variable for whether to plot the integrations to a .png file. Reccomended when testing peak-finding parameters and/or validating that the code is choosing peaks you want it to.
     height, threshold, prominence, width: scipy peak finder parameters. 
     out_basename: The basename of the Excel file that data will be written to
+    integration_mode: How each scan is interpolated and searched for peaks, one of workflows.integrate_mzml.INTEGRATION_MODES: 'full', 'windowed', 'batched', 'native'
+        (peaks found and integrated on the raw points, without interpolation) or 'averaged' (the peak is integrated once on the mean spectrum of all scans). In 'averaged' mode
+        the stdev is the bootstrap uncertainty of the averaged integration, not the scan-to-scan spread reported by the other modes. See workflows.integrate_mzml.integrate_spectra_multi for details.
+    n_workers: Number of worker processes used to integrate the mzml files (wavelengths) in parallel. 1 processes the files one after another.
+    sweep_values: Optional dict of {'height': [...], 'threshold': [...], 'prominence': [...], 'width': [...]}. If given, the total PE of every combination of these peak finder
+        settings is written to out_basename_peak_sweep.csv instead of running the regular analysis, integrated in integration_mode. See workflows.peak_param_sweep for details.
+    n_converters: Number of msconvert processes that convert .wiff files at the same time.
+    msconvert_path: The msconvert executable used to convert the .wiff files. Defaults to the one on the system's PATH.
+    mz_window_filter: If True, msconvert only keeps m/z 0 to parent_mz + 51 of each spectrum. Everything above parent_mz + 50 is discarded by the analysis anyway; the extra 1 m/z keeps the interpolation at the edge of the grid unchanged.
+    zlib_compression: If True, msconvert zlib-compresses the binary arrays of the mzML files (lossless).
+    intensity_32bit: If True, msconvert writes intensities as 32-bit floats (m/z values stay 64-bit).
+    experiment_store_flag: If True, every scan of every mzml file is packed into a single memory-mapped file (mzml_directory/experiment.spectra) that the integration
+        and raw data export read from. The store is only rebuilt when the mzml files change, and it is used on its own if the mzml files have been deleted. See workflows.experiment_store.
+    qc_action: What to do with wavelengths that fail quality control (e.g., a parent ion integration below min_parent_integral). Every wavelength is checked before the PE is calculated, then:
+        'flag' (the default) continues, 'ask' asks once whether to continue (unattended runs abort), 'skip' leaves them out of the results, and 'abort' stops the analysis.
+        Flagged and skipped wavelengths are listed in the QC sheet of the output. See workflows.qc for details.
+    min_parent_integral: Lowest parent ion integration that passes quality control.
+    raw_data_format: Format of the raw data file written when extract_raw_data_flag is True: 'csv', 'npy', 'parquet' or 'feather' (the last two require pyarrow).
+    raw_data_float32: If True, the raw data intensities are written as 32-bit floats. See workflows.RawData_from_mzml.RawDataWriter for details.
+    output_formats: The formats the results are written in, any of 'excel' (workbook with charts), 'csv', 'parquet', 'npz' and 'json' (settings of the analysis and the files written).
+        Every format is written from the same results. See workflows.result_writers for details.
+    window_margin: Optional m/z on each side of a peak within which its bases (the integration range) are searched, in every integration mode. None (default) searches the whole spectrum.
+    Returns True once the results have been written. Returns None or False if the analysis is stopped by an error or by the user.
+    The integration results of every mzml file are saved as soon as the file has been integrated (see workflows.results_cache), so running the analysis again with the same
+    inputs after it was stopped skips the files (wavelengths) that were already done and picks up at the first one that wasn't. With plot_flag, this needs the plots of the
+    previous run: keep them when asked whether to delete them, and only the targets that don't have a plot yet are integrated again.
     '''
     
     start_time = time.time() #get the time to determine overall calculation time.    
+
+    if reporter is None:
+        reporter = Reporter()
+    reporter.start()
        
     '''Step 0: Pre-process inputs, check for correct format, and assign their contents to usable variables'''
     preprocess = preprocessing_5500(directory, parent_mz, search_window, frag_list_file, extract_mzml_flag, PowerNorm_flag, power_file, extract_raw_data_flag, plot_flag, height, threshold, prominence, width)
@@ -35,53 +72,49 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
         return
     else:
         print('All files /inputs provided are in the right format.')
+
+    #checked now rather than after the integration, when the results and raw data are written
+    if extract_raw_data_flag and raw_data_format not in RAW_DATA_FORMATS:
+        print(f'Unknown raw data format "{raw_data_format}". Please choose one of: {", ".join(RAW_DATA_FORMATS)}.')
+        process_events()
+        return
+
+    unknown_formats = [result_format for result_format in output_formats if result_format not in RESULT_FORMATS]
+    if unknown_formats or not output_formats:
+        print(f'Unknown or no output format(s): {", ".join(unknown_formats)}. Please choose at least one of: {", ".join(RESULT_FORMATS)}.')
+        process_events()
+        return
     
     print('Starting interpolation and integration of mass spectra and calculation of photogragmentaion efficiency...')
-    QApplication.processEvents()
+    process_events()
 
     #Parse fragment file list, and assign contents to lists
-    frags = [] #empty list to store fragment m/z values from .txt
-    frag_bckgds = [] #empty list to store fragment background signal intensities from .txt
-    
-    with open(frag_list_file, 'r') as opf:
-        lines = opf.readlines()
-
-    for line in lines:
-        line = line.strip()
-        if line:  #Ignore empty lines
-            parts = line.split(',')
-            if len(parts) == 2:  #Ensure there are exactly two elements, which is only possible if the line has one comma
-                try:
-                    #Convert each part to a float (or int, depending on your requirement)
-                    frag = float(parts[0])
-                    bckgd = float(parts[1])
-                    
-                    frags.append(frag)
-                    frag_bckgds.append(bckgd)
-                
-                except ValueError:
-                    print(f'Non-numeric entry encountered in {os.path.basename(frag_list_file)}: {line}.\nPlease check the fragment list .txt file and re-run the code.')
-                    return
-                
-            else:
-                print(f'The following line in {os.path.basename(frag_list_file)} contains more than two comma-separated entries: {line}.\nPlease check the fragment list .txt file and re-run the code.')
-                return
+    fragment_list = read_fragment_file(frag_list_file)
+    if fragment_list is None:
+        return
+    frags, frag_bckgds = fragment_list
 
     '''Step 1: Get list of mzml files, or extract them from the .wiff if requested'''   
     mzml_directory = os.path.join(directory, 'mzml_directory') #directory for mzml files to be written to / where they are stored
     
+    integrated = None #integration results of each mzml file, if they are integrated during the .wiff extraction
+
     #Convert contents of each wiff file into an mzml (if requested)
     if extract_mzml_flag:      
         wiff_files = [f for f in os.listdir(directory) if f.lower().endswith('.wiff')]
         
         if len(wiff_files) == 0:
             print(f'There are no .wiff files present in {directory} to extract! Please specify a directory that contains .wiff files if you wish to extract them.\n')
-            QApplication.processEvents()   
+            process_events()   
             return False
             
         print('Starting extraction of .wiff files. You may see a command prompt interface show up.')
-        QApplication.processEvents() 
+        process_events() 
         
+        #msconvert filters and encodings that shrink the mzml files
+        msconvert_options = {'mz_window': (0, parent_mz + 51.) if mz_window_filter else None, 'zlib': zlib_compression, 'intensity_32bit': intensity_32bit}
+        resume = False #resume an extraction that was interrupted (e.g., by a crash) instead of starting over
+
         #Create a directory to write the extracted .mzml files to. If the directory exists, check if there are mzml files in there.
         try:
             os.mkdir(mzml_directory) #make the mzml directory
@@ -89,18 +122,26 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
         except FileExistsError:
             mzml_files = [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
 
-            if len(mzml_files) > 0:
+            #if every mzml file in the directory comes from a .wiff file that was completely converted with the same settings, only the remaining .wiff files are converted
+            checkpoint = ConversionCheckpoint(directory, mzml_directory, msconvert_options)
+            reusable_mzml_files = set()
+            for wiff_file in wiff_files:
+                reusable_mzml_files.update(checkpoint.mzml_files(wiff_file) or [])
+
+            if len(mzml_files) > 0 and set(mzml_files) <= reusable_mzml_files:
+                resume = True
+
+            elif len(mzml_files) > 0:
 
                 #Prompt the user
-                reply = QMessageBox.question(self, '.mzML files found in /mzml_directory!',
-                                             f'The directory {mzml_directory} already contains {len(mzml_files)} .mzML files. Do you want to delete these files and re-extract? Analysis will be aborted if No is selected.',
-                                             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
-                                             QMessageBox.StandardButton.No)
-                if reply == QMessageBox.StandardButton.Yes:
+                reply = reporter.question('.mzML files found in /mzml_directory!',
+                                          f'The directory {mzml_directory} already contains {len(mzml_files)} .mzML files. Do you want to delete these files and re-extract? Analysis will be aborted if No is selected.')
+                if reply:
                     i = 0
                     for f in mzml_files:
                         os.remove(os.path.join(mzml_directory, f))
                         i += 1
+                    checkpoint.clear()
                     print(f'{i} .mzML files have been romoved from {mzml_directory}. Proceeding with the re-extraction.')
                 else:
                     print('Extraction cancelled by user. Please uncheck the "extract .wiff option", or manually delete the mzml_directory before re-running the code.')
@@ -110,20 +151,25 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
             else:
                 pass
         
-        #.wiff extraction
-        for wiff_file in wiff_files:
-            wiff_stime = time.time() #define a time when the .wiff extraction starts
-            mzml_conversion = convert_wiff_to_mzml(wiff_file, directory, mzml_directory) #extract each scan in the .wiff file to a unique mzml. Returns True on success, False on error.
-            
-            if mzml_conversion:
-                print(f'{os.path.basename(wiff_file)} has been successfully extracted in {np.round((time.time() - wiff_stime),1)}s.')
-                QApplication.processEvents()
-            
-            else:
+        #.wiff extraction - each scan in the .wiff file is extracted to a unique mzml, with up to n_converters msconvert processes running at once
+        if sweep_values is not None:
+            if not convert_wiff_files(wiff_files, directory, mzml_directory, n_converters, msconvert_path, reporter, msconvert_options=msconvert_options, resume=resume):
                 return #exit analysis on unsucessful mzml extraction
-        
+
+        #the mzml files of each .wiff file are integrated (Step 4.1) as soon as they have been extracted, while the next .wiff file is still being converted
+        else:
+            if plot_flag and not prepare_plot_directory(reporter, mzml_directory):
+                return
+
+            parent_background = 0.0  # There will be no background fragmentation of the parent, so this is being hard-coded as zero.
+            integrated = convert_and_integrate(wiff_files, directory, mzml_directory, [parent_mz] + frags, search_window, parent_mz, [parent_background] + frag_bckgds, plot_flag, height, threshold, prominence, width,
+                                               mode=integration_mode, n_workers=n_workers, n_converters=n_converters, msconvert_path=msconvert_path, reporter=reporter, msconvert_options=msconvert_options, resume=resume, raw_spectrum=extract_raw_data_flag,
+                                               window_margin=window_margin)
+            if not integrated:
+                return #exit analysis on unsucessful mzml extraction or integration
+
         #Get list of extracted mzml files
-        mzml_files = [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
+        mzml_files = list(integrated) if integrated is not None else [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
 
     #if .wiff extraction is not requested, check to see if mzml files exist. 
     else:
@@ -131,31 +177,47 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
         if os.path.isdir(mzml_directory):
             mzml_files = [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
 
+            #an experiment store can stand in for mzml files that have been deleted to save space
+            if len(mzml_files) == 0:
+                store = open_experiment_store(mzml_directory)
+                if store is not None:
+                    mzml_files = list(store.mzml_files)
+                    experiment_store_flag = True
+                    print(f'No .mzml files were found in {mzml_directory}. Using the {len(mzml_files)} files archived in the experiment store {store.path} instead.')
+                    process_events()
+
             if len(mzml_files) == 0:
                 print(f'There are no .mzml files present in {mzml_directory} to extract! Please specify a directory that contains .wiff files if you wish to extract them, or transfer any mzml files to this folder, then re-run the code.\n')
-                QApplication.processEvents()
+                process_events()
                 return
         
         else:
             print('The mzml_directory could not be found. Please click the "extract mzml from .wiff" checkbox and re-run the code.')
-            QApplication.processEvents() 
+            process_events() 
             return    
+
+    #pack the spectra into the experiment store (if requested), or reuse the store if the mzml files haven't changed since it was built
+    store_file = None
+    if experiment_store_flag:
+        store_file = update_experiment_store(mzml_directory, mzml_files, reporter)
+        if not store_file:
+            return
     
     '''Step 2: Parse power_data.csv file (if present), and assign corresponding photofragmentation efficiency function depending on its presence.'''
     #empty array for PE_calc_NoNorm functions that requires these arguements because ... reasons. Don't worry about it future reader. This is the way. 
     laser_data = np.empty(shape=(len(mzml_files), 3), dtype=[('Wavelength', None),('LaserPower', None), ('PowerStdDev', None)]) 
 
     #Assisgn method to calcualte photofragmentation efficiency depending on if Power normalization is used or not
-    PE_function = PE_calc_noNorm 
+    PE_function = PE_calc_noNorm_vectorized 
     if power_file is not None: 
         #Load laser data from a CSV file into a structured NumPy array
         laser_data = np.genfromtxt(power_file, delimiter=',', dtype=None, names=['Wavelength', 'LaserPower', 'PowerStdDev'], encoding=None, ndmin=1)
-        PE_function = PE_calc
+        PE_function = PE_calc_vectorized
     
     #check to see if the number of mzml files (ie. the number of wavelengths scanned) matches the number of rows in the laser power data file. If not, we'll have index errors!
     if len(mzml_files) != len(laser_data['Wavelength']):
         print(f'The number of mzml files ({len(mzml_files)}) does not match the number of rows in the laser power data file ({len(laser_data["Wavelength"])}). Are there extra scans present / not enough power data?\n')
-        QApplication.processEvents()   
+        process_events()   
         return
     
     '''Step3: Get the m/z of each fragmentation channel and create arrays for PE data to be written to'''
@@ -166,39 +228,11 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
     #array size (rows x columns) to store photofragmentation efficiency (PE) data should be number of wavelengths x number of fragment ions * 2 (PE + stdev) + 2 (total PE + stdev) +1 (wavelength)
     PE_data = np.empty(shape=(len(mzml_files), num_fragment_ions * 2 + 3), dtype=float) 
 
-    '''Step4: Loop through each mzml file in the directory and calculate the fragmentation efficiency for each fragment specified'''
+    '''Step4: Get the laser wavelength of each mzml file, integrate the parent and fragment peaks of every file, and calculate the fragmentation efficiency for each fragment specified'''
     wavelengths = [] #empty list to store wavlengths to - wavelength written as last characters in each .mzML file
-    i = 0 #index to keep track of which row of the power normalization file that we are in
-
-    #make the directory for the plot files if requested and if it doesn't already exist. If it does and it contains plot files from previous run, prompt the user to delete the files
-    if plot_flag:
-        plot_dir = os.path.join(mzml_directory, 'integration_plots')
-        try:
-            os.mkdir(plot_dir)
-            time.sleep(3) #cloud-based storage bullshit with the folder not being recognized in time
-        except FileExistsError:
-            plot_files = [f for f in os.listdir(plot_dir) if f.lower().endswith('.png')]
-
-            if len(plot_files) > 0:
-                    #prompt user to delete files if present
-                    reply = QMessageBox.question(self, 'Plot files found in previous plot directory!',
-                                                f'The directory {plot_dir} already contains {len(plot_files)} .png files. Do you want to delete these files and re-extract? Analysis will be aborted if No is selected.',
-                                                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
-                                                QMessageBox.StandardButton.No)
-                    if reply == QMessageBox.StandardButton.Yes:
-                        j = 0
-                        for f in plot_files:
-                            j += 1
-                            os.remove(os.path.join(plot_dir, f))
-                        print(f'{j} .png files have been romoved from {plot_dir}. Proceeding with the analysis.')
-                    else:
-                        print(f'Extraction cancelled by user. Please uncheck the "plotting option", or manually delete the /integration_plots before re-running the code.')
-                        return
 
     for mzml_file in mzml_files: 
         
-        mzml_runstart = time.time()        
-        
         #get laser wavelength from mzml filename and append to list - need that for writing to the final .csv later
         try:
             match = re.search(r'Laser.*?(\d+)', mzml_file)
@@ -208,132 +242,101 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
                 wavelengths.append(wavelength)
             else:
                 print(f'The wavelength could not be found in {os.path.basename(mzml_file)}. Does the filename contain the text: "Laser"?\n')
-                QApplication.processEvents()         
+                process_events()         
                 return  
         
         except ValueError as ve:
             print(f'Could not extract the wavelength from the .mzml file name. This is what the code has found: {wavelength}.')
-            QApplication.processEvents()         
-            return     
+            process_events()         
+            return
 
-        #empty lists to store the average integrations and their stdev for each fragment - we need these to calcualte the total PE later.  
-        fragment_ion_integrations = [] 
-        fragment_ion_integrations_stdevs = []
+    #process the mzml files in order of increasing wavelength so that the PE data is assembled in wavelength order
+    wavelength_order = np.argsort(wavelengths, kind='stable')
+    mzml_files = [mzml_files[idx] for idx in wavelength_order]
+    wavelengths = [wavelengths[idx] for idx in wavelength_order]
 
-        fragment_ion_efficiencies = [] #empty list to store PE for each fragmentation channel
-        fragment_ion_efficiency_stdevs = [] #empty list to store PE stdev for each fragmentation channel
+    #look up the laser power of every wavelength in the power file
+    laser_power = get_laser_power(laser_data, wavelengths, PowerNorm_flag)
 
-        #get integration for base peak (parent ion)
-        try:
-            parent_background = 0.0  # There will be no background fragmentation of the parent, so this is being hard-coded as zero.
-            base_peak = integrate_spectra(mzml_directory, mzml_file, parent_mz, search_window, parent_mz, parent_background, plot_flag)
-
-            if base_peak[0] < 100000:
-                reply = QMessageBox.question(self, 'Low/zero integration for parent ion!',
-                                            f'Integration of the parent ion peak at mz {parent_mz} at {wavelength}nm is low (int = {base_peak[0]} +/- {base_peak[1]}). It\'s possible that the parent mz you provided is incorrect. Would you like to continue analysis? Analysis will be aborted if No is selected.\nNote that you will see this error pop up every time the parent ion integration is below 1E6.',
-                                            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
-                                            QMessageBox.StandardButton.No)
-                if reply == QMessageBox.StandardButton.No:
-                    print('Extraction cancelled by user. Please check that the parent mz is correct before re-running the code.')
-                    return
+    if laser_power is None:
+        return
+    laser_power, laser_power_stdev = laser_power
 
-        except Exception as e:
-            print(f'Problem encountered when integrating the base peak in {mzml_file}:\n{e}')
-            QApplication.processEvents()
+    '''Step4 (sweep mode): evaluate every combination of peak finder settings in the integration mode of the analysis, on spectra that are decoded once, and write the total PE of each setting to a .csv'''
+    if sweep_values is not None:
+        if not run_peak_sweep(reporter, directory, mzml_directory, mzml_files, wavelengths, parent_mz, search_window, frags, frag_bckgds, laser_power, laser_power_stdev, PE_function, sweep_values, out_basename, store_file, integration_mode, window_margin):
             return
-        
-        '''Step4.1: Integrate the mass spectrum to get the integrations of the parent ion peak and each fragment ion peak'''
-        for frag_mz, frag_backgd in zip(frags, frag_bckgds):
-            
-            try:
-                fragment_peak = integrate_spectra(mzml_directory, mzml_file, frag_mz, search_window, parent_mz, frag_backgd, plot_flag)
-                print(f'm/z {frag_mz} integration & stdev: {(fragment_peak)}')
 
-            except Exception as e:
-                print(f'Problem encountered when integrating the fragment m/z={frag_mz} in {mzml_file}:\n{e}')
-                QApplication.processEvents()         
-                return     
+        print(f'Peak finder parameter sweep has completed in {np.round((time.time() - start_time),2)} seconds.\n')
+        process_events()
+        return True
 
-            '''Step 4.2: Calculate PE for each fragment ion, then append PE to the fragment_ion_efficiencies list'''
-        
-            try:
-                #find the index where the integer part of the wavelength in the power file matches the integer wavelength from the filename
-                if PowerNorm_flag:
-                    integer_wavelengths = np.trunc(laser_data['Wavelength']).astype(int) #get int value from dict
-                    pwr_idxs = np.where(laser_data['Wavelength'] == wavelength)[0]
-                    pwr_idx_check = pwr_idxs[0]
-                    
-                    #there will only ever be one index because of the power file checks beforehand, but just in case.....
-                    if len(pwr_idxs) == 1 and np.isclose((laser_data['Wavelength'][pwr_idx_check] - wavelength), 0, rtol=0.01): #check if wavelengths match
-                        pwr_idx = pwr_idxs[0]
-                    
-                    elif len(pwr_idxs) == 1 and not np.isclose((laser_data['Wavelength'][pwr_idx_check] - wavelength), 0, rtol=0.01): #check if wavelengths match    
-                        print(f'WARNING: The power file entry for {laser_data["Wavelength"][pwr_idx]}nm is being compared to the file at {wavelength}nm ! Analysis will be aborted.')
-                        return               
-                    
-                    elif len(pwr_idxs) == 0:                        
-                        print(f'WARNING: The power file contains {len(pwr_idxs)} wavelength entries that match the mzML file at {wavelength}nm ! Analysis will be aborted.')
-                        return
+    #make the directory for the plot files if requested (already done before the extraction if the .wiff files were extracted)
+    if plot_flag and integrated is None and not prepare_plot_directory(reporter, mzml_directory):
+        return
 
-                    elif len(pwr_idxs) > 1:
-                        print(f'WARNING: The power file contains {len(pwr_idxs)} wavelength entries that match the mzML file at {wavelength}nm ! Analysis will be aborted.')
-                        return
-                    
-                PE = PE_function(wavelength, laser_data['LaserPower'][pwr_idx], laser_data['PowerStdDev'][pwr_idx], base_peak[0], base_peak[1], fragment_peak[0], fragment_peak[1]) #W, P, dP, Par, dPar, Frag, dFrag
-            
-            except IndexError:
-                print('The number of wavelengths sampled in your powerdata.csv file does not match the number of .mzML files extracted. These need to be the same.')
-                print(f'There are {len(mzml_files)} .mzML files in {directory} and {len(laser_data["LaserPower"])} wavelengths in {os.path.basename(power_file)}.')
-                QApplication.processEvents()  
-                return
-            
-            except Exception as e:
-                print(f'Problem encountered when calculating the photofragmentation efficiency of m/z={frag_mz} in {mzml_file}:\n{e}')
-                QApplication.processEvents()   
-                return     
-
-            #Since there are multiple fragmentation channels, append the PE from each channel to a list
-            #The PE_function returns a list - the first entry is the photofragmentation efficiency averaged over N spectra; the second entry is the associated stdev
-            fragment_ion_efficiencies.append(PE[0]) 
-            fragment_ion_efficiency_stdevs.append(PE[1])
-
-            #Since total PE is not the sum of the PE from all fragment channels, we need to store the total integration of all fragment ion peaks and their stdevs
-            fragment_ion_integrations.append(fragment_peak[0]) #storing total fragment ion area to calculate total PE later
-            fragment_ion_integrations_stdevs.append(fragment_peak[1]) #storing total fragment ion area stdev to calculate total PE stdev later
-
-        print(f'Integration for {np.round((wavelength),0)}nm has completed in {np.round((time.time() - mzml_runstart),2)} seconds.\n')
-        QApplication.processEvents()
-            
-        '''Step4.3: Compute the total photofragmentation efficiency'''    
-        #get total fragment ion integration 
-        total_fragment_ion_integration = np.sum(fragment_ion_integrations)
+    '''Step4.1: Integrate the parent ion peak and every fragment ion peak of each mzml file, one file at a time or in parallel (n_workers > 1)'''
+    if integrated is not None:
+        #integrated while the .wiff files were being extracted
+        all_integration_results = [integrated[mzml_file] for mzml_file in mzml_files]
 
-        #propagate stdev of each fragment ion uncertainty together. Since its jsut addition, proparation is the square root of the sum of squares
-        total_fragment_ion_integration_stdev = np.sqrt(np.sum(np.square(fragment_ion_integrations_stdevs)))
+    else:
+        parent_background = 0.0  # There will be no background fragmentation of the parent, so this is being hard-coded as zero.
+        all_integration_results = integrate_mzml_files(mzml_directory, mzml_files, [parent_mz] + frags, search_window, parent_mz, [parent_background] + frag_bckgds, plot_flag, height, threshold, prominence, width, mode=integration_mode, n_workers=n_workers, reporter=reporter, store_file=store_file, raw_spectrum=extract_raw_data_flag, window_margin=window_margin)
 
-        #compute total PE for each mzml file
-        try:
-            Total_PE = PE_function(wavelength, laser_data['LaserPower'][pwr_idx], laser_data['PowerStdDev'][pwr_idx], base_peak[0], base_peak[1], total_fragment_ion_integration, total_fragment_ion_integration_stdev) #W, P, dP, Par, dPar, Frag, dFrag
-        
-        except IndexError:
-            print('The number of wavelengths sampled in your powerdata.csv file does not match the number of .mzML files extracted. These need to be the same.')
-            print(f'There are {len(mzml_files)} .mzML files in {directory} and {len(laser_data["LaserPower"])} wavelengths in {os.path.basename(power_file)}.')
-            QApplication.processEvents()        
-            return
-        
-        except Exception as e:
-            print(f'Problem encountered when calculating the TOTAL photofragmentation efficiency in {mzml_file}:\n{e}\n')
-            QApplication.processEvents()         
-            return   
+    if not all_integration_results:
+        return
+
+    #(n_wavelengths, n_targets, 2) array of [average integration, stdev]. Target 0 is the parent ion, the rest are the fragments in the order of the fragment file.
+    integrations = np.array(all_integration_results, dtype=float).reshape(len(mzml_files), len(frags) + 1, 2)
+
+    '''Step4.2: Quality control - check every wavelength at once, then flag, skip or abort as set by qc_action'''
+    qc_flags = run_qc_checks(wavelengths, integrations, min_parent_integral)
+    keep = apply_qc_policy(reporter, qc_flags, wavelengths, qc_action, parent_mz)
+    if keep is None:
+        return
 
-        '''Step4.3: Store calculated efficiencies in the result_data array. row index = i'''  
-        PE_data[i, 0] = wavelength #wavelengths in first column
-        PE_data[i, 1] = Total_PE[0] #Store total_efficiency in the second column
-        PE_data[i, 2] = Total_PE[1] #Store total_efficiency stdev in the third column       
-        PE_data[i, 3:num_fragment_ions*2 + 3:2] = fragment_ion_efficiencies #Store fragment ion efficiency in the 4, 6, 8, 10, .... columns
-        PE_data[i, 4:num_fragment_ions*2 + 3:2] = fragment_ion_efficiency_stdevs #Store fragment ion efficiency stdev in the 5, 7, 9, 11, .... columns
+    if not keep.any():
+        print('Every wavelength has been left out by the quality control policy. No output files have been written.')
+        process_events()
+        return
+
+    integrations = integrations[keep]
+    wavelengths = [wavelength for wavelength, kept in zip(wavelengths, keep) if kept]
+    laser_power, laser_power_stdev = laser_power[keep], laser_power_stdev[keep]
+    PE_data = PE_data[keep]
+
+    for wavelength, integration_results in zip(wavelengths, integrations):
+        #print the integrations of each fragment ion peak
+        for frag_mz, fragment_peak in zip(frags, integration_results[1:]):
+            print(f'm/z {frag_mz} integration & stdev: {list(fragment_peak)}')
+
+    '''Step4.3: Calculate the PE of every fragment ion and the total PE at every wavelength with a single vectorized call'''
+    parent_integrations = integrations[:, 0, 0:1] #(n_wavelengths, 1) columns that broadcast against the fragment matrix
+    parent_integration_stdevs = integrations[:, 0, 1:2]
+    fragment_integrations = integrations[:, 1:, 0] #(n_wavelengths, n_fragments)
+    fragment_integration_stdevs = integrations[:, 1:, 1]
+
+    #Since total PE is not the sum of the PE from all fragment channels, the total fragment integration is prepended as an extra "fragment" column.
+    #The stdevs of the fragment ions are propagated as the square root of the sum of squares.
+    total_fragment_integration = fragment_integrations.sum(axis=1, keepdims=True)
+    total_fragment_integration_stdev = np.sqrt(np.square(fragment_integration_stdevs).sum(axis=1, keepdims=True))
+
+    try:
+        PE, PE_stdev = PE_function(np.asarray(wavelengths)[:, None], laser_power[:, None], laser_power_stdev[:, None], parent_integrations, parent_integration_stdevs,
+                                   np.hstack([total_fragment_integration, fragment_integrations]), np.hstack([total_fragment_integration_stdev, fragment_integration_stdevs])) #W, P, dP, Par, dPar, Frag, dFrag
+
+    except Exception as e:
+        print(f'Problem encountered when calculating the photofragmentation efficiencies:\n{e}')
+        process_events()
+        return
 
-        i+=1 #update index to start next row of printing to results file 
+    '''Step4.3: Store calculated efficiencies in the result_data array'''
+    PE_data[:, 0] = wavelengths #wavelengths in first column
+    PE_data[:, 1] = PE[:, 0] #Store total_efficiency in the second column
+    PE_data[:, 2] = PE_stdev[:, 0] #Store total_efficiency stdev in the third column
+    PE_data[:, 3:num_fragment_ions*2 + 3:2] = PE[:, 1:] #Store fragment ion efficiency in the 4, 6, 8, 10, .... columns
+    PE_data[:, 4:num_fragment_ions*2 + 3:2] = PE_stdev[:, 1:] #Store fragment ion efficiency stdev in the 5, 7, 9, 11, .... columns
 
     '''Step5: Create an array to write PE data to'''
     #Create a structured array for results
@@ -355,15 +358,20 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
 
     except Exception as e:
         print(f'Problem encountered when creating structured data array:\n{e}')
-        QApplication.processEvents()         
+        process_events()         
         return    
 
-    '''Step6: Write the PE data and its smoothed variant to Excel files'''
+    '''Step6: Write the PE data and its smoothed variant in every output format (the Excel workbook by default)'''
+    if reporter.cancelled():
+        print('Analysis cancelled by user. No output files have been written.')
+        return
+
+    reporter.progress(len(mzml_files), len(mzml_files), 'Writing results')
     
     #remove the path if one was inadvertantly provided:
     out_basename = os.path.basename(out_basename)
 
-    #Remove any extension in the basename if it was provided (want to ensure it gets written with an excel file extension)
+    #Remove any extension in the basename if it was provided (want to ensure it gets written with the extension of each output format)
     if '.' in out_basename:
         out_basename = out_basename.rsplit('.', 1)[0]
     
@@ -371,120 +379,172 @@ def process_UVPD_5500(self, directory, parent_mz, search_window, frag_list_file,
         print('The field for the output basename is empty. The name of the output file will default to photofrag_eff.xlsx')
         out_basename = 'photofrag_eff'
     
-    output_file = os.path.join(directory,f'{out_basename}.xlsx')
-    index = 0
+    output_base = unique_output_base(directory, out_basename, output_formats)
 
-    #mechanism to prevent overwriting existing output files
-    while os.path.exists(output_file):
-        index += 1
-        output_file = os.path.join(directory,f'{out_basename}_{index}.xlsx')
-
-    # Apply weighted adjacent average smoothing to all columns except 'Wavelength'
-    smoothed_df = df.copy()
-    for column in smoothed_df.columns:
-        if column != 'Wavelength':
-            smooth_window = int(adj_avg_smoothing_size)
-            smoothed_df[column] = smoothed_df[column].rolling(window=smooth_window, min_periods=1, center=True).mean()
-
-    #Normalize data
-    max_pe = df['Total PE'].max()
-    normalized_original = df[['Wavelength', 'Total PE', 'Total PE stdev']].copy()
-    normalized_original['Total PE'] /= max_pe
-    normalized_original['Total PE stdev'] /= max_pe
-
-    max_pe_smoothed = smoothed_df['Total PE'].max()
-    normalized_smoothed = smoothed_df[['Wavelength', 'Total PE', 'Total PE stdev']].copy()
-    normalized_smoothed['Total PE'] /= max_pe_smoothed
-    normalized_smoothed['Total PE stdev'] /= max_pe_smoothed
-
-    #write normalized data to dataframe
-    normalized_data = pd.DataFrame({
-    'Wavelength': normalized_original['Wavelength'],
-    'Total PE': normalized_original['Total PE'],
-    'Total PE StDev': normalized_original['Total PE stdev'],
-    'Smoothed Total PE': normalized_smoothed['Total PE'],
-    'Smoothed Total PE StDev': normalized_smoothed['Total PE stdev']
-    })
+    #the settings of the analysis, written with the results by the json output
+    metadata = {'directory': directory, 'mzml_directory': mzml_directory, 'mzml_files': mzml_files, 'parent_mz': parent_mz, 'search_window': search_window,
+                'fragments': [{'mz': frag_mz, 'background': frag_bckgd} for frag_mz, frag_bckgd in zip(frags, frag_bckgds)], 'power_file': power_file if PowerNorm_flag else None,
+                'peak_finder': {'height': height, 'threshold': threshold, 'prominence': prominence, 'width': width}, 'smoothing': adj_avg_smoothing_size,
+                'integration_mode': integration_mode, 'window_margin': window_margin, 'qc_action': qc_action, 'min_parent_integral': min_parent_integral, 'run_time': np.round((time.time() - start_time), 2)}
 
     try:
-        #Write both original and smoothed data to Excel
-        with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Original')
-            smoothed_df.to_excel(writer, index=False, sheet_name=f'Smoothed')
-            normalized_data.to_excel(writer, index=False, sheet_name='Normalization')
-
-            #Plot total PE in each worksheet
-            for sheet_name, dataframe in zip(['Original', 'Smoothed'],[df, smoothed_df]):
-                worksheet = writer.sheets[sheet_name]
-                workbook = writer.book
-                chart = workbook.add_chart({'type': 'scatter', 'subtype': 'straight_with_markers'})
-                max_row = len(dataframe) + 1
-
-                # Finding the min and max wavelength from the DataFrame
-                min_wavelength = dataframe['Wavelength'].min()
-                max_wavelength = dataframe['Wavelength'].max()
-
-                # Series for Total PE with error bars
-                chart.add_series({
-                    'name': f'Total PE {sheet_name}',
-                    'categories': f'={sheet_name}!$A$2:$A${max_row}',
-                    'values': f'={sheet_name}!$B$2:$B${max_row}',
-                    'y_error_bars': {
-                        'type': 'custom',
-                        'plus_values': f'={sheet_name}!$C$2:$C${max_row}',  # Assuming the stdev values for positive error
-                        'minus_values': f'={sheet_name}!$C$2:$C${max_row}',  # Assuming the same stdev values for negative error
-                        'line': {'color': 'black'},
-                        'end_style': 1  # Optional: no cap on the error bars
-                    },
-                    'line': {'color': 'blue', 'width': 1},  
-                    'marker': {'type': 'circle', 'size': 4, 'border': {'color': 'black'}, 'fill': {'color': 'black'}}
-                })
-
-                # Set chart title and axis titles
-                chart.set_title({'name': 'Photofragmentation Efficiency'})
-                chart.set_x_axis({'name': 'Wavelength (nm)', 
-                    'name_font': {'size': 14, 'bold': True}, 
-                    'num_font': {'italic': True},
-                    'min': min_wavelength, 
-                    'max': max_wavelength})
-                chart.set_y_axis({'name': 'Total PE', 'name_font': {'size': 14, 'bold': True}, 'num_font': {'italic': True}})
-
-                # Set style and layout
-                chart.set_style(10)  # Predefined style (1-48 available)
-                chart.set_legend({'position': 'bottom'})
-
-                #add chart to worksheet
-                worksheet.insert_chart('E4', chart)
-
-    except PermissionError: #this should never proc because we check for existing files and change the ending index to make sure the file is new, but you never know...
-        print(f'Python is trying to write to {output_file}, but it is open. Please close it and then rerun the code.')
-        QApplication.processEvents()        
-        return
-    
+        results = UVPDResults(df, adj_avg_smoothing_size, qc_flags, metadata)
+
     except Exception as e:
-        print(f'An unexpected exception occured when trying to write the PE data to the Excel file {os.path.basename(output_file)}:\n{e}')
-        QApplication.processEvents()        
-        return        
+        print(f'Problem encountered when smoothing and normalizing the photofragmentation efficiencies:\n{e}')
+        process_events()
+        return
+
+    output_files = write_results(results, output_base, output_formats)
+    if output_files is None:
+        return
+
+    print(f'Results written to {", ".join(os.path.basename(path) for path in output_files)}.')
+    process_events()
 
     '''Step7: Write Raw Mass Spectra to a file (if requested by the user)'''
     if extract_raw_data_flag:
         print('User has requested generation of raw data. Exporting mass spectra now...')
-        QApplication.processEvents()
+        process_events()
+        reporter.progress(len(mzml_files), len(mzml_files), 'Exporting raw data')
 
-        rawdata_file_name = os.path.join(directory,'Raw_data.csv')
+        extension = RAW_DATA_FORMATS[raw_data_format]
+        rawdata_file_name = os.path.join(directory,f'Raw_data{extension}')
         
         #mechanism to prevent overwriting existing output files
         index = 0
 
         while os.path.exists(rawdata_file_name):
             index += 1
-            rawdata_file_name = os.path.join(directory,f'Raw_data_{index}.csv')
+            rawdata_file_name = os.path.join(directory,f'Raw_data_{index}{extension}')
 
-        extract_RawData(mzml_directory, parent_mz, rawdata_file_name)
+        extract_RawData(mzml_directory, parent_mz, rawdata_file_name, store_file, raw_data_format, raw_data_float32)
         
     run_time = np.round((time.time() - start_time),2)
 
     print(f'UVPD photofragmentation efficiency calculation has completed in {run_time} seconds.\n')
-    QApplication.processEvents()  #Allow the GUI to update
+    process_events()  #Allow the GUI to update
+
+    return True
+
+def read_fragment_file(frag_list_file):
+    '''Reads the fragment m/z values and their background intensities from the fragment file (one "m/z, background" pair per line). Returns (frags, frag_bckgds), or None if the file is malformed.'''
+    frags = [] #empty list to store fragment m/z values from .txt
+    frag_bckgds = [] #empty list to store fragment background signal intensities from .txt
+    
+    with open(frag_list_file, 'r') as opf:
+        lines = opf.readlines()
+
+    for line in lines:
+        line = line.strip()
+        if line:  #Ignore empty lines
+            parts = line.split(',')
+            if len(parts) == 2:  #Ensure there are exactly two elements, which is only possible if the line has one comma
+                try:
+                    #Convert each part to a float (or int, depending on your requirement)
+                    frag = float(parts[0])
+                    bckgd = float(parts[1])
+                    
+                    frags.append(frag)
+                    frag_bckgds.append(bckgd)
+                
+                except ValueError:
+                    print(f'Non-numeric entry encountered in {os.path.basename(frag_list_file)}: {line}.\nPlease check the fragment list .txt file and re-run the code.')
+                    return
+                
+            else:
+                print(f'The following line in {os.path.basename(frag_list_file)} contains more than two comma-separated entries: {line}.\nPlease check the fragment list .txt file and re-run the code.')
+                return
+
+    return frags, frag_bckgds
+
+def prepare_plot_directory(reporter, mzml_directory):
+    '''Makes mzml_directory/integration_plots if it doesn't already exist. If it does and it contains plot files from a previous run, prompts the user to delete the files.
+    Kept files are not plotted again for targets whose integration results are cached, so that a stopped run can be resumed. Returns True once the directory is ready.'''
+    plot_dir = os.path.join(mzml_directory, 'integration_plots')
+    try:
+        os.mkdir(plot_dir)
+        time.sleep(3) #cloud-based storage bullshit with the folder not being recognized in time
+    except FileExistsError:
+        plot_files = [f for f in os.listdir(plot_dir) if f.lower().endswith('.png')]
+
+        if len(plot_files) > 0:
+                #prompt user to delete files if present
+                reply = reporter.question('Plot files found in previous plot directory!',
+                                          f'The directory {plot_dir} already contains {len(plot_files)} .png files. Do you want to delete these files and re-extract? '
+                                          'If No is selected, the files are kept, and the targets that already have a plot and a saved integration result (e.g., from a run that was stopped) are not integrated again.')
+                if reply:
+                    j = 0
+                    for f in plot_files:
+                        j += 1
+                        os.remove(os.path.join(plot_dir, f))
+                    print(f'{j} .png files have been romoved from {plot_dir}. Proceeding with the analysis.')
+                else:
+                    print(f'Keeping the {len(plot_files)} .png files in {plot_dir}. Only the targets without a plot or a saved integration result will be integrated and plotted.')
+
+    return True
+
+def get_laser_power(laser_data, wavelengths, PowerNorm_flag):
+    '''Returns (laser power, laser power stdev) arrays with the entry of the power file that matches each wavelength, or None if a wavelength does not have exactly one entry.
+    Without power normalization, both arrays are zero (they are ignored by PE_calc_noNorm_vectorized).'''
+    if not PowerNorm_flag:
+        return np.zeros(len(wavelengths)), np.zeros(len(wavelengths))
+
+    matches = laser_data['Wavelength'][None, :] == np.asarray(wavelengths)[:, None] #(n_wavelengths, n_power_file_rows)
+    n_matches = matches.sum(axis=1)
+
+    for wavelength, n_match in zip(wavelengths, n_matches):
+        if n_match != 1:
+            print(f'WARNING: The power file contains {n_match} wavelength entries that match the mzML file at {wavelength}nm ! Analysis will be aborted.')
+            process_events()
+            return None
+
+    pwr_idx = np.argmax(matches, axis=1)
+    return laser_data['LaserPower'][pwr_idx].astype(float), laser_data['PowerStdDev'][pwr_idx].astype(float)
 
-    return
+def run_peak_sweep(reporter, directory, mzml_directory, mzml_files, wavelengths, parent_mz, search_window, frags, frag_bckgds, laser_power, laser_power_stdev, PE_function, sweep_values, out_basename, store_file=None, integration_mode='full', window_margin=None):
+    '''Sweep mode of process_UVPD_5500: integrates every mzml file in integration_mode for every combination of peak finder settings and writes the total PE of each setting and wavelength to directory/out_basename_peak_sweep.csv. Returns True on success, False otherwise.'''
+
+    n_settings = np.prod([len(sweep_values[parameter]) for parameter in sweep_values])
+    print(f'Starting peak finder parameter sweep over {n_settings} settings...')
+    process_events()
+
+    parent_background = 0.0  # There will be no background fragmentation of the parent, so this is being hard-coded as zero.
+    sweep = sweep_peak_parameters(mzml_directory, mzml_files, [parent_mz] + frags, search_window, parent_mz, [parent_background] + frag_bckgds, sweep_values, window_margin, reporter=reporter, store_file=store_file, mode=integration_mode)
+
+    if not sweep:
+        return False
+
+    settings, means, stdevs = sweep
+    sweep_df = sweep_total_PE(settings, wavelengths, means, stdevs, PE_function, laser_power, laser_power_stdev)
+
+    #summarize each setting: how many wavelengths had no parent peak, and the average total PE over the sweep
+    for s, (height, threshold, prominence, width) in enumerate(settings):
+        n_missing = int(np.sum(means[s, :, 0] == 0))
+        print(f'Height {height}, threshold {threshold}, prominence {prominence}, width {width}: mean total PE = {np.mean(sweep_df["Total PE"].values[s*len(wavelengths):(s+1)*len(wavelengths)])}, parent ion not found at {n_missing}/{len(wavelengths)} wavelengths.')
+    process_events()
+
+    #remove the path and any extension if they were provided
+    out_basename = os.path.basename(out_basename)
+    if '.' in out_basename:
+        out_basename = out_basename.rsplit('.', 1)[0]
+    elif not out_basename:
+        out_basename = 'photofrag_eff'
+
+    #mechanism to prevent overwriting existing output files
+    output_file = os.path.join(directory, f'{out_basename}_peak_sweep.csv')
+    index = 0
+    while os.path.exists(output_file):
+        index += 1
+        output_file = os.path.join(directory, f'{out_basename}_peak_sweep_{index}.csv')
+
+    try:
+        sweep_df.to_csv(output_file, index=False)
+        print(f'The total PE of every peak finder setting has been written to {output_file}.')
+        process_events()
+        return True
+
+    except Exception as e:
+        print(f'An unexpected exception occured when trying to write the parameter sweep to {os.path.basename(output_file)}:\n{e}')
+        process_events()
+        return False
@@ -1,6 +1,6 @@
 #import python libraries once it is verified that they are installed
 from PyQt6.QtWidgets import QApplication, QHBoxLayout, QComboBox, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QMessageBox, QLabel, QGroupBox, QLineEdit, QPushButton, QFileDialog, QTextEdit, QCheckBox, QSpinBox, QSizePolicy, QDoubleSpinBox
-from PyQt6.QtCore import QCoreApplication, Qt, QThread, pyqtSignal
+from PyQt6.QtCore import QCoreApplication, Qt, QThread, pyqtSignal, QObject
 from PyQt6.QtGui import QScreen, QIcon, QTextCursor
 import numpy as np
 
@@ -35,6 +35,11 @@ class TextRedirect(StringIO):
         #Invoke the stored callback function to notify external components with the written text
         self.update_output(text)
 
+class OutputSignal(QObject):
+    '''Carries printed text to the status window. Print statements can come from worker threads, and widgets may only be touched on the GUI thread,
+    so the text is sent through a signal, which Qt queues onto the GUI thread whenever it is emitted from another thread.'''
+    text_written = pyqtSignal(str)
+
 #############################################
 #               Main GUI Layout
 #############################################
@@ -45,7 +50,9 @@ class SpectroGUI(QMainWindow):
         super().__init__()
 
         self.output_text_edit = QTextEdit()
-        self.text_redirector = TextRedirect(update_output=self.update_output_text)
+        self.output_signal = OutputSignal()
+        self.output_signal.text_written.connect(self.update_output_text)
+        self.text_redirector = TextRedirect(update_output=self.output_signal.text_written.emit)
         sys.stdout = self.text_redirector
 
         self.initUI()
@@ -81,6 +88,12 @@ class SpectroGUI(QMainWindow):
         self.QTRAP5500_UVPD_tab = QTRAP5500_UVPD_processing(self.output_text_edit)
         QTRAP_5500_MainTab.addTab(self.QTRAP5500_UVPD_tab, 'UVPD processing')
 
+        self.QTRAP5500_batch_tab = QTRAP5500_batch_queue(self.output_text_edit, self.QTRAP5500_UVPD_tab)
+        QTRAP_5500_MainTab.addTab(self.QTRAP5500_batch_tab, 'Batch queue')
+
+        self.QTRAP5500_inspector_tab = QTRAP5500_integration_inspector(self.output_text_edit, self.QTRAP5500_UVPD_tab)
+        QTRAP_5500_MainTab.addTab(self.QTRAP5500_inspector_tab, 'Integration inspector')
+
         self.QTRAP5500_IRMPD_tab = QTRAP5500_IRMPD_processing(self.output_text_edit)
         QTRAP_5500_MainTab.addTab(self.QTRAP5500_IRMPD_tab, 'IRMPD processing')
 
@@ -129,6 +142,11 @@ class SpectroGUI(QMainWindow):
                                       'Are you sure you wish to exit?',
                                       QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if choice == QMessageBox.StandardButton.Yes:
+            #stop any analysis that is still running in the background
+            self.QTRAP5500_UVPD_tab.stop_worker()
+            self.QTRAP5500_batch_tab.stop_worker()
+            self.QTRAP5500_inspector_tab.stop_worker()
+
             #restore original stdout (ie. normal printing) before closing the application
             sys.stdout = sys.__stdout__
             event.accept()
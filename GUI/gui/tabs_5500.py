@@ -1,8 +1,71 @@
 #import python libraries once it is verified that they are installed
-from PyQt6.QtWidgets import QApplication, QHBoxLayout, QComboBox, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QMessageBox, QLabel, QGroupBox, QLineEdit, QPushButton, QFileDialog, QTextEdit, QCheckBox, QSpinBox, QSizePolicy, QDoubleSpinBox
+import os, traceback
+from PyQt6.QtWidgets import QApplication, QHBoxLayout, QComboBox, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QMessageBox, QLabel, QGroupBox, QLineEdit, QPushButton, QFileDialog, QTextEdit, QCheckBox, QSpinBox, QSizePolicy, QDoubleSpinBox, QProgressBar, QTableWidget, QTableWidgetItem, QAbstractItemView
+from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal
+import re
+from collections import OrderedDict
 
 #import module dependencies
 from SCIEX.process_UVPD_5500 import *
+from SCIEX.batch_UVPD_5500 import BatchQueue, run_batch_queue
+from workflows.reporting import Reporter
+from workflows.peak_param_sweep import SWEEP_PARAMETERS, parse_sweep_values
+from workflows.qc import MIN_PARENT_INTEGRAL
+from workflows.experiment_store import open_experiment_store
+from workflows.integrate_mzml import inspect_integration
+from workflows.integration_plots import IntegrationPlotRenderer, plot_file
+from uvpd import load_config
+
+class QtReporter(Reporter):
+    '''Forwards progress and questions from the analysis (running on a worker thread) to the GUI thread through the worker's signals'''
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+
+    def report_progress(self, files_done, n_files, stage, throughput, eta, unit='files'):
+        self.worker.progress_changed.emit(files_done, n_files, stage, throughput, eta, unit)
+
+    def question(self, title, text, default=False):
+        #question_asked uses a blocking connection, so emit only returns once the user has answered the message box on the GUI thread
+        self.worker.question_asked.emit(title, text, default)
+        return self.worker.reply
+
+class UVPD_5500_worker(QThread):
+    '''Runs process_UVPD_5500 on a separate thread so that the GUI stays responsive (and can cancel the run) during the analysis'''
+    progress_changed = pyqtSignal(int, int, str, float, float, str) #files done, total files, stage, throughput (files/s), ETA (s), what is counted ('files', 'plots')
+    question_asked = pyqtSignal(str, str, bool) #title, text, default answer
+
+    def __init__(self, kwargs, parent=None):
+        super().__init__(parent)
+        self.kwargs = kwargs
+        self.reply = False
+        self.reporter = QtReporter(self)
+
+    def run(self):
+        try:
+            process_UVPD_5500(self.reporter, **self.kwargs)
+        
+        except Exception as e:
+            print(f'An unexpected error occured during the analysis:\n{e}\nTraceback: {traceback.format_exc()}')
+
+class batch_queue_worker(QThread):
+    '''Runs the jobs of a batch queue on a separate thread. The jobs themselves run in worker processes (see SCIEX.batch_UVPD_5500).'''
+    progress_changed = pyqtSignal(int, int, str, float, float, str) #jobs done, total jobs, stage, throughput (jobs/s), ETA (s), unit (unused: always jobs)
+    question_asked = pyqtSignal(str, str, bool) #unused: jobs answer their own questions
+
+    def __init__(self, queue, max_parallel, parent=None):
+        super().__init__(parent)
+        self.queue = queue
+        self.max_parallel = max_parallel
+        self.reply = False
+        self.reporter = QtReporter(self)
+
+    def run(self):
+        try:
+            run_batch_queue(self.queue, self.max_parallel, self.reporter)
+        
+        except Exception as e:
+            print(f'An unexpected error occured while running the batch queue:\n{e}\nTraceback: {traceback.format_exc()}')
 
 class QTRAP5500_control(QWidget):
     def __init__(self, text_redirector, parent=None):
@@ -137,6 +200,73 @@ class QTRAP5500_UVPD_processing(QWidget):
         layout.addLayout(peak_fit_param_layout)
         layout.addSpacing(5)
 
+        #Peak finder parameter sweep - comma-separated lists of values to try for each parameter. Blank fields use the single value above.
+        sweep_title = QLabel('Parameter sweep values (comma-separated, blank = value above). Used by "Run sweep":')
+        sweep_layout = QHBoxLayout()
+
+        self.sweep_inputs = {}
+        for parameter in SWEEP_PARAMETERS:
+            sweep_label = QLabel(f'{parameter.capitalize()}:')
+            sweep_input = QLineEdit()
+            sweep_input.setPlaceholderText('e.g. 1000, 2000, 5000')
+            self.sweep_inputs[parameter] = sweep_input
+
+            sweep_layout.addWidget(sweep_label)
+            sweep_layout.addWidget(sweep_input)
+            sweep_layout.addSpacing(5)
+
+        layout.addWidget(sweep_title)
+        layout.addLayout(sweep_layout)
+        layout.addSpacing(5)
+
+        #Integration mode - how each scan is interpolated and searched for peaks
+        integration_mode_layout = QHBoxLayout()
+
+        integration_mode_label = QLabel('Integration mode:')
+        self.integration_mode_input = QComboBox()
+        self.integration_mode_input.addItem('Full grid (0 to parent m/z + 50)', 'full')
+        self.integration_mode_input.addItem('Windowed (search window +/- 2 m/z only)', 'windowed')
+        self.integration_mode_input.addItem('Batched (windowed, all scans at once)', 'batched')
+        self.integration_mode_input.addItem('Native sampling (no interpolation)', 'native')
+        self.integration_mode_input.addItem('Averaged spectrum (bootstrap stdev)', 'averaged')
+        self.integration_mode_input.setToolTip('Full grid: interpolates every scan onto the 0.01 m/z grid.\n'
+                                               'Windowed: only interpolates around each target; can integrate less than the full grid on a noisy baseline unless the base window is set.\n'
+                                               'Batched: windowed, with all scans of a file at once.\n'
+                                               'Native sampling: integrates the raw data points without interpolating.\n'
+                                               'Averaged spectrum: integrates the mean of all scans once; its stdev is a bootstrap estimate.')
+
+        #optional limit of the search for the peak bases, in every integration mode
+        window_margin_label = QLabel('Base window (+/- m/z):')
+        self.window_margin_input = QDoubleSpinBox()
+        self.window_margin_input.setDecimals(2)
+        self.window_margin_input.setMinimum(0.0)
+        self.window_margin_input.setMaximum(50.0)
+        self.window_margin_input.setSingleStep(0.5)
+        self.window_margin_input.setSpecialValueText('Off')
+        self.window_margin_input.setValue(0.0)
+        self.window_margin_input.setToolTip('Searches the peak bases only this far on each side of the peak, so that the windowed modes match the full grid. Off searches the whole spectrum.')
+
+        #number of worker processes used to integrate the mzML files (wavelengths) in parallel
+        n_workers_label = QLabel('Worker processes:')
+        self.n_workers_input = QSpinBox()
+        self.n_workers_input.setMinimum(1)
+        self.n_workers_input.setMaximum(os.cpu_count() or 1)
+        self.n_workers_input.setValue(1)
+        self.n_workers_input.setToolTip('Number of mzML files (wavelengths) integrated in parallel. 1 processes the files one after another.')
+
+        integration_mode_layout.addWidget(integration_mode_label)
+        integration_mode_layout.addWidget(self.integration_mode_input)
+        integration_mode_layout.addSpacing(5)
+        integration_mode_layout.addWidget(window_margin_label)
+        integration_mode_layout.addWidget(self.window_margin_input)
+        integration_mode_layout.addSpacing(5)
+        integration_mode_layout.addWidget(n_workers_label)
+        integration_mode_layout.addWidget(self.n_workers_input)
+        integration_mode_layout.addStretch(1)
+
+        layout.addLayout(integration_mode_layout)
+        layout.addSpacing(5)
+
         #Fragment Ion Text file
         frag_layout = QHBoxLayout()
         
@@ -153,10 +283,43 @@ class QTRAP5500_UVPD_processing(QWidget):
         layout.addLayout(frag_layout)
         layout.addSpacing(5)  
         
-        #Extract mzML from .wiff Flag
+        #Extract mzML from .wiff Flag, and the number of .wiff files converted at the same time
+        extract_layout = QHBoxLayout()
         self.extract_mzml_checkbox = QCheckBox('Extract mzML files from .wiff?')
 
-        layout.addWidget(self.extract_mzml_checkbox)
+        n_converters_label = QLabel('Concurrent msconvert processes:')
+        self.n_converters_input = QSpinBox()
+        self.n_converters_input.setMinimum(1)
+        self.n_converters_input.setMaximum(os.cpu_count() or 1)
+        self.n_converters_input.setValue(1)
+        self.n_converters_input.setToolTip('Number of .wiff files converted to mzML at the same time.')
+
+        extract_layout.addWidget(self.extract_mzml_checkbox)
+        extract_layout.addSpacing(10)
+        extract_layout.addWidget(n_converters_label)
+        extract_layout.addWidget(self.n_converters_input)
+        extract_layout.addStretch(1)
+
+        layout.addLayout(extract_layout)
+
+        #msconvert options that shrink the mzML files written during extraction
+        msconvert_options_layout = QHBoxLayout()
+        self.mz_window_filter_checkbox = QCheckBox('Only keep m/z 0 to parent m/z + 50')
+        self.mz_window_filter_checkbox.setChecked(True)
+        self.mz_window_filter_checkbox.setToolTip('msconvert drops every peak above the m/z range used by the analysis, so the mzML files are smaller and faster to read. Results are unchanged.')
+        self.zlib_checkbox = QCheckBox('zlib compression')
+        self.zlib_checkbox.setChecked(True)
+        self.zlib_checkbox.setToolTip('Lossless compression of the m/z and intensity arrays in the mzML files.')
+        self.intensity_32bit_checkbox = QCheckBox('32-bit intensities')
+        self.intensity_32bit_checkbox.setToolTip('Stores intensities as 32-bit floats (m/z values stay 64-bit). Halves the size of the intensity arrays, at ~7 significant digits of precision.')
+
+        msconvert_options_layout.addSpacing(20)
+        msconvert_options_layout.addWidget(self.mz_window_filter_checkbox)
+        msconvert_options_layout.addWidget(self.zlib_checkbox)
+        msconvert_options_layout.addWidget(self.intensity_32bit_checkbox)
+        msconvert_options_layout.addStretch(1)
+
+        layout.addLayout(msconvert_options_layout)
         layout.addSpacing(5)  
 
         #PowerNorm Flag
@@ -187,18 +350,51 @@ class QTRAP5500_UVPD_processing(QWidget):
         layout.addLayout(power_file_layout)
         layout.addSpacing(5)
 
-        #PrintRawData Flag
+        #PrintRawData Flag, and the format of the raw data file
+        raw_data_layout = QHBoxLayout()
+
         self.print_raw_data_checkbox = QCheckBox('Print Raw Data?')
+        self.print_raw_data_checkbox.stateChanged.connect(self.toggle_raw_data_format)
+
+        self.raw_data_format_label = QLabel('Format:')
+        self.raw_data_format_input = QComboBox()
+        self.raw_data_format_input.addItem('CSV', 'csv')
+        self.raw_data_format_input.addItem('NumPy (.npy)', 'npy')
+        self.raw_data_format_input.addItem('Parquet', 'parquet')
+        self.raw_data_format_input.addItem('Feather', 'feather')
+        self.raw_data_format_input.setToolTip('CSV and NumPy files hold one column per wavelength. Parquet and Feather files hold one row per point (wavelength, m/z, intensity)\n'
+                                              'and require pyarrow. Every format is written one wavelength at a time, so long sweeps don\'t need more memory.')
+        self.raw_data_float32_checkbox = QCheckBox('32-bit intensities')
+        self.raw_data_float32_checkbox.setToolTip('Write the intensities as 32-bit floats (m/z stays 64-bit), which halves the size of the binary formats.')
+
+        #default setting is off unless the print raw data checkbox is checked
+        self.raw_data_format_label.setEnabled(False)
+        self.raw_data_format_input.setEnabled(False)
+        self.raw_data_float32_checkbox.setEnabled(False)
 
-        layout.addWidget(self.print_raw_data_checkbox)
+        raw_data_layout.addWidget(self.print_raw_data_checkbox)
+        raw_data_layout.addSpacing(10)
+        raw_data_layout.addWidget(self.raw_data_format_label)
+        raw_data_layout.addWidget(self.raw_data_format_input)
+        raw_data_layout.addWidget(self.raw_data_float32_checkbox)
+        raw_data_layout.addStretch(1)
+
+        layout.addLayout(raw_data_layout)
         layout.addSpacing(5)
 
         #Plot integrations flag
-        self.plot_integrations_checkbox = QCheckBox('Plot peak integrations to external files for validation? (WARNING! TAKES A WHILE!)')
+        self.plot_integrations_checkbox = QCheckBox('Plot peak integrations to external files for validation? (rendered in the background, the analysis waits for the last plots)')
 
         layout.addWidget(self.plot_integrations_checkbox)
         layout.addSpacing(5)
 
+        #Experiment store flag
+        self.experiment_store_checkbox = QCheckBox('Pack mzML files into a single experiment store? (faster re-analysis, can replace the mzML files as an archive)')
+        self.experiment_store_checkbox.setToolTip('Every scan of every mzML file is written to mzml_directory/experiment.spectra, which is memory-mapped by the integration and raw data export. The store is only rebuilt when the mzML files change.')
+
+        layout.addWidget(self.experiment_store_checkbox)
+        layout.addSpacing(5)
+
         #Adjacent averaging input
         smoothing_layout = QHBoxLayout()
 
@@ -219,10 +415,41 @@ class QTRAP5500_UVPD_processing(QWidget):
         layout.addLayout(smoothing_layout)
         layout.addSpacing(5)
 
+        #Quality control - what to do with wavelengths whose parent ion integration is too low
+        qc_layout = QHBoxLayout()
+
+        qc_action_label = QLabel('Low parent integration:')
+        self.qc_action_input = QComboBox()
+        self.qc_action_input.addItem('Continue and flag', 'flag')
+        self.qc_action_input.addItem('Ask once', 'ask')
+        self.qc_action_input.addItem('Skip wavelength', 'skip')
+        self.qc_action_input.addItem('Abort', 'abort')
+        self.qc_action_input.setToolTip('Every wavelength is checked once all files have been integrated. Wavelengths whose parent ion integration is below the minimum are flagged (kept),\n'
+                                        'skipped (left out of the results) or abort the analysis. Ask once asks whether to continue after listing all of them, which aborts unattended runs.\n'
+                                        'Flagged and skipped wavelengths are listed in the QC sheet of the output.')
+
+        min_parent_label = QLabel('Minimum:')
+        self.min_parent_integral_input = QDoubleSpinBox()
+        self.min_parent_integral_input.setDecimals(0)
+        self.min_parent_integral_input.setRange(0, 1e12)
+        self.min_parent_integral_input.setSingleStep(10000)
+        self.min_parent_integral_input.setValue(MIN_PARENT_INTEGRAL)
+        self.min_parent_integral_input.setMinimumWidth(100)
+
+        qc_layout.addWidget(qc_action_label)
+        qc_layout.addWidget(self.qc_action_input)
+        qc_layout.addSpacing(5)
+        qc_layout.addWidget(min_parent_label)
+        qc_layout.addWidget(self.min_parent_integral_input)
+        qc_layout.addStretch(1)
+
+        layout.addLayout(qc_layout)
+        layout.addSpacing(5)
+
         #Fragment Ion Text file
         output_layout = QHBoxLayout()
         
-        out_file_label = QLabel('Output .xlsx basename:')
+        out_file_label = QLabel('Output basename:')
         self.out_file_input = QLineEdit()
         self.out_file_input.setPlaceholderText('file basname only. No need for directory or file extension.')
 
@@ -232,13 +459,60 @@ class QTRAP5500_UVPD_processing(QWidget):
         layout.addLayout(output_layout)
         layout.addSpacing(5)  
 
-        #Run Button
-        run_button = QPushButton('Run')
-        run_button.clicked.connect(self.run_UVPD_QTRAP5500)
+        #Output formats - every checked format is written from the same results
+        output_formats_layout = QHBoxLayout()
 
-        layout.addWidget(run_button)
+        output_formats_label = QLabel('Output formats:')
+        output_formats_layout.addWidget(output_formats_label)
+
+        self.output_format_checkboxes = {}
+        for result_format, text, tooltip in [('excel', 'Excel (with charts)', 'One workbook with the Original, Smoothed, Normalization and QC sheets, and charts of the total PE.'),
+                                             ('csv', 'CSV', 'One .csv file per table: <basename>_Original.csv, _Smoothed.csv, _Normalization.csv and _QC.csv.'),
+                                             ('parquet', 'Parquet', 'One .parquet file per table, for fast loading in scripts (pandas.read_parquet). Requires pyarrow.'),
+                                             ('npz', 'NumPy (.npz)', 'One archive with a structured array per table (numpy.load).'),
+                                             ('json', 'JSON metadata', 'The settings of the analysis, the wavelengths and the names of the other output files.')]:
+            checkbox = QCheckBox(text)
+            checkbox.setToolTip(tooltip)
+            checkbox.setChecked(result_format == 'excel')
+            self.output_format_checkboxes[result_format] = checkbox
+            output_formats_layout.addWidget(checkbox)
+        output_formats_layout.addStretch(1)
+
+        layout.addLayout(output_formats_layout)
+        layout.addSpacing(5)
+
+        #Run and cancel buttons
+        run_layout = QHBoxLayout()
+
+        self.run_button = QPushButton('Run')
+        self.run_button.clicked.connect(lambda: self.run_UVPD_QTRAP5500())
+
+        self.sweep_button = QPushButton('Run sweep')
+        self.sweep_button.setToolTip('Computes the total PE for every combination of the parameter sweep values and writes them to <output basename>_peak_sweep.csv. Spectra are decoded and interpolated only once.')
+        self.sweep_button.clicked.connect(self.run_peak_sweep_QTRAP5500)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_UVPD_QTRAP5500)
+        self.cancel_button.setEnabled(False)
+
+        run_layout.addWidget(self.run_button)
+        run_layout.addWidget(self.sweep_button)
+        run_layout.addWidget(self.cancel_button)
+
+        layout.addLayout(run_layout)
+        layout.addSpacing(5)
+
+        #Progress of the current run: files completed, stage, throughput and estimated time remaining
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+        self.progress_label = QLabel('Idle')
+
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.progress_label)
         layout.addStretch(1)
 
+        self.worker = None
+
         layout.setContentsMargins(30, 30, 30, 30) 
         self.setLayout(layout)
 
@@ -254,6 +528,13 @@ class QTRAP5500_UVPD_processing(QWidget):
         self.power_data_file_input.setEnabled(enabled)
         self.power_file_button.setEnabled(enabled)
 
+    def toggle_raw_data_format(self, state):
+        #Toggle the raw data format inputs depending on whether the Print Raw Data box is checked
+        enabled = state == 2  #Qt.CheckState.Checked == 2
+        self.raw_data_format_label.setEnabled(enabled)
+        self.raw_data_format_input.setEnabled(enabled)
+        self.raw_data_float32_checkbox.setEnabled(enabled)
+
     def browse_power_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, 'Select .csv file', '', 'CSV Files (*.csv)')
 
@@ -268,7 +549,29 @@ class QTRAP5500_UVPD_processing(QWidget):
         if file_path:
             self.fragment_file_input.setText(file_path)
 
-    def run_UVPD_QTRAP5500(self):
+    def peak_sweep_values(self):
+        #gather the values of each peak finder parameter to sweep over. Blank fields sweep over the single value set in the peak finder parameters. Returns None if a field can't be read.
+        single_values = {'height': self.height_input.value(), 'threshold': self.threshold_input.value(), 'prominence': self.prominence_input.value(), 'width': self.width_input.value()}
+        sweep_values = {}
+
+        for parameter in SWEEP_PARAMETERS:
+            text = self.sweep_inputs[parameter].text()
+            if text.strip():
+                sweep_values[parameter] = parse_sweep_values(text, parameter)
+                if not sweep_values[parameter]:
+                    return None
+            else:
+                sweep_values[parameter] = [single_values[parameter]]
+
+        return sweep_values
+
+    def run_peak_sweep_QTRAP5500(self):
+        sweep_values = self.peak_sweep_values()
+        if sweep_values is not None:
+            self.run_UVPD_QTRAP5500(sweep_values)
+
+    def UVPD_settings(self, sweep_values=None):
+        '''The keyword arguments of process_UVPD_5500 set in this tab (also used to add jobs to the batch queue)'''
         
         #assign GUI inputs to variables
         directory = self.dir_path_input.text()
@@ -279,6 +582,10 @@ class QTRAP5500_UVPD_processing(QWidget):
         PowerNorm_flag = self.power_norm_checkbox.isChecked()        #Checkbox for normalizing photofragmentation efficiency to laser power
         extract_raw_data_flag = self.print_raw_data_checkbox.isChecked()     #Checkbox for printing the mass spectra used to calculate photofragmentation efficiency     
         plot_flag = self.plot_integrations_checkbox.isChecked() #Chekcbox for plotting integrations of mass spectra ot external files
+        experiment_store_flag = self.experiment_store_checkbox.isChecked() #Checkbox for packing the mzml files into a memory-mapped experiment store
+        raw_data_format = self.raw_data_format_input.currentData()
+        raw_data_float32 = self.raw_data_float32_checkbox.isChecked()
+        output_formats = [result_format for result_format, checkbox in self.output_format_checkboxes.items() if checkbox.isChecked()]
         out_basename = self.out_file_input.text()
 
         #peak fit parameters
@@ -290,14 +597,578 @@ class QTRAP5500_UVPD_processing(QWidget):
         #Adj. averaging smoothing input
         adj_avg_smoothing_size = self.smoothing_input.value()
 
+        #Integration mode
+        integration_mode = self.integration_mode_input.currentData()
+        window_margin = self.window_margin_input.value() or None #0 (Off) searches the whole spectrum
+        n_workers = self.n_workers_input.value()
+        n_converters = self.n_converters_input.value()
+
+        #msconvert options
+        mz_window_filter = self.mz_window_filter_checkbox.isChecked()
+        zlib_compression = self.zlib_checkbox.isChecked()
+        intensity_32bit = self.intensity_32bit_checkbox.isChecked()
+
+        #quality control policy
+        qc_action = self.qc_action_input.currentData()
+        min_parent_integral = self.min_parent_integral_input.value()
+
         #if powernorm is checked, assign a variable to the power file. Otherwise, give the variable a None value.
         if PowerNorm_flag:
             power_file = self.power_data_file_input.text()
         else:
             power_file = None
+
+        return {'directory': directory, 'parent_mz': basepeak, 'search_window': search_window, 'frag_list_file': frag_list_file, 'extract_mzml_flag': extract_mzml_flag,
+                'PowerNorm_flag': PowerNorm_flag, 'power_file': power_file, 'extract_raw_data_flag': extract_raw_data_flag, 'plot_flag': plot_flag, 'height': height,
+                'threshold': threshold, 'prominence': prominence, 'width': width, 'adj_avg_smoothing_size': adj_avg_smoothing_size, 'out_basename': out_basename,
+                'integration_mode': integration_mode, 'n_workers': n_workers, 'sweep_values': sweep_values, 'n_converters': n_converters, 'msconvert_path': 'msconvert',
+                'mz_window_filter': mz_window_filter, 'zlib_compression': zlib_compression, 'intensity_32bit': intensity_32bit, 'experiment_store_flag': experiment_store_flag,
+                'qc_action': qc_action, 'min_parent_integral': min_parent_integral, 'raw_data_format': raw_data_format, 'raw_data_float32': raw_data_float32,
+                'output_formats': output_formats, 'window_margin': window_margin}
+
+    def run_UVPD_QTRAP5500(self, sweep_values=None):
+        
+        # Execute the main function, which computes photofragmentation efficiency and writes the data to a file. It runs on a worker thread so that the GUI stays responsive.
+        self.worker = UVPD_5500_worker(self.UVPD_settings(sweep_values), self)
+        self.worker.progress_changed.connect(self.update_progress)
+        self.worker.question_asked.connect(self.answer_question, Qt.ConnectionType.BlockingQueuedConnection)
+        self.worker.finished.connect(self.UVPD_QTRAP5500_finished)
+
+        self.run_button.setEnabled(False)
+        self.sweep_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.progress_label.setText('Starting...')
+
+        self.worker.start()
+
+    def cancel_UVPD_QTRAP5500(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.reporter.cancel()
+            self.cancel_button.setEnabled(False)
+            self.progress_label.setText('Cancelling...')
+            print('Cancelling the analysis. It will stop after the current scan.')
+
+    def stop_worker(self):
+        '''Cancels a running analysis and waits for it to stop (e.g., when the GUI is closed)'''
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.reporter.cancel()
+            self.worker.wait()
+
+    def update_progress(self, files_done, n_files, stage, throughput, eta, unit='files'):
+        self.progress_bar.setMaximum(max(n_files, 1))
+        self.progress_bar.setValue(files_done)
+
+        status = f'{stage}: {files_done}/{n_files} {unit}'
+        if throughput > 0:
+            status += f' | {throughput:.2f} {unit}/s'
+        if eta >= 0 and files_done < n_files:
+            status += f' | ~{int(eta // 60)}:{int(eta % 60):02d} remaining'
+        self.progress_label.setText(status)
+
+    def answer_question(self, title, text, default):
+        default_button = QMessageBox.StandardButton.Yes if default else QMessageBox.StandardButton.No
+        reply = QMessageBox.question(self, title, text, QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No, default_button)
+        self.worker.reply = reply == QMessageBox.StandardButton.Yes
+
+    def UVPD_QTRAP5500_finished(self):
+        self.run_button.setEnabled(True)
+        self.sweep_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.progress_label.setText('Cancelled' if self.worker.reporter.cancelled() else 'Idle')
+
+class integration_inspector_worker(QThread):
+    '''Integrates one target of one mzml file for the integration inspector on a separate thread, so that the GUI stays responsive while the file is read'''
+    inspected = pyqtSignal(object, object) #inspection key, result of inspect_integration
+
+    def __init__(self, key, kwargs, parent=None):
+        super().__init__(parent)
+        self.key = key
+        self.kwargs = kwargs
+
+    def run(self):
+        try:
+            result = inspect_integration(**self.kwargs)
+        
+        except Exception as e:
+            print(f'An unexpected error occured while inspecting the integration:\n{e}\nTraceback: {traceback.format_exc()}')
+            result = False
+
+        self.inspected.emit(self.key, result)
+
+class QTRAP5500_batch_queue(QWidget):
+    '''Queue of UVPD analyses that run unattended, e.g., overnight. Jobs are added from the settings of the UVPD processing tab or from config files (see uvpd.py).'''
+    TABLE_COLUMNS = ['Job', 'Name', 'State', 'Directory', 'Parent m/z', 'Mode', 'Run time (s)', 'Message']
+
+    def __init__(self, text_redirector, UVPD_tab, parent=None):
+        super().__init__(parent)
+        self.text_redirector = text_redirector
+        self.UVPD_tab = UVPD_tab
+        self.queue = None
+        self.worker = None
+        self.initUI()
+
+    def initUI(self):
+        layout = QVBoxLayout(self)
+
+        #queue file - holds the jobs and their state, so that finished jobs survive a crash or closing the GUI
+        queue_file_layout = QHBoxLayout()
+        queue_file_label = QLabel('Queue file:')
+        self.queue_file_input = QLineEdit(os.path.join(os.path.expanduser('~'), 'SpectroGUI_batch_queue.json'))
+        self.queue_file_input.setToolTip('The jobs of the queue and their state are saved to this .json file after every change. A summary table of the jobs (run times and outcomes)\n'
+                                         'is written next to it (_summary.csv), and the output of each job to the _logs folder.')
+        self.queue_file_button = QPushButton('Browse')
+        self.queue_file_button.clicked.connect(self.browse_queue_file)
+        self.load_button = QPushButton('Load')
+        self.load_button.clicked.connect(self.load_queue)
+
+        queue_file_layout.addWidget(queue_file_label)
+        queue_file_layout.addWidget(self.queue_file_input)
+        queue_file_layout.addWidget(self.queue_file_button)
+        queue_file_layout.addWidget(self.load_button)
+        layout.addLayout(queue_file_layout)
+
+        #jobs in the queue
+        self.job_table = QTableWidget(0, len(self.TABLE_COLUMNS))
+        self.job_table.setHorizontalHeaderLabels(self.TABLE_COLUMNS)
+        self.job_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.job_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.job_table.verticalHeader().setVisible(False)
+        layout.addWidget(self.job_table)
+
+        #adding and removing jobs
+        job_layout = QHBoxLayout()
+        self.add_analysis_button = QPushButton('Add UVPD analysis')
+        self.add_analysis_button.setToolTip('Adds a job with the current settings of the UVPD processing tab.')
+        self.add_analysis_button.clicked.connect(lambda: self.add_current_settings(sweep=False))
+        self.add_sweep_button = QPushButton('Add peak sweep')
+        self.add_sweep_button.setToolTip('Adds a peak finder parameter sweep with the current settings of the UVPD processing tab.')
+        self.add_sweep_button.clicked.connect(lambda: self.add_current_settings(sweep=True))
+        self.add_config_button = QPushButton('Add config files')
+        self.add_config_button.setToolTip('Adds a job for each .toml config file (see "python -m uvpd template").')
+        self.add_config_button.clicked.connect(self.add_config_files)
+        self.remove_button = QPushButton('Remove selected')
+        self.remove_button.clicked.connect(self.remove_selected)
+        self.requeue_button = QPushButton('Requeue selected')
+        self.requeue_button.setToolTip('Queues the selected jobs that have finished, failed or been cancelled again.')
+        self.requeue_button.clicked.connect(self.requeue_selected)
+
+        job_layout.addWidget(self.add_analysis_button)
+        job_layout.addWidget(self.add_sweep_button)
+        job_layout.addWidget(self.add_config_button)
+        job_layout.addWidget(self.remove_button)
+        job_layout.addWidget(self.requeue_button)
+        layout.addLayout(job_layout)
+
+        #how the queue runs
+        options_layout = QHBoxLayout()
+        max_parallel_label = QLabel('Jobs at a time:')
+        self.max_parallel_input = QSpinBox()
+        self.max_parallel_input.setRange(1, max(os.cpu_count() or 1, 1))
+        self.max_parallel_input.setValue(1)
+        self.max_parallel_input.setToolTip('Number of jobs that run at the same time. Each job also uses the worker processes set in its own settings.')
+        answer_label = QLabel('Answer to questions:')
+        self.answer_input = QComboBox()
+        self.answer_input.addItem('Default', 'ask')
+        self.answer_input.addItem('Yes', 'yes')
+        self.answer_input.addItem('No', 'no')
+        self.answer_input.setToolTip('Jobs run unattended: this is how the jobs added from the UVPD processing tab answer the yes/no questions asked during the analysis\n'
+                                     '(e.g., whether to overwrite existing mzML files). Default uses the default answer of each question.')
+
+        options_layout.addWidget(max_parallel_label)
+        options_layout.addWidget(self.max_parallel_input)
+        options_layout.addSpacing(20)
+        options_layout.addWidget(answer_label)
+        options_layout.addWidget(self.answer_input)
+        options_layout.addStretch(1)
+        layout.addLayout(options_layout)
+
+        run_layout = QHBoxLayout()
+        self.run_button = QPushButton('Run queue')
+        self.run_button.clicked.connect(self.run_queue)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_queue)
+        self.cancel_button.setEnabled(False)
+        run_layout.addWidget(self.run_button)
+        run_layout.addWidget(self.cancel_button)
+        layout.addLayout(run_layout)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+        self.progress_label = QLabel('Idle')
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.progress_label)
+
+        #the job table is refreshed while the queue runs, as the jobs change state in the background
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(1000)
+        self.refresh_timer.timeout.connect(self.refresh_table)
+
+        layout.setContentsMargins(30, 30, 30, 30) 
+        self.setLayout(layout)
+
+    def browse_queue_file(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, 'Select queue file', self.queue_file_input.text(), 'JSON Files (*.json)', options=QFileDialog.Option.DontConfirmOverwrite)
+        if file_path:
+            self.queue_file_input.setText(file_path)
+            self.load_queue()
+
+    def load_queue(self):
+        '''Opens the queue file (created when the first job is added). Returns the queue, or None if it can't be read.'''
+        path = self.queue_file_input.text()
+        if self.queue is None or self.queue.path != os.path.abspath(path):
+            try:
+                self.queue = BatchQueue(path)
+            except (OSError, ValueError) as e:
+                print(f'The batch queue {path} could not be read: {e}')
+                self.queue = None
+                return None
+
+            print(f'Loaded the batch queue {self.queue.path} ({len(self.queue.jobs)} jobs).')
+
+        self.refresh_table()
+        return self.queue
+
+    def refresh_table(self):
+        summary = self.queue.summary() if self.queue is not None else None
+        self.job_table.setRowCount(0 if summary is None else len(summary))
+        if summary is None:
+            return
+
+        for row, job in enumerate(summary[self.TABLE_COLUMNS].itertuples(index=False)):
+            for column, value in enumerate(job):
+                self.job_table.setItem(row, column, QTableWidgetItem('' if value is None or value != value else str(value))) #value != value: NaN
+        self.job_table.resizeColumnsToContents()
+
+    def selected_job_ids(self):
+        rows = sorted({index.row() for index in self.job_table.selectedIndexes()})
+        return [int(self.job_table.item(row, 0).text()) for row in rows]
+
+    def add_job(self, spec, name=None, answer='ask'):
+        if self.load_queue() is None:
+            return
+        if self.queue.add(spec, name, answer) is None:
+            print(f'{name or spec["directory"]} is already in the batch queue. Select it and click Requeue selected to run it again.')
+        self.refresh_table()
+
+    def add_current_settings(self, sweep):
+        sweep_values = None
+        if sweep:
+            sweep_values = self.UVPD_tab.peak_sweep_values()
+            if sweep_values is None:
+                return
+        self.add_job(self.UVPD_tab.UVPD_settings(sweep_values), answer=self.answer_input.currentData())
+
+    def add_config_files(self):
+        file_paths, _ = QFileDialog.getOpenFileNames(self, 'Select config files', '', 'Config Files (*.toml)')
+        for file_path in file_paths:
+            kwargs = load_config(file_path)
+            if kwargs is not None:
+                answer = kwargs.pop('answer')
+                self.add_job(kwargs, os.path.splitext(os.path.basename(file_path))[0], answer)
+
+    def remove_selected(self):
+        for job_id in self.selected_job_ids():
+            if not self.queue.remove(job_id):
+                print(f'Job {job_id} is running and can\'t be removed.')
+        self.refresh_table()
+
+    def requeue_selected(self):
+        for job_id in self.selected_job_ids():
+            self.queue.requeue(job_id)
+        self.refresh_table()
+
+    def run_queue(self):
+        if self.load_queue() is None:
+            return
+
+        self.worker = batch_queue_worker(self.queue, self.max_parallel_input.value(), self)
+        self.worker.progress_changed.connect(self.update_progress)
+        self.worker.finished.connect(self.batch_queue_finished)
+
+        #the queue file can't change while it runs; jobs can still be added to it
+        for widget in (self.run_button, self.queue_file_input, self.queue_file_button, self.load_button, self.max_parallel_input):
+            widget.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.progress_label.setText('Starting...')
+
+        self.refresh_timer.start()
+        self.worker.start()
+
+    def cancel_queue(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.reporter.cancel()
+            self.cancel_button.setEnabled(False)
+            self.progress_label.setText('Cancelling...')
+
+    def stop_worker(self):
+        '''Cancels a running queue and waits for its jobs to stop (e.g., when the GUI is closed). The cancelled jobs can be requeued later.'''
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.reporter.cancel()
+            self.worker.wait()
+
+    def update_progress(self, jobs_done, n_jobs, stage, throughput, eta, unit='jobs'):
+        self.progress_bar.setMaximum(max(n_jobs, 1))
+        self.progress_bar.setValue(jobs_done)
+
+        status = f'{stage}: {jobs_done}/{n_jobs} jobs'
+        if eta >= 0 and jobs_done < n_jobs:
+            status += f' | ~{int(eta // 3600)}:{int(eta % 3600 // 60):02d} h remaining'
+        self.progress_label.setText(status)
+
+    def batch_queue_finished(self):
+        self.refresh_timer.stop()
+        self.refresh_table()
+        for widget in (self.run_button, self.queue_file_input, self.queue_file_button, self.load_button, self.max_parallel_input):
+            widget.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.progress_label.setText('Cancelled' if self.worker.reporter.cancelled() else 'Idle')
+
+class QTRAP5500_integration_inspector(QWidget):
+    '''
+    Shows the integration of one target at one wavelength, with the settings of the UVPD processing tab, instead of writing a plot file for every integration.
+    The integration is computed when a wavelength and a target are picked (from the spectrum cache or the experiment store, so only the first look at a file decodes it),
+    and the last INSPECTOR_CACHE_SIZE inspections are kept, so going back and forth between wavelengths is instant. Nothing is written to disk unless the plot is exported.
+    '''
+    INSPECTOR_CACHE_SIZE = 64
+
+    def __init__(self, text_redirector, UVPD_tab, parent=None):
+        super().__init__(parent)
+        self.text_redirector = text_redirector
+        self.UVPD_tab = UVPD_tab
+        self.mzml_directory = None
+        self.store_file = None
+        self.worker = None
+        self.canvas = None
+        self.renderer = None
+        self.export_renderer = None
+        self.current_plot = None
+        self.inspecting = False
+        self.inspections = OrderedDict() #inspection key -> result of inspect_integration
+        self.initUI()
+
+    def initUI(self):
+        layout = QVBoxLayout(self)
+
+        #files and targets of the analysis set in the UVPD processing tab
+        selection_layout = QHBoxLayout()
+        self.load_button = QPushButton('Load files')
+        self.load_button.setToolTip('Lists the mzML files in the directory of the UVPD processing tab, and the parent and fragment ions of its fragment file.')
+        self.load_button.clicked.connect(self.load_files)
+        wavelength_label = QLabel('Wavelength:')
+        self.wavelength_input = QComboBox()
+        self.wavelength_input.setMinimumWidth(100)
+        self.previous_button = QPushButton('<')
+        self.previous_button.setToolTip('Previous wavelength')
+        self.previous_button.clicked.connect(lambda: self.step_wavelength(-1))
+        self.next_button = QPushButton('>')
+        self.next_button.setToolTip('Next wavelength')
+        self.next_button.clicked.connect(lambda: self.step_wavelength(1))
+        target_label = QLabel('Target:')
+        self.target_input = QComboBox()
+        self.target_input.setMinimumWidth(150)
+        self.refresh_button = QPushButton('Refresh')
+        self.refresh_button.setToolTip('Integrates again with the current peak finder settings of the UVPD processing tab.')
+        self.refresh_button.clicked.connect(self.inspect)
+
+        selection_layout.addWidget(self.load_button)
+        selection_layout.addSpacing(10)
+        selection_layout.addWidget(wavelength_label)
+        selection_layout.addWidget(self.previous_button)
+        selection_layout.addWidget(self.wavelength_input)
+        selection_layout.addWidget(self.next_button)
+        selection_layout.addSpacing(10)
+        selection_layout.addWidget(target_label)
+        selection_layout.addWidget(self.target_input)
+        selection_layout.addWidget(self.refresh_button)
+        selection_layout.addStretch(1)
+        layout.addLayout(selection_layout)
+
+        #the plot canvas is made by the first inspection, so that matplotlib is only imported when it is used
+        self.plot_layout = QVBoxLayout()
+        self.placeholder_label = QLabel('Load the files of the analysis, then pick a wavelength and a target.')
+        self.placeholder_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.placeholder_label.setMinimumHeight(300)
+        self.plot_layout.addWidget(self.placeholder_label)
+        layout.addLayout(self.plot_layout, 1)
+
+        result_layout = QHBoxLayout()
+        self.result_label = QLabel('')
+        self.export_button = QPushButton('Export PNG')
+        self.export_button.setToolTip('Saves the plot as it would be written by "Plot peak integrations".')
+        self.export_button.clicked.connect(self.export_plot)
+        self.export_button.setEnabled(False)
+        result_layout.addWidget(self.result_label)
+        result_layout.addStretch(1)
+        result_layout.addWidget(self.export_button)
+        layout.addLayout(result_layout)
+
+        self.wavelength_input.currentIndexChanged.connect(self.inspect)
+        self.target_input.currentIndexChanged.connect(self.inspect)
+
+        layout.setContentsMargins(30, 30, 30, 30) 
+        self.setLayout(layout)
+
+    def load_files(self):
+        '''Lists the wavelengths (mzML files) and targets of the analysis set in the UVPD processing tab'''
+        settings = self.UVPD_tab.UVPD_settings()
+        mzml_directory = os.path.join(settings['directory'], 'mzml_directory')
+        if not os.path.isdir(mzml_directory):
+            print(f'{mzml_directory} does not exist. Please extract the mzML files first.')
+            return
+
+        fragment_list = read_fragment_file(settings['frag_list_file']) if os.path.isfile(settings['frag_list_file']) else None
+        if fragment_list is None:
+            print('Please select a valid fragment file in the UVPD processing tab.')
+            return
+
+        #the mzml files, or the files of the experiment store if they have been deleted. The store is only used if it is current.
+        mzml_files = [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
+        store = open_experiment_store(mzml_directory, mzml_files if mzml_files else None)
+        if not mzml_files and store is not None:
+            mzml_files = list(store.mzml_files)
+        if not mzml_files:
+            print(f'No .mzML files were found in {mzml_directory}.')
+            return
+
+        wavelengths = {}
+        for mzml_file in mzml_files:
+            match = re.search(r'Laser.*?(\d+)', mzml_file)
+            if match:
+                wavelengths[mzml_file] = float(match.group(1))
+            else:
+                print(f'The wavelength could not be found in {mzml_file}. Does the filename contain the text: "Laser"? It has been left out of the inspector.')
+
+        self.mzml_directory = mzml_directory
+        self.store_file = store.path if store is not None else None
+        self.inspections.clear()
+
+        #fill the lists without inspecting every entry on the way
+        for widget in (self.wavelength_input, self.target_input):
+            widget.blockSignals(True)
+            widget.clear()
+
+        for mzml_file in sorted(wavelengths, key=wavelengths.get):
+            self.wavelength_input.addItem(f'{wavelengths[mzml_file]:g} nm', mzml_file)
+
+        frags, frag_bckgds = fragment_list
+        self.target_input.addItem(f'Parent m/z {settings["parent_mz"]}', (settings['parent_mz'], 0.0))
+        for frag_mz, frag_bckgd in zip(frags, frag_bckgds):
+            self.target_input.addItem(f'Fragment m/z {frag_mz}', (frag_mz, frag_bckgd))
+
+        for widget in (self.wavelength_input, self.target_input):
+            widget.blockSignals(False)
+
+        print(f'Loaded {self.wavelength_input.count()} wavelengths and {self.target_input.count()} targets into the integration inspector.')
+        self.inspect()
+
+    def step_wavelength(self, step):
+        index = self.wavelength_input.currentIndex() + step
+        if 0 <= index < self.wavelength_input.count():
+            self.wavelength_input.setCurrentIndex(index)
+
+    def current_request(self):
+        '''The key and the keyword arguments of inspect_integration of the picked wavelength and target, with the current settings of the UVPD processing tab'''
+        settings = self.UVPD_tab.UVPD_settings()
+        target_mz, background = self.target_input.currentData()
+        kwargs = {'directory': self.mzml_directory, 'mzml_file': self.wavelength_input.currentData(), 'target_mz': target_mz, 'search_window': settings['search_window'],
+                  'parent_mz': settings['parent_mz'], 'background': background, 'height': settings['height'], 'threshold': settings['threshold'],
+                  'prominence': settings['prominence'], 'width': settings['width'], 'mode': settings['integration_mode'], 'store_file': self.store_file,
+                  'window_margin': settings['window_margin']}
+        return tuple(kwargs.values()), kwargs
+
+    def inspect(self):
+        '''Shows the picked integration, integrating it first on a worker thread unless it has been inspected before'''
+        if self.mzml_directory is None or self.wavelength_input.currentIndex() < 0 or self.target_input.currentIndex() < 0:
+            return
+
+        key, kwargs = self.current_request()
+        if key in self.inspections:
+            self.inspections.move_to_end(key)
+            self.show_inspection(key)
+            return
+
+        #one integration at a time. The latest pick is inspected once the running one is done.
+        if self.inspecting:
+            return
+
+        self.result_label.setText(f'Integrating {self.target_input.currentText()} at {self.wavelength_input.currentText()}...')
+        self.inspecting = True
+        self.worker = integration_inspector_worker(key, kwargs, self)
+        self.worker.inspected.connect(self.inspection_finished)
+        self.worker.start()
+
+    def inspection_finished(self, key, result):
+        self.inspecting = False
+        self.inspections[key] = result
+        while len(self.inspections) > self.INSPECTOR_CACHE_SIZE:
+            self.inspections.popitem(last=False)
+
+        #the pick may have changed while the integration was running
+        if key == self.current_request()[0]:
+            self.show_inspection(key)
+        else:
+            self.inspect()
+
+    def show_inspection(self, key):
+        result = self.inspections[key]
+        plot = None
+        if result is False:
+            self.result_label.setText('The integration failed, see the status window.')
+        else:
+            (integration, stdev), plot = result
+            self.result_label.setText(f'Average integration: {integration:.6g} +/- {stdev:.4g}' + ('' if plot is not None else ' (no scan has a valid peak)'))
+
+        self.current_plot = plot
+        self.export_button.setEnabled(plot is not None)
+        if plot is None:
+            if self.canvas is not None:
+                self.canvas.setVisible(False)
+            self.placeholder_label.setText(f'No plot: no scan has a valid peak for {self.target_input.currentText()} at {self.wavelength_input.currentText()}.')
+            self.placeholder_label.setVisible(True)
+            return
+
+        if self.canvas is None:
+            try:
+                from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg #imported here since it is slow to import, and only needed once something is inspected
+                from matplotlib.figure import Figure
+            except ImportError:
+                self.placeholder_label.setText('The integration inspector requires matplotlib. Please install it (pip install matplotlib).')
+                return
+
+            self.canvas = FigureCanvasQTAgg(Figure(figsize=(10, 5)))
+            self.renderer = IntegrationPlotRenderer(self.canvas.figure)
+            self.plot_layout.addWidget(self.canvas)
+
+        self.renderer.draw(plot)
+        self.placeholder_label.setVisible(False)
+        self.canvas.setVisible(True)
+        self.canvas.draw_idle()
+
+    def export_plot(self):
+        '''Saves the shown plot to a .png file, drawn at the size of the plot files of the analysis'''
+        if self.current_plot is None:
+            return
+
+        default_path = os.path.join(os.path.dirname(self.mzml_directory), os.path.basename(plot_file(self.mzml_directory, self.current_plot)))
+        file_path, _ = QFileDialog.getSaveFileName(self, 'Export plot', default_path, 'PNG Files (*.png)')
+        if not file_path:
+            return
+
+        try:
+            if self.export_renderer is None:
+                self.export_renderer = IntegrationPlotRenderer()
+            self.export_renderer.render(self.current_plot, file_path)
+            print(f'Integration plot written to {file_path}.')
         
-        # Execute the main function, which computes photofragmentation efficiency and writes the data to a file
-        process_UVPD_5500(self, directory, basepeak, search_window, frag_list_file, extract_mzml_flag, PowerNorm_flag, power_file, extract_raw_data_flag, plot_flag, height, threshold, prominence, width, adj_avg_smoothing_size, out_basename)
+        except Exception as e:
+            print(f'The plot could not be written to {file_path}: {e}')
+
+    def stop_worker(self):
+        '''Waits for a running integration to finish (e.g., when the GUI is closed). It only reads one file, so this is short.'''
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.wait()
 
 #placeholder tab currently
 class QTRAP5500_IRMPD_processing(QWidget):
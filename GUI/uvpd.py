@@ -0,0 +1,236 @@
+'''
+Headless entry point for the QTRAP 5500 UVPD analysis. Runs the same pipeline as the QTRAP 5500 tab without importing Qt, e.g., on a processing node or from a script.
+Usage (from the GUI directory):
+    python -m uvpd template > config.toml      writes an example config file
+    python -m uvpd run config.toml             runs the analysis described by the config file
+    python -m uvpd batch queue.json a.toml b.toml --parallel 2
+                                               adds the analyses described by the config files to a batch queue and runs every queued job, two at a time.
+                                               Run the same command again after a crash to finish the jobs that didn't complete.
+Relative paths in the config file are relative to the folder that contains it. Press Ctrl+C once to cancel at the next opportunity, twice to stop immediately.
+'''
+import argparse, contextlib, os, signal, sys, tomllib
+
+from SCIEX.batch_UVPD_5500 import BatchQueue, run_batch_queue
+from SCIEX.process_UVPD_5500 import process_UVPD_5500
+from workflows.integrate_mzml import INTEGRATION_MODES
+from workflows.peak_param_sweep import SWEEP_PARAMETERS
+from workflows.qc import QC_ACTIONS
+from workflows.RawData_from_mzml import RAW_DATA_FORMATS
+from workflows.result_writers import RESULT_FORMATS
+from workflows.reporting import TerminalReporter
+
+#Every option of the config file, with the same defaults as the QTRAP 5500 tab. Options that are left out take these values.
+CONFIG_TEMPLATE = '''\
+# SpectroGUI - QTRAP 5500 UVPD analysis
+directory = "."                 # folder with the .wiff files, or with mzml_directory
+parent_mz = 203.01
+search_window = 0.25            # m/z
+fragment_file = "frags.csv"     # fragment m/z, background
+power_file = "power.csv"        # wavelength (nm), laser power, stdev. Remove this line to skip the power normalization.
+extract_mzml = false            # convert the .wiff files to mzML first
+raw_data = false                # write the averaged mass spectrum of every wavelength to Raw_data.csv
+raw_data_format = "csv"         # csv, npy, parquet or feather (the last two require pyarrow)
+raw_data_float32 = false        # write the raw data intensities as 32-bit floats
+plot = false                    # plot every peak integration to mzml_directory/integration_plots
+smoothing = 3                   # adjacent averaging points for the smoothed data
+out_basename = "photofrag_eff"
+output_formats = ["excel"]      # any of excel (workbook with charts), csv, parquet (requires pyarrow), npz and json (settings and files written)
+answer = "ask"                  # answer to the yes/no questions asked during the analysis: "ask" (prompt on the terminal, No when unattended), "yes" or "no"
+
+[peak_finder]                   # scipy find_peaks parameters
+height = 2000.0
+threshold = 2000.0
+prominence = 200.0
+width = 5.0
+
+[integration]
+mode = "full"                   # full, windowed, batched, native or averaged
+window_margin = 0.0             # search the peak bases only this many m/z on each side of the peak, in every mode; 0 searches the whole spectrum
+n_workers = 1                   # worker processes
+experiment_store = false        # pack the mzML files into mzml_directory/experiment.spectra
+
+[qc]                            # quality control of every wavelength, once all files have been integrated
+action = "flag"                 # wavelengths that fail: "flag" (keep them, listed in the QC output), "ask" (once; aborts when unattended unless answer = "yes"), "skip" or "abort"
+min_parent_integral = 100000.0
+
+[conversion]                    # only used with extract_mzml = true
+n_converters = 1                # concurrent msconvert processes
+msconvert_path = "msconvert"
+mz_window_filter = true         # only keep m/z 0 to parent m/z + 50
+zlib = true
+intensity_32bit = false
+
+# Uncomment to sweep the peak finder parameters instead of running the analysis. Parameters that are left out are held at their [peak_finder] value.
+# [sweep]
+# height = [1000.0, 2000.0, 5000.0]
+# prominence = [100.0, 200.0]
+'''
+
+def _defaults():
+    return tomllib.loads(CONFIG_TEMPLATE)
+
+def load_config(config_file):
+    '''
+    Reads a config file and returns the keyword arguments of process_UVPD_5500 (plus 'answer'). Options that are missing take the defaults of CONFIG_TEMPLATE.
+    Returns None and prints the problem if the file can't be read or contains an unknown option.
+    '''
+    try:
+        with open(config_file, 'rb') as opf:
+            config = tomllib.load(opf)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        print(f'The config file {config_file} could not be read: {e}')
+        return None
+
+    defaults = _defaults()
+    sections = {name: value for name, value in defaults.items() if isinstance(value, dict)}
+
+    #reject typos rather than silently running with a default
+    for name, value in config.items():
+        if name == 'sweep':
+            unknown = [key for key in value if key not in SWEEP_PARAMETERS]
+        elif name in sections:
+            unknown = [key for key in value if key not in sections[name]]
+        elif name in defaults:
+            continue
+        else:
+            unknown = [name]
+
+        if unknown:
+            print(f'Unknown option(s) in {os.path.basename(config_file)}: {", ".join(unknown)}. Run "python -m uvpd template" to see every option.')
+            return None
+
+    settings = {name: config.get(name, value) for name, value in defaults.items() if name not in sections}
+    for name, section in sections.items():
+        settings.update({f'{name}.{key}': config.get(name, {}).get(key, value) for key, value in section.items()})
+
+    if settings['answer'] not in ('ask', 'yes', 'no'):
+        print(f'answer must be "ask", "yes" or "no", not "{settings["answer"]}".')
+        return None
+
+    if settings['integration.mode'] not in INTEGRATION_MODES:
+        print(f'Unknown integration mode "{settings["integration.mode"]}". Please choose one of: {", ".join(INTEGRATION_MODES)}.')
+        return None
+
+    if settings['integration.window_margin'] < 0:
+        print(f'The integration window_margin can\'t be negative ({settings["integration.window_margin"]}). Use 0 to search the whole spectrum for the peak bases.')
+        return None
+
+    if settings['qc.action'] not in QC_ACTIONS:
+        print(f'Unknown QC action "{settings["qc.action"]}". Please choose one of: {", ".join(QC_ACTIONS)}.')
+        return None
+
+    if settings['raw_data_format'] not in RAW_DATA_FORMATS:
+        print(f'Unknown raw data format "{settings["raw_data_format"]}". Please choose one of: {", ".join(RAW_DATA_FORMATS)}.')
+        return None
+
+    unknown_formats = [result_format for result_format in settings['output_formats'] if result_format not in RESULT_FORMATS]
+    if unknown_formats or not settings['output_formats']:
+        print(f'Unknown or no output format(s): {", ".join(unknown_formats)}. Please choose at least one of: {", ".join(RESULT_FORMATS)}.')
+        return None
+
+    #paths are relative to the config file
+    config_directory = os.path.dirname(os.path.abspath(config_file))
+    def resolve(path):
+        return os.path.normpath(os.path.join(config_directory, path))
+
+    power_file = config.get('power_file')
+
+    sweep_values = None
+    if 'sweep' in config:
+        sweep_values = {parameter: sorted(set(float(value) for value in config['sweep'].get(parameter, [settings[f'peak_finder.{parameter}']]))) for parameter in SWEEP_PARAMETERS}
+
+    return {'directory': resolve(settings['directory']), 'parent_mz': settings['parent_mz'], 'search_window': settings['search_window'], 'frag_list_file': resolve(settings['fragment_file']),
+            'extract_mzml_flag': settings['extract_mzml'], 'PowerNorm_flag': power_file is not None, 'power_file': resolve(power_file) if power_file is not None else None,
+            'extract_raw_data_flag': settings['raw_data'], 'plot_flag': settings['plot'], 'height': settings['peak_finder.height'], 'threshold': settings['peak_finder.threshold'],
+            'prominence': settings['peak_finder.prominence'], 'width': settings['peak_finder.width'], 'adj_avg_smoothing_size': settings['smoothing'], 'out_basename': settings['out_basename'],
+            'integration_mode': settings['integration.mode'], 'n_workers': settings['integration.n_workers'], 'sweep_values': sweep_values, 'n_converters': settings['conversion.n_converters'],
+            'msconvert_path': settings['conversion.msconvert_path'], 'mz_window_filter': settings['conversion.mz_window_filter'], 'zlib_compression': settings['conversion.zlib'],
+            'intensity_32bit': settings['conversion.intensity_32bit'], 'experiment_store_flag': settings['integration.experiment_store'],
+            'qc_action': settings['qc.action'], 'min_parent_integral': settings['qc.min_parent_integral'],
+            'raw_data_format': settings['raw_data_format'], 'raw_data_float32': settings['raw_data_float32'],
+            'output_formats': settings['output_formats'], 'window_margin': settings['integration.window_margin'] or None, 'answer': settings['answer']}
+
+@contextlib.contextmanager
+def cancel_on_interrupt(reporter):
+    '''The first Ctrl+C cancels the run the same way the Cancel button does, the second one stops it immediately'''
+    def interrupt(signum, frame):
+        if reporter.cancelled():
+            raise KeyboardInterrupt
+        print('Cancelling... press Ctrl+C again to stop immediately.')
+        reporter.cancel()
+
+    previous_handler = signal.signal(signal.SIGINT, interrupt)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+
+def run(config_file):
+    '''Runs the analysis described by a config file. Returns the exit code: 0 on success, 1 otherwise.'''
+    kwargs = load_config(config_file)
+    if kwargs is None:
+        return 1
+
+    answer = kwargs.pop('answer')
+    reporter = TerminalReporter(answer={'ask': None, 'yes': True, 'no': False}[answer])
+
+    with cancel_on_interrupt(reporter):
+        return 0 if process_UVPD_5500(reporter, **kwargs) else 1
+
+def batch(queue_file, config_files=(), max_parallel=1, retry=False):
+    '''
+    Adds the analyses described by config_files to the batch queue in queue_file (created if needed) and runs every queued job. Jobs that are already in the queue
+    are not added again, so running the same command twice only runs the jobs that haven't finished. retry queues the failed and cancelled jobs again.
+    Returns the exit code: 0 if every job that ran succeeded, 1 otherwise.
+    '''
+    jobs = []
+    for config_file in config_files:
+        kwargs = load_config(config_file)
+        if kwargs is None:
+            return 1
+        jobs.append((os.path.splitext(os.path.basename(config_file))[0], kwargs))
+
+    try:
+        queue = BatchQueue(queue_file)
+    except (OSError, ValueError) as e:
+        print(f'The batch queue {queue_file} could not be read: {e}')
+        return 1
+
+    for name, kwargs in jobs:
+        answer = kwargs.pop('answer')
+        if queue.add(kwargs, name, answer) is None:
+            print(f'{name} is already in the batch queue.')
+
+    if retry:
+        for job in queue.jobs:
+            if job['state'] in ('failed', 'cancelled'):
+                queue.requeue(job['id'])
+
+    reporter = TerminalReporter()
+    with cancel_on_interrupt(reporter):
+        return 0 if run_batch_queue(queue, max_parallel, reporter) else 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m uvpd', description='Headless QTRAP 5500 UVPD analysis.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the analysis described by a config file')
+    run_parser.add_argument('config', help='.toml config file (see "template")')
+    subparsers.add_parser('template', help='print an example config file with every option')
+    batch_parser = subparsers.add_parser('batch', help='add config files to a batch queue and run every queued job')
+    batch_parser.add_argument('queue', help='.json file that holds the queue and the state of its jobs (created if needed)')
+    batch_parser.add_argument('configs', nargs='*', help='.toml config files of the jobs to add')
+    batch_parser.add_argument('--parallel', type=int, default=1, help='number of jobs that run at the same time (default: 1)')
+    batch_parser.add_argument('--retry', action='store_true', help='queue the failed and cancelled jobs again')
+    args = parser.parse_args(argv)
+
+    if args.command == 'template':
+        sys.stdout.write(CONFIG_TEMPLATE)
+        return 0
+
+    if args.command == 'batch':
+        return batch(args.queue, args.configs, args.parallel, args.retry)
+
+    return run(args.config)
+
+if __name__ == '__main__':
+    sys.exit(main())
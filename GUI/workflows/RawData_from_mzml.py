@@ -1,93 +1,226 @@
 import os, re, traceback
 import numpy as np
-import pyteomics.mzml as mzml
 import pandas as pd
-from PyQt6.QtWidgets import QApplication
 
-def extract_RawData(mzml_directory, parent_mz, output_csv_file):
-    '''Extracts the mass spectra from mzml files and averages them across all scans. Interpolation on a common mz grid for all mzml files provided is used. Usage is:
-    directory containing mzml files, m/z of the parent ion (needed for interpolation), and the name of .csv file to output results to.
-    '''
-   
-    #Set up interpolation grid - different from before because we don't want to print the mass spectrum in 0.01 Da increments. 
+from workflows.experiment_store import ExperimentStore
+from workflows.reporting import process_events
+from workflows.results_cache import ResultsCache, raw_spectrum_key
+from workflows.spectrum_cache import load_spectra_arrays
+
+#The raw data export averages every scan of a file on a coarser grid than the integration: 0.05 Da from 0 to parent_mz + 50
+RAW_DATA_STEP = 0.05
+
+def raw_data_grid(parent_mz):
+    '''The m/z grid of the raw data export'''
+    #different from the integration grid because we don't want to print the mass spectrum in 0.01 Da increments.
     min_mz = 0.
     max_mz = parent_mz + 50.  #adding 50 mass units to the parent ion
+    return np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / RAW_DATA_STEP + 1)),2) #0.05 Da incremenets for mz grid
 
-    #Get a list of mzML files in the given directory
-    mzml_files = [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
+def mean_raw_spectrum(grid, mz, intensity, offsets):
+    '''Averages every scan of a file (flat arrays, where scan i spans mz[offsets[i]:offsets[i+1]]) on the raw data grid. Returns None if the file has no scans.'''
+    n_scans = len(offsets) - 1
+    if n_scans == 0:
+        return None
 
-    #dict to store data
-    raw_data = {}
-    
-    #define common mz grid for interpolation and add to dict
-    common_mz_grid = np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / 0.05 + 1)),2) #0.05 Da incremenets for mz grid
-    raw_data['m/z'] = common_mz_grid
+    average_intensity = np.zeros_like(grid)
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        #Interpolate intensity onto the common m/z grid and add it to the sum
+        average_intensity += np.interp(grid, mz[start:stop], intensity[start:stop], left = 0, right = 0)
+
+    return average_intensity / n_scans
+
+#File formats of the raw data export, and the extension of each
+RAW_DATA_FORMATS = {'csv': '.csv', 'npy': '.npy', 'parquet': '.parquet', 'feather': '.feather'}
+CSV_CHUNK_ROWS = 10000
+
+class RawDataWriter:
+    '''
+    Writes the averaged spectrum of each wavelength to the raw data file as soon as it is finished, so that only one spectrum (plus the m/z grid) is held in memory,
+    however many wavelengths there are. The file is written under a temporary name and only renamed to output_file by close(), so a failed export never leaves half a file behind.
+    Formats (RAW_DATA_FORMATS):
+        csv: the wide table of the GUI's raw data export (m/z, then one column per wavelength). A CSV can only be written row by row, so the columns are staged in a
+            memory-mapped temporary .npy file and the CSV is written from it in chunks of CSV_CHUNK_ROWS rows by close().
+        npy: the same wide table as a structured NumPy array with one named field per column, memory-mapped while it is written. Read it with np.load.
+        parquet, feather: a long table with one row per point (columns 'Wavelength (nm)', 'm/z', 'Intensity'). Each wavelength is appended as its own row group (Parquet)
+            or record batch (Feather) when it is written. Requires pyarrow.
+    float32: If True, intensities are written as 32-bit floats (m/z stays 64-bit), which halves the size of the binary formats.
+    '''
+    def __init__(self, output_file, mz_grid, columns, wavelengths, raw_format='csv', float32=False):
+        if raw_format not in RAW_DATA_FORMATS:
+            raise ValueError(f'Unknown raw data format "{raw_format}". Please choose one of: {", ".join(RAW_DATA_FORMATS)}.')
+
+        self.output_file = output_file
+        self.temp_file = f'{output_file}.tmp'
+        self.mz_grid = mz_grid
+        self.columns = list(columns)
+        self.wavelengths = dict(zip(self.columns, wavelengths))
+        self.raw_format = raw_format
+        self.dtype = np.dtype(np.float32 if float32 else float)
+        self._stage = None
+        self._stage_file = None
+        self._writer = None
+
+        if raw_format == 'csv':
+            self._stage_file = f'{output_file}.columns.npy'
+            self._stage = np.lib.format.open_memmap(self._stage_file, mode='w+', dtype=self.dtype, shape=(len(mz_grid), len(self.columns)))
+
+        elif raw_format == 'npy':
+            self._stage = np.lib.format.open_memmap(self.temp_file, mode='w+', dtype=[('m/z', float)] + [(column, self.dtype) for column in self.columns], shape=(len(mz_grid),))
+            self._stage['m/z'] = mz_grid
+
+        else:
+            import pyarrow as pa #imported here since it is only needed for the binary table formats, and it is an optional dependency
+            self._pa = pa
+            self._schema = pa.schema([('Wavelength (nm)', pa.float64()), ('m/z', pa.float64()), ('Intensity', pa.from_numpy_dtype(self.dtype))])
+            if raw_format == 'parquet':
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.temp_file, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.temp_file, self._schema)
+
+    def write(self, column, intensity):
+        '''Writes the averaged spectrum of one wavelength (column)'''
+        intensity = np.asarray(intensity).astype(self.dtype, copy=False)
+
+        if self.raw_format == 'csv':
+            self._stage[:, self.columns.index(column)] = intensity
+        elif self.raw_format == 'npy':
+            self._stage[column] = intensity
+        else:
+            self._writer.write_table(self._pa.table({'Wavelength (nm)': np.full(len(self.mz_grid), self.wavelengths[column], dtype=float), 'm/z': self.mz_grid, 'Intensity': intensity}, schema=self._schema))
+
+    def close(self):
+        '''Finishes the file and moves it to output_file'''
+        if self.raw_format == 'csv':
+            with open(self.temp_file, 'w', newline='') as opf:
+                for start in range(0, len(self.mz_grid), CSV_CHUNK_ROWS):
+                    stop = start + CSV_CHUNK_ROWS
+                    chunk = pd.DataFrame({'m/z': self.mz_grid[start:stop], **{column: self._stage[start:stop, k] for k, column in enumerate(self.columns)}})
+                    chunk.to_csv(opf, index=False, header=start == 0)
+        elif self.raw_format == 'npy':
+            self._stage.flush()
+        else:
+            self._writer.close()
+            self._writer = None
+
+        self._release()
+        os.replace(self.temp_file, self.output_file)
+
+    def abort(self):
+        '''Removes the partly written file'''
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+            self._writer = None
+
+        self._release()
+        if os.path.exists(self.temp_file):
+            os.remove(self.temp_file)
 
+    def _release(self):
+        '''Unmaps the staged columns and deletes the staging file (the maps have to be released before the files can be moved or deleted on Windows)'''
+        self._stage = None
+        if self._stage_file is not None and os.path.exists(self._stage_file):
+            os.remove(self._stage_file)
+
+def extract_RawData(mzml_directory, parent_mz, output_csv_file, store_file=None, raw_format='csv', float32=False):
+    '''Extracts the mass spectra from mzml files and averages them across all scans. Interpolation on a common mz grid for all mzml files provided is used. Usage is:
+    directory containing mzml files, m/z of the parent ion (needed for interpolation), and the name of the file to output results to.
+    The averaged spectrum of a file is normally computed while the file is integrated (see integrate_spectra_multi's raw_spectrum) and read here from the results cache,
+    so only files that weren't integrated with raw_spectrum are decoded and averaged again. Each spectrum is written out as soon as it has been read (see RawDataWriter),
+    so memory use doesn't grow with the number of wavelengths.
+    If an experiment store (see workflows.experiment_store) is given, the spectra of every file in the store are sliced straight out of it instead.
+    raw_format: One of RAW_DATA_FORMATS. float32: If True, intensities are written as 32-bit floats.
+    Returns True once the file has been written, None on error.
+    '''
+    #Get a list of mzML files in the given directory (or in the experiment store)
+    store = ExperimentStore(store_file) if store_file is not None else None
+    mzml_files = store.mzml_files if store is not None else [f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')]
+
+    #get wavelength from each mzml file name - the columns of the output have to be known before the first one is written
+    wl_titles = {} #title to be written to raw data file -> wavelength
+    file_titles = {} #mzml file -> title
     for mzml_file in mzml_files:
-        
-        #get wavelength from mzml file name
         try:
             wavelength = re.findall(r'\d+', mzml_file.split('Laser')[-1])[-1]
-            wl_title = f'{wavelength}nm' #title to be written to raw data file
+            file_titles[mzml_file] = f'{wavelength}nm'
+            wl_titles[f'{wavelength}nm'] = float(wavelength)
 
-        except ValueError as ve:
-            print(f'Could not extract the wavelength from the .mzml file name. This is what the code has found: {wavelength}.\nDoes the filename contain the text: "Laser"?\nAnalysis will be stopped.')
-            QApplication.processEvents()
+        except (ValueError, IndexError):
+            print(f'Could not extract the wavelength from the .mzml file name {mzml_file}.\nDoes the filename contain the text: "Laser"?\nAnalysis will be stopped.')
+            process_events()
             return
 
-        #Initialize dictionary w/ zeroes for each scan
-        average_intensity = np.zeros_like(common_mz_grid)
-        scan_counter = 0
+    #define common mz grid for interpolation
+    common_mz_grid = raw_data_grid(parent_mz)
+    cache_key = raw_spectrum_key(parent_mz, RAW_DATA_STEP)
+    n_computed = 0
 
-        with mzml.read(os.path.join(mzml_directory, mzml_file)) as spectra:  
-            
-            for spectrum in spectra:
-
-                #according to stack exchange, these are pre-defined lists from pyteomics              
-                try:
-                    mz = spectrum['m/z array']
-                    intensity = spectrum['intensity array']
-                    
-                except Exception as e:
-                    print(f'Error encounter when extract m/z and intensity arrays from spectrum number {i+1} in {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}\n')
-                    QApplication.processEvents()
-                    return
+    try:
+        writer = RawDataWriter(output_csv_file, common_mz_grid, wl_titles, wl_titles.values(), raw_format, float32)
+
+    except ImportError:
+        print(f'The {raw_format} raw data format requires pyarrow. Please install it (pip install pyarrow), or choose the csv or npy format.')
+        process_events()
+        return
+
+    except (OSError, ValueError) as e:
+        print(f'The raw data file {output_csv_file} could not be created: {e}')
+        process_events()
+        return
+
+    try:
+        for mzml_file in mzml_files:
+            #the averaged spectrum from the integration pass, or else the decoded m/z and intensity arrays from the experiment store or the spectrum cache
+            try:
+                average_intensity = ResultsCache(mzml_directory, mzml_file, store_file).entries.get(cache_key)
+
+                if average_intensity is not None:
+                    average_intensity = np.array(average_intensity, dtype=float)
+                else:
+                    spectra = store.file_arrays(mzml_file) if store is not None else load_spectra_arrays(os.path.join(mzml_directory, mzml_file))
+                    average_intensity = mean_raw_spectrum(common_mz_grid, *spectra)
+                    n_computed += 1
                 
-                #Check for inconsistent data
-                if len(mz) != len(intensity):
-                    print(f'Inconsistent lengths of m/z and intensity arrays in {os.path.basename(mzml_file)}. Analysis will be stopped.')
-                    QApplication.processEvents()     
-                    return
-
-                #Interpolate intensity onto the common m/z grid and append to list
-                interp_intensity = np.interp(common_mz_grid, mz, intensity, left = 0, right = 0)
+            except Exception as e:
+                print(f'Error encounter when extracting m/z and intensity arrays from {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}\n')
+                process_events()
+                writer.abort()
+                return
+
+            if average_intensity is None:
+                print(f'No mass spectra were found in {mzml_file}! Aborting raw data processing.')
+                process_events()  
+                writer.abort()
+                return
             
-                average_intensity += interp_intensity
-                scan_counter += 1
+            #write the averaged mass spectrum of this wavelength straight to the file
+            writer.write(file_titles[mzml_file], average_intensity)
 
-        if scan_counter > 0:
-            average_intensity /= scan_counter
+        if n_computed:
+            print(f'{n_computed} of {len(mzml_files)} averaged spectra were not computed during the integration and have been computed now.')
+            process_events()
 
-        else:
-            print(f'No mass spectra were found in {mzml_file}! Aborting raw data processing.')
-            QApplication.processEvents()  
-            return
-        
-        #append averaged mass spectra for each wavelength to the dictionary
-        raw_data[wl_title] = average_intensity
-
-    try: 
-        df = pd.DataFrame(raw_data)
-        df.to_csv(output_csv_file, index=False)
+        writer.close()
         print(f'Data succesfully written to {output_csv_file}\n\n')
-        QApplication.processEvents()  
-        return
+        process_events()  
+        return True
     
     except PermissionError:
-        'Close the .csv file with the same name as the one where the raw data is being written and then rerun the code.'
-        QApplication.processEvents()  
+        print(f'Python is trying to write to {output_csv_file}, but it is open. Please close it and then rerun the code.')
+        process_events()  
+        writer.abort()
         return       
 
+    except Exception as e:
+        print(f'An unexpected exception occured when writing the raw data to {output_csv_file}:\n{e}\nTraceback: {traceback.format_exc()}')
+        process_events()
+        writer.abort()
+        return
+
 def PE_calc(W_nm, P, dP, Par, dPar, Frag, dFrag):
     '''Calculates photofragmentation efficiency with normlaization to laser power. Useage is:
     Wavelength, Power, Power stdev, base peak integration, base peak integration stdev, fragment peak integration, fragment peak integration stdev
@@ -96,7 +229,7 @@ def PE_calc(W_nm, P, dP, Par, dPar, Frag, dFrag):
     #Check for division by zero
     if P == 0 or Par == 0:
         print(f'WARNING!!!!!\nDivision by zero error for wavelenth {W}nm. Power (P) is {P}, Parent integration is {Par} and Fragment integration is {Frag}.\n The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()   
+        process_events()   
         return [0, 0]   
    
     #convert wavelength (nm) to eV because we want lower numbers as we increase nm, not the other way around
@@ -142,7 +275,7 @@ def PE_calc(W_nm, P, dP, Par, dPar, Frag, dFrag):
     
     except Exception as e:
         print(f'Error encountered during calculation of photogfragmentaion efficiency at wavelength {W}nm: {e}.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()      
+        process_events()      
         return [0, 0] 
 
 def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag): 
@@ -154,7 +287,7 @@ def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag):
     #Check for division by zero
     if Par == 0:
         print(f'WARNING!!!!!\nDivision by zero error for wavelenth {W}nm. Power (P) is {P}, Parent integration is {Par} and Fragment integration is {Frag}.\n The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()   
+        process_events()   
         return [0, 0]   
 
     #calculate photofragmentation efficiency
@@ -171,5 +304,5 @@ def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag):
 
     except Exception as e:
         print(f'Error encountered during calculation of photogfragmentaion efficiency at wavelength {W}nm: {e}.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()      
+        process_events()      
         return [0, 0] 
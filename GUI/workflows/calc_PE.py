@@ -1,5 +1,6 @@
 import numpy as np
-from PyQt6.QtWidgets import QApplication
+
+from workflows.reporting import process_events
 
 def PE_calc(W_nm, P, dP, Par, dPar, Frag, dFrag):
     '''Calculates photofragmentation efficiency with normlaization to laser power. Usage is:
@@ -15,7 +16,7 @@ def PE_calc(W_nm, P, dP, Par, dPar, Frag, dFrag):
     #Check for division by zero
     if P == 0 or Par == 0:
         print(f'WARNING!!!!!\nDivision by zero error for wavelenth {W}nm. Power (P) is {P}, Parent integration is {Par} and Fragment integration is {Frag}.\n The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()   
+        process_events()   
         return [0, 0]   
    
     #convert wavelength (nm) to eV because we want lower numbers as we increase nm, not the other way around
@@ -69,7 +70,7 @@ def PE_calc(W_nm, P, dP, Par, dPar, Frag, dFrag):
     
     except Exception as e:
         print(f'Error encountered during calculation of photogfragmentaion efficiency at wavelength {W}nm: {e}.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()      
+        process_events()      
         return [0, 0] 
 
 def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag): 
@@ -88,7 +89,7 @@ def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag):
     #Check for division by zero
     if Par == 0:
         print(f'WARNING!!!!!\nDivision by zero error for wavelenth {W}nm. Power (P) is {P}, Parent integration is {Par} and Fragment integration is {Frag}.\n The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()   
+        process_events()   
         return [0, 0]   
 
     #calculate photofragmentation efficiency
@@ -106,9 +107,77 @@ def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag):
 
     except Exception as e:
         print(f'Error encountered during calculation of photogfragmentaion efficiency at wavelength {W}nm: {e}.\nWriting zeros for PE and PE_stdev')
-        QApplication.processEvents()      
+        process_events()      
         return [0, 0] 
 
+def nm_to_eV(wavelength):
+    '''Converts a wavelength (nm, scalar or array) to photon energy (eV)'''
+    h = 6.62607015E-34 #J*s
+    c = 299792458 #m/s
+    E = 1.60217663E-19
+
+    return ((h * c) / (np.asarray(wavelength, dtype=float) * 1.E-9)) / E
+
+#FWHM = 2*sqrt(2*ln(2))*sigma
+FWHM_TO_SIGMA = 1. / (2 * np.sqrt(2 * np.log(2)))
+
+def _warn_zero_division(W_nm, invalid, reason):
+    '''Prints a single warning listing every wavelength where the PE could not be calculated'''
+    if not np.any(invalid):
+        return
+    bad_wavelengths = np.unique(np.broadcast_to(W_nm, invalid.shape)[invalid])
+    print(f'WARNING!!!!!\nDivision by zero at {np.count_nonzero(invalid)} entries ({", ".join(f"{w:g}nm" for w in bad_wavelengths)}). {reason}\nWriting zeros for PE and PE_stdev at these entries.')
+    process_events()
+
+def PE_calc_vectorized(W_nm, P, dP, Par, dPar, Frag, dFrag):
+    '''Array version of PE_calc. All inputs are broadcast against each other, e.g. pass the wavelength, power, power stdev, parent integration and its stdev
+    as (n_wavelengths, 1) columns and the fragment integrations and their stdevs as an (n_wavelengths, n_fragments) matrix. Returns the PE and PE stdev arrays.
+    Entries where the power or the parent integration is zero are masked and set to zero.'''
+    W_nm, P, dP, Par, dPar, Frag, dFrag = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (W_nm, P, dP, Par, dPar, Frag, dFrag)))
+
+    invalid = (P == 0) | (Par == 0)
+    _warn_zero_division(W_nm, invalid, 'The laser power (P) and parent integration (Par) must be non-zero.')
+
+    #mask invalid entries with ones so that no division by zero occurs, then zero them afterwards
+    P = np.where(invalid, 1., P)
+    Par = np.where(invalid, 1., Par)
+
+    #incident wavelength to eV, and its stdev from the +/- 2 nm bandwidth of the OPO (taken as the FWHM of a Gaussian energy distribution)
+    W = nm_to_eV(W_nm)
+    dW = np.abs(nm_to_eV(W_nm - 2.) - nm_to_eV(W_nm + 2.)) * FWHM_TO_SIGMA
+
+    log_ratio = np.log(Par / (Frag + Par))
+
+    #calculate photofragmentation efficiency. 100 is a scaling factor so that numbers aren't super small
+    PE = -100. * (1/W) * (1/P) * log_ratio
+
+    #propagated standard deviation (same terms as PE_calc)
+    term1 = np.square((dW * log_ratio) / (np.square(W) * P))
+    term2 = np.square((dP * log_ratio) / (np.square(P) * W))
+    term3 = np.square(-1 * (dPar * Frag) / ((Par * P * W) * (Frag + Par)))
+    term4 = np.square(dFrag / ((W * P) * (Par + Frag)))
+    PE_stdev = np.sqrt(term1 + term2 + term3 + term4) * 100.
+
+    return np.where(invalid, 0., PE), np.where(invalid, 0., PE_stdev)
+
+def PE_calc_noNorm_vectorized(W_nm, P, dP, Par, dPar, Frag, dFrag):
+    '''Array version of PE_calc_noNorm, with the same broadcasting and masking as PE_calc_vectorized. Wavelength, Power, and Power stdev are only used for the shape and the warnings.'''
+    W_nm, P, dP, Par, dPar, Frag, dFrag = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (W_nm, P, dP, Par, dPar, Frag, dFrag)))
+
+    invalid = Par == 0
+    _warn_zero_division(W_nm, invalid, 'The parent integration (Par) must be non-zero.')
+    Par = np.where(invalid, 1., Par)
+
+    #calculate photofragmentation efficiency
+    efficiency = -1 * np.log(Par / (Frag + Par))
+
+    #calculate standard deviatian in photofragmentation efficiency
+    term1 = np.square(-1 * (Frag / (Par + Frag) / Par) * dPar)
+    term2 = np.square((1 / (Par + Frag)) * dFrag)
+    PE_stdev = np.sqrt(term1 + term2)
+
+    return np.where(invalid, 0., efficiency), np.where(invalid, 0., PE_stdev)
+
 if __name__ == "__main__":
 
     W_nm = 200
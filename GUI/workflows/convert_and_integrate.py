@@ -0,0 +1,106 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from workflows.integrate_mzml import _integrate_and_collect_plots
+from workflows.integration_plots import IntegrationPlotStage
+from workflows.reporting import process_events
+from workflows.wiff2mzml import convert_wiff_files
+
+def convert_and_integrate(wiff_files, directory, mzml_directory, target_mzs, search_window, parent_mz, backgrounds=None, plot=False, height=2000, threshold=2000, prominence=100.0, width=10, mode='full', n_workers=1, n_converters=1, msconvert_path='msconvert', reporter=None, msconvert_options=None, resume=False, raw_spectrum=False, window_margin=None):
+    '''
+    Converts .wiff files to mzML and integrates the mzML files of each .wiff file as soon as msconvert has finished writing them, while the remaining
+    .wiff files are still converting. Conversion (msconvert processes) and integration (a background thread, or n_workers worker processes) run at the same time,
+    so only the integration of the last .wiff file's spectra is left once the conversion has finished.
+
+    Returns a dict of {mzml file: integration results of integrate_spectra_multi}, in the order the files were converted, or False on error or cancel.
+    See convert_wiff_files and integrate_mzml_files for the parameters. With resume, the .wiff files converted by an earlier, interrupted run are not converted again,
+    and their mzML files are integrated straight away (from the results cache, if they were integrated too).
+    With plot, the plots of every integrated file are rendered in the background by an IntegrationPlotStage, like in integrate_mzml_files.
+    '''
+    integration_args = (target_mzs, search_window, parent_mz, backgrounds, plot, height, threshold, prominence, width, mode)
+    cancelled = reporter.cancelled if reporter is not None else None
+
+    #worker processes for n_workers > 1. Otherwise, a single background thread integrates the files - msconvert runs in its own processes, so the two don't compete.
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=int(n_workers))
+        integration_kwargs = {'raw_spectrum': raw_spectrum, 'window_margin': window_margin} #the cancel check can't be sent to another process; queued files are dropped on cancel instead
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+        integration_kwargs = {'cancelled': cancelled, 'raw_spectrum': raw_spectrum, 'window_margin': window_margin}
+
+    futures = {} #integration future -> mzml file
+    results = {} #mzml file -> integration results (False on failure)
+    plot_stage = IntegrationPlotStage(mzml_directory, n_workers) if plot else None
+
+    def collect(future):
+        '''Stores the result of a finished integration. Returns False if it failed.'''
+        mzml_file = futures[future]
+        if mzml_file not in results:
+            try:
+                integrated, plots = future.result()
+                results[mzml_file] = integrated or False
+                if integrated and plot_stage is not None:
+                    plot_stage.submit(plots)
+            except Exception as e:
+                print(f'Problem encountered when integrating the mass spectra in {mzml_file}:\n{e}')
+                results[mzml_file] = False
+
+            if results[mzml_file]:
+                print(f'Integration of {mzml_file} has completed.')
+            elif not (cancelled is not None and cancelled()):
+                print(f'Integration of the mass spectra in {mzml_file} failed. Analysis will be stopped.')
+            process_events()
+
+        return results[mzml_file] is not False
+
+    def queue_integration(wiff_file, mzml_files):
+        '''Called as soon as a .wiff file has been converted. Stops the conversion if an integration has already failed.'''
+        for future in list(futures):
+            if future.done() and not collect(future):
+                return False
+
+        for mzml_file in mzml_files:
+            futures[executor.submit(_integrate_and_collect_plots, mzml_directory, mzml_file, *integration_args, **integration_kwargs)] = mzml_file
+
+        print(f'{len(mzml_files)} .mzML files from {wiff_file} have been queued for integration.')
+        process_events()
+        return True
+
+    stopped = True
+    try:
+        converted = convert_wiff_files(wiff_files, directory, mzml_directory, n_converters, msconvert_path, reporter, on_converted=queue_integration, msconvert_options=msconvert_options, resume=resume)
+        if not converted:
+            return False
+
+        #the conversion has finished - wait for the integrations that are still queued or running
+        stage = 'Integrating mzML files'
+        if reporter is not None:
+            reporter.progress(len(results), len(futures), stage)
+
+        pending = {future for future in futures if futures[future] not in results}
+        while pending:
+            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+
+            if cancelled is not None and cancelled():
+                print('Integration cancelled by user.')
+                process_events()
+                return False
+
+            for future in done:
+                if not collect(future):
+                    return False
+
+                if reporter is not None:
+                    reporter.progress(len(results), len(futures), stage)
+
+        #the plots of the last files may still be rendering
+        if plot_stage is not None and not plot_stage.finish(reporter):
+            return False
+
+        stopped = False
+        return {mzml_file: results[mzml_file] for mzml_file in converted}
+
+    finally:
+        #on error or cancel, drop the files that are still queued and don't wait for the ones in progress
+        executor.shutdown(wait=not stopped, cancel_futures=True)
+        if plot_stage is not None:
+            plot_stage.stop()
@@ -0,0 +1,234 @@
+import os, re, json, struct, traceback
+import numpy as np
+
+from workflows.reporting import process_events
+from workflows.spectrum_cache import load_spectra_arrays, file_fingerprint
+
+#Every scan of every mzML file in an experiment is packed into one file in the mzml_directory.
+#Layout: STORE_MAGIC, the length of the JSON header (uint64), the JSON header, then the raw arrays, each starting on a multiple of ARRAY_ALIGNMENT bytes.
+#The header lists the mzML files (with their wavelengths and fingerprints) and the dtype, shape and byte offset of each array:
+#   mz, intensity: m/z and intensity of every scan of every file, concatenated
+#   scan_offsets: (n_scans + 1) offsets into mz/intensity, where scan i spans mz[scan_offsets[i]:scan_offsets[i+1]]
+#   file_scans: (n_files + 1) offsets into the scans, where file k spans scans file_scans[k] to file_scans[k+1]
+STORE_FILE_NAME = 'experiment.spectra'
+STORE_MAGIC = b'SPECSTORE'
+STORE_VERSION = 1
+ARRAY_ALIGNMENT = 64
+
+def store_path(mzml_directory):
+    '''Location of the experiment store for an mzml_directory'''
+    return os.path.join(mzml_directory, STORE_FILE_NAME)
+
+def _wavelength(mzml_file):
+    '''Laser wavelength in the mzml file name (same pattern as the main analysis), or NaN if there is none'''
+    match = re.search(r'Laser.*?(\d+)', mzml_file)
+    return float(match.group(1)) if match else np.nan
+
+def _align(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+class ExperimentStore:
+    '''
+    Read-only view of an experiment store. The arrays are memory-mapped, so opening a store only reads its header, and the spectra of a file are
+    read from disk when they are used. The arrays returned by file_arrays and spectra are slices of the mapped file, not copies.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as opf:
+            if opf.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError(f'{os.path.basename(path)} is not an experiment store.')
+            header_length, = struct.unpack('<Q', opf.read(8))
+            self.header = json.loads(opf.read(header_length).decode('utf-8'))
+
+        if self.header.get('version') != STORE_VERSION:
+            raise ValueError(f'{os.path.basename(path)} was written by an incompatible version of the experiment store.')
+
+        self.mzml_files = self.header['mzml_files']
+        self.wavelengths = np.array(self.header['wavelengths'], dtype=float)
+        self._file_index = {mzml_file: k for k, mzml_file in enumerate(self.mzml_files)}
+
+        self.mz = self._map('mz')
+        self.intensity = self._map('intensity')
+        self.scan_offsets = self._map('scan_offsets')
+        self.file_scans = self._map('file_scans')
+
+    def _map(self, name):
+        '''Memory-maps one of the arrays listed in the header'''
+        spec = self.header['arrays'][name]
+        shape = tuple(spec['shape'])
+        if not np.prod(shape):
+            return np.empty(shape, dtype=spec['dtype']) #empty arrays can't be mapped
+        return np.memmap(self.path, dtype=spec['dtype'], mode='r', offset=spec['offset'], shape=shape)
+
+    def __len__(self):
+        return len(self.mzml_files)
+
+    def __contains__(self, mzml_file):
+        return mzml_file in self._file_index
+
+    def file_arrays(self, mzml_file):
+        '''Returns the (mz, intensity, offsets) arrays of one mzML file in the same form as workflows.spectrum_cache.load_spectra_arrays, where scan i spans mz[offsets[i]:offsets[i+1]]'''
+        k = self._file_index[mzml_file]
+        first_scan, last_scan = self.file_scans[k], self.file_scans[k + 1]
+        offsets = np.asarray(self.scan_offsets[first_scan:last_scan + 1])
+        start, stop = offsets[0], offsets[-1]
+        return self.mz[start:stop], self.intensity[start:stop], offsets - start
+
+    def spectra(self, mzml_file):
+        '''Returns a list of (mz, intensity) array pairs, one per scan of an mzML file'''
+        mz, intensity, offsets = self.file_arrays(mzml_file)
+        return [(mz[offsets[i]:offsets[i+1]], intensity[offsets[i]:offsets[i+1]]) for i in range(len(offsets) - 1)]
+
+    def is_current(self, mzml_directory, mzml_files):
+        '''
+        True if the store holds exactly mzml_files and none of them has changed since the store was built. mzML files that are no longer in the mzml_directory
+        are not checked, so the store keeps working as an archive of the experiment once the (much larger) mzML files have been deleted.
+        '''
+        if sorted(mzml_files) != sorted(self.mzml_files):
+            return False
+
+        for mzml_file, fingerprint in zip(self.mzml_files, self.header['fingerprints']):
+            mzml_path = os.path.join(mzml_directory, mzml_file)
+            if os.path.exists(mzml_path):
+                current = file_fingerprint(mzml_path, content_hash=False)
+                if (current['size'], current['mtime_ns']) != (fingerprint['size'], fingerprint['mtime_ns']):
+                    return False
+
+        return True
+
+def open_experiment_store(mzml_directory, mzml_files=None):
+    '''Opens the experiment store of an mzml_directory. If mzml_files is given, the store must hold exactly those files, unchanged. Returns None if there is no usable store.'''
+    path = store_path(mzml_directory)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        store = ExperimentStore(path)
+    except Exception as e:
+        print(f'The experiment store {path} could not be read ({e}). It will be rebuilt if needed.')
+        process_events()
+        return None
+
+    if mzml_files is not None and not store.is_current(mzml_directory, mzml_files):
+        return None
+
+    return store
+
+def build_experiment_store(mzml_directory, mzml_files, reporter=None):
+    '''
+    Packs every scan of every mzML file into the experiment store of the mzml_directory. Each file is read through the spectrum cache twice: once to size the arrays,
+    and once to copy its scans into the memory-mapped store, so only one file is held in memory at a time. The store is written to a temporary file first
+    so that an interrupted build never leaves a corrupt store behind. Returns the path of the store, or False on error or cancel.
+    reporter: Optional workflows.reporting.Reporter that receives progress after every file and is polled for cancellation.
+    '''
+    stage = 'Building experiment store'
+    n_steps = 2 * len(mzml_files) #sizing pass + copy pass
+    path = store_path(mzml_directory)
+    temp_file = f'{path}.tmp'
+
+    if reporter is not None:
+        reporter.progress(0, n_steps, stage)
+
+    try:
+        #pass 1: number of points and scans in every file, and an intensity dtype that holds all of them (float32 if msconvert was run with --inten32)
+        n_points, n_scans, fingerprints = [], [], []
+        intensity_dtype = None
+        for k, mzml_file in enumerate(mzml_files):
+            if reporter is not None and reporter.cancelled():
+                print('Building of the experiment store cancelled by user.')
+                return False
+
+            mzml_path = os.path.join(mzml_directory, mzml_file)
+            mz, intensity, offsets = load_spectra_arrays(mzml_path)
+            n_points.append(len(mz))
+            n_scans.append(len(offsets) - 1)
+            fingerprints.append(file_fingerprint(mzml_path, content_hash=False))
+            intensity_dtype = intensity.dtype if intensity_dtype is None else np.promote_types(intensity_dtype, intensity.dtype)
+
+            if reporter is not None:
+                reporter.progress(k + 1, n_steps, stage)
+
+        #header with the location of every array
+        arrays = {'mz': (np.dtype(float), sum(n_points)), 'intensity': (np.dtype(intensity_dtype or float), sum(n_points)),
+                  'scan_offsets': (np.dtype(np.int64), sum(n_scans) + 1), 'file_scans': (np.dtype(np.int64), len(mzml_files) + 1)}
+        header = {'version': STORE_VERSION, 'mzml_files': list(mzml_files), 'wavelengths': [_wavelength(f) for f in mzml_files], 'fingerprints': fingerprints, 'arrays': {}}
+
+        #the header has to be written before the arrays, but its length depends on their offsets. Reserve room for the offsets, then lay out the arrays behind it.
+        header_length = len(json.dumps(header, allow_nan=True).encode('utf-8')) + 128 * len(arrays)
+        offset = _align(len(STORE_MAGIC) + 8 + header_length)
+        for name, (dtype, size) in arrays.items():
+            header['arrays'][name] = {'dtype': dtype.str, 'shape': [size], 'offset': offset}
+            offset = _align(offset + dtype.itemsize * size)
+
+        header_bytes = json.dumps(header, allow_nan=True).encode('utf-8').ljust(header_length)
+        with open(temp_file, 'wb') as opf:
+            opf.write(STORE_MAGIC + struct.pack('<Q', header_length) + header_bytes)
+            opf.truncate(offset)
+
+        def mapped(name):
+            spec = header['arrays'][name]
+            return np.memmap(temp_file, dtype=spec['dtype'], mode='r+', offset=spec['offset'], shape=tuple(spec['shape'])) if spec['shape'][0] else None
+
+        mz_out, intensity_out, scan_offsets, file_scans = (mapped(name) for name in arrays)
+        scan_offsets[0] = file_scans[0] = 0
+
+        #pass 2: copy the scans of every file into the store
+        point, scan = 0, 0
+        for k, mzml_file in enumerate(mzml_files):
+            if reporter is not None and reporter.cancelled():
+                print('Building of the experiment store cancelled by user.')
+                return False
+
+            mz, intensity, offsets = load_spectra_arrays(os.path.join(mzml_directory, mzml_file))
+            if len(mz) != n_points[k] or len(offsets) - 1 != n_scans[k]:
+                raise ValueError(f'{mzml_file} changed while the experiment store was being built.')
+
+            if len(mz):
+                mz_out[point:point + len(mz)] = mz
+                intensity_out[point:point + len(mz)] = intensity
+            scan_offsets[scan + 1:scan + n_scans[k] + 1] = offsets[1:] + point
+            point += len(mz)
+            scan += n_scans[k]
+            file_scans[k + 1] = scan
+
+            if reporter is not None:
+                reporter.progress(len(mzml_files) + k + 1, n_steps, stage)
+
+        for array in (mz_out, intensity_out, scan_offsets, file_scans):
+            if array is not None:
+                array.flush()
+        mz_out = intensity_out = scan_offsets = file_scans = None #release the maps so that the file can be moved (required on Windows)
+
+        os.replace(temp_file, path)
+
+    except Exception as e:
+        print(f'Problem encountered when building the experiment store {path}: {e}\nTraceback: {traceback.format_exc()}')
+        process_events()
+        return False
+
+    finally:
+        mz_out = intensity_out = scan_offsets = file_scans = None
+        if os.path.exists(temp_file):
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+    size_mb = os.path.getsize(path) / 1e6
+    mzml_mb = sum(fingerprint['size'] for fingerprint in fingerprints) / 1e6
+    print(f'{len(mzml_files)} .mzML files ({sum(n_scans)} scans) have been packed into {path} ({size_mb:.1f} MB, {mzml_mb:.1f} MB of mzML).')
+    process_events()
+    return path
+
+def update_experiment_store(mzml_directory, mzml_files, reporter=None):
+    '''Returns the path of the experiment store of the mzml_directory, (re)building it first if it doesn't hold exactly mzml_files or any of them has changed. Returns False on error or cancel.'''
+    store = open_experiment_store(mzml_directory, mzml_files)
+    if store is not None:
+        print(f'Reading the spectra from the experiment store {store.path}.')
+        process_events()
+        return store.path
+
+    print(f'Packing {len(mzml_files)} .mzML files into the experiment store...')
+    process_events()
+    return build_experiment_store(mzml_directory, mzml_files, reporter)
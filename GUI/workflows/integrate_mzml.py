@@ -1,144 +1,650 @@
-import os, re, traceback
+import os, sys, re, time, traceback
 import numpy as np
-import pyteomics.mzml as mzml
-from scipy.signal import find_peaks
-import matplotlib.pyplot as plt
-from PyQt6.QtWidgets import QApplication
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from scipy.signal import find_peaks, peak_widths
 
-#Function to integrate mass spectra within specified bounds using NumPy
-def integrate_spectra(directory, mzml_file, target_mz, search_window, parent_mz, background = 0.0, plot=False, height=2000, threshold=2000, prominence=100.0, width=10):
+from workflows.experiment_store import ExperimentStore
+from workflows.integration_plots import IntegrationPlotStage, integration_plot, plot_file, render_integration_plots
+from workflows.reporting import process_events
+from workflows.RawData_from_mzml import RAW_DATA_STEP, raw_data_grid, mean_raw_spectrum
+from workflows.results_cache import ResultsCache, integration_key, raw_spectrum_key
+from workflows.spectrum_cache import load_spectra_arrays
+
+#Ways in which integrate_spectra_multi can interpolate and search each scan for peaks. See its docstring for details.
+INTEGRATION_MODES = ('full', 'windowed', 'batched', 'native', 'averaged')
+
+#Spacing of the common m/z grid. The peak finder's threshold and width are given in units of this grid, also in 'native' mode.
+GRID_STEP = 0.01
+
+#Extra m/z on each side of the search window that the 'windowed', 'batched' and 'averaged' modes interpolate, unless window_margin is given
+WINDOW_MARGIN = 2.0
+
+#The bootstrap of the 'averaged' mode draws the same resamples on every run, so that repeated analyses give identical results
+BOOTSTRAP_SEED = 0
+
+def _common_mz_grid(parent_mz):
+    '''The 0.01 Da grid (0 to parent_mz + 50) that every scan is interpolated onto'''
+    min_mz = 0.
+    max_mz = parent_mz + 50.  #adding 50 mass units to the parent ion
+    return np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / GRID_STEP + 1)),2) #0.01 Da incremenets for mz grid
+
+def _base_wlen(window_margin, spacing=GRID_STEP):
+    '''scipy's wlen (in samples) that limits the search for the peak bases to window_margin on each side of the peak, or None (no limit) if window_margin is None'''
+    return None if window_margin is None else 2 * int(round(window_margin / spacing)) + 1
+
+def _window_grids(common_mz_grid, target_mzs, search_window, window_margin=None):
+    '''Slices of the common grid within target_mz +/- (search_window + WINDOW_MARGIN) for each target, as used by the 'windowed', 'batched' and 'averaged' modes.
+    If window_margin is given, the slices reach window_margin plus one grid point beyond the search window instead, so that they hold the whole (limited) base search of any peak.'''
+    margin = search_window + (WINDOW_MARGIN if window_margin is None else window_margin + GRID_STEP)
+    return [common_mz_grid[np.searchsorted(common_mz_grid, target_mz - margin, side='left'):np.searchsorted(common_mz_grid, target_mz + margin, side='right')] for target_mz in target_mzs]
+
+def _interp_window(grid, mz, intensity):
+    '''Interpolates a scan onto a contiguous slice of the common m/z grid. Only the raw points that bracket the slice are passed to np.interp,
+    which gives exactly the same values as interpolating the whole scan onto the full grid and slicing the result.'''
+    start = max(np.searchsorted(mz, grid[0], side='right') - 1, 0)
+    stop = min(np.searchsorted(mz, grid[-1], side='left') + 1, len(mz))
+    return np.interp(grid, mz[start:stop], intensity[start:stop], left = 0, right = 0)
+
+def _find_peaks_native(mz, intensity, height, threshold, prominence, width, window_margin=None):
     '''
-    Integrates the mass spectra from mzml files around peaks detected near a specified m/z using a common interpolated grid and SciPy's peak detection.
-    Optional plotting to visualize peak detection and integration.
+    Runs scipy's peak finder directly on raw (not interpolated) points, with threshold and width converted from units of the 0.01 Da grid so that they mean the same as in the other modes:
+        threshold is the minimum drop to the neighbouring samples, i.e., a slope. It is scaled by the median point spacing over GRID_STEP.
+        width (in grid points) is compared with the width at half prominence in m/z, which peak_widths interpolates linearly between samples, like np.interp does on the grid.
+        window_margin (m/z), if given, limits the search for the peak bases like on the grid. It is converted to samples with the median point spacing.
+    height and prominence are unaffected by the sampling, because the maxima and minima of a linear interpolation are always at raw points.
+    '''
+    spacing = np.median(np.diff(mz))
+    peaks, properties = find_peaks(intensity, height=height, threshold=None if threshold is None else threshold * spacing / GRID_STEP, distance=None, prominence=prominence,
+                                   wlen=_base_wlen(window_margin, spacing))
+
+    if width is not None and peaks.size:
+        prominence_data = (properties['prominences'], properties['left_bases'], properties['right_bases']) if 'prominences' in properties else None
+        _, _, left_ips, right_ips = peak_widths(intensity, peaks, rel_height=0.5, prominence_data=prominence_data)
+        sample_index = np.arange(mz.size)
+        keep = (np.interp(right_ips, sample_index, mz) - np.interp(left_ips, sample_index, mz)) >= width * GRID_STEP
+        peaks = peaks[keep]
+        properties = {key: value[keep] for key, value in properties.items()}
+
+    return peaks, properties
+
+def _segment_areas(grid, intensity):
+    '''Areas of the trapezoids between neighbouring grid points, along the last axis of intensity. Every mode integrates with these, rather than with np.trapz
+    (removed in NumPy 2.4) or np.trapezoid (added in NumPy 2.0), so that the integration is the same in all of them and on every NumPy version.'''
+    return 0.5 * (intensity[..., :-1] + intensity[..., 1:]) * np.diff(grid)
+
+def _integrate_target(grid, interp_intensity, peaks, properties, target_mz, search_window, background):
+    '''Selects the most intense peak within search_window of target_mz and integrates it between its bases using the trapezoidal rule.
+    Returns (integration, left_base, right_base), or None if no valid peak is found.'''
+    peak_mz = grid[peaks]
+
+    #Filter peaks within the specified search window around the target m/z
+    valid_peaks = np.flatnonzero((peak_mz >= (target_mz - search_window)) & (peak_mz <= (target_mz + search_window)))
+
+    if valid_peaks.size == 0 or 'left_bases' not in properties or 'right_bases' not in properties:
+        return None
+
+    #Find the peak with the highest intensity among valid peaks. 'idx' is the index within 'peaks', so it's valid for accessing 'properties'
+    idx = valid_peaks[np.argmax(interp_intensity[peaks[valid_peaks]])]
+    left_base = properties['left_bases'][idx]
+    right_base = properties['right_bases'][idx]
+    
+    #Integrate the peak using the trapezoidal rule
+    integration = _segment_areas(grid[left_base:right_base + 1], interp_intensity[left_base:right_base + 1]).sum() - background
+
+    #if total integration is not discernable from background and yields a negative number, assign an integration of zero.
+    if integration < 0:
+        integration = 0.0
+
+    return integration, left_base, right_base
+
+def _interp_scans(grid, mz, intensity, offsets):
+    '''Interpolates every scan of a file onto the same grid with a single np.interp call and returns an (n_scans, n_grid) array.
+    Each scan i spans mz[offsets[i]:offsets[i+1]]. The scans (and copies of the grid) are shifted along the m/z axis by i * span so that they
+    form one monotonic array, and grid points outside each scan's own m/z range are set to zero afterwards (same as left=0, right=0).
+    The shift costs a little floating-point precision: values agree with per-scan np.interp to ~1e-9 relative.'''
+    n_scans = len(offsets) - 1
+    counts = np.diff(offsets)
+    interp_intensity = np.zeros((n_scans, grid.size))
+
+    if n_scans == 0 or grid.size == 0 or mz.size == 0:
+        return interp_intensity
+
+    low = min(grid[0], mz.min())
+    span = max(grid[-1], mz.max()) - low + 1.
+
+    scan_shift = np.arange(n_scans) * span
+    shifted_mz = (mz - low) + np.repeat(scan_shift, counts)
+    shifted_grid = (grid - low)[None, :] + scan_shift[:, None]
+    interp_intensity[:] = np.interp(shifted_grid.ravel(), shifted_mz, intensity).reshape(n_scans, grid.size)
+
+    #zero everything outside of each scan's m/z range (and any empty scans)
+    has_points = counts > 0
+    first_mz = np.where(has_points, mz[np.minimum(offsets[:-1], mz.size - 1)], np.inf)
+    last_mz = np.where(has_points, mz[np.maximum(offsets[1:] - 1, 0)], -np.inf)
+    interp_intensity[(grid[None, :] < first_mz[:, None]) | (grid[None, :] > last_mz[:, None])] = 0.
+
+    return interp_intensity
+
+def _find_peaks_batched(interp_intensity, grid, target_mz, search_window, height, threshold, prominence, width, wlen=None):
+    '''
+    Vectorized equivalent of running scipy's find_peaks on every row of an (n_scans, n_grid) array and selecting the most intense peak within
+    search_window of target_mz, as done by _integrate_target. Follows find_peaks' definitions of local maxima (plateau midpoints), height,
+    threshold, prominence (with its left/right bases, searched within wlen samples centred on the peak) and width (at half prominence).
+    Returns (found, peak, left_base, right_base), one entry per row.
+    '''
+    n_rows, n_points = interp_intensity.shape
+    found = np.zeros(n_rows, dtype=bool)
+    peak = np.zeros(n_rows, dtype=int)
+    left_base = np.zeros(n_rows, dtype=int)
+    right_base = np.zeros(n_rows, dtype=int)
+
+    if n_points < 3:
+        return found, peak, left_base, right_base
+
+    columns = np.arange(n_points)
+    rows = np.arange(n_rows)[:, None]
+    diff = np.diff(interp_intensity, axis=1)
+
+    #local maxima: a rise into i, followed by a (possibly flat) plateau that ends in a fall. The peak sits at the middle of the plateau.
+    change = np.where(diff != 0, columns[:-1], n_points - 1)
+    plateau_end = np.minimum.accumulate(change[:, ::-1], axis=1)[:, ::-1] #first index >= i where the intensity changes
+    rising = np.zeros((n_rows, n_points), dtype=bool)
+    rising[:, 1:-1] = diff[:, :-1] > 0
+    end = np.where(rising[:, :-1], plateau_end, n_points - 1)
+    falling = np.zeros_like(rising)
+    falling[:, :-1] = rising[:, :-1] & (end < n_points - 1)
+    falling[:, :-1] &= np.take_along_axis(diff, np.minimum(end, n_points - 2), axis=1) < 0
+
+    candidate_rows, left_edges = np.nonzero(falling)
+    midpoints = (left_edges + end[candidate_rows, left_edges]) // 2
+
+    candidates = np.zeros((n_rows, n_points), dtype=bool)
+    candidates[candidate_rows, midpoints] = True
+
+    #peak height and threshold (vertical distance to both neighbouring samples)
+    if height is not None:
+        candidates &= interp_intensity >= height
+    if threshold is not None:
+        neighbour_drop = np.full((n_rows, n_points), -np.inf)
+        neighbour_drop[:, 1:-1] = np.minimum(interp_intensity[:, 1:-1] - interp_intensity[:, :-2], interp_intensity[:, 1:-1] - interp_intensity[:, 2:])
+        candidates &= neighbour_drop >= threshold
+
+    #only peaks within the search window around the target can be selected
+    candidates &= ((grid >= (target_mz - search_window)) & (grid <= (target_mz + search_window)))[None, :]
+
+    #Take the most intense candidate of each row. If it fails the prominence/width criteria, discard it and try the next most intense one.
+    active = np.flatnonzero(candidates.any(axis=1))
+    while active.size:
+        y = interp_intensity[active]
+        p = np.argmax(np.where(candidates[active], y, -np.inf), axis=1)
+        peak_height = y[np.arange(active.size), p]
+        before = columns[None, :] <= p[:, None]
+        after = columns[None, :] >= p[:, None]
+        if wlen is not None:
+            before &= columns[None, :] >= (p - wlen // 2)[:, None]
+            after &= columns[None, :] <= (p + wlen // 2)[:, None]
+
+        #prominence bases: the lowest point between the peak and the nearest higher sample (or the end of wlen) on each side (closest to the peak on ties)
+        higher = y > peak_height[:, None]
+        left_limit = np.where(higher & before, columns, -1).max(axis=1)
+        right_limit = np.where(higher & after, columns, n_points).min(axis=1)
+        left_range = before & (columns[None, :] > left_limit[:, None])
+        right_range = after & (columns[None, :] < right_limit[:, None])
+        left_values = np.where(left_range, y, np.inf)
+        right_values = np.where(right_range, y, np.inf)
+        lb = n_points - 1 - np.argmin(left_values[:, ::-1], axis=1)
+        rb = np.argmin(right_values, axis=1)
+        peak_prominence = peak_height - np.maximum(left_values.min(axis=1), right_values.min(axis=1))
+        passed = np.ones(active.size, dtype=bool) if prominence is None else peak_prominence >= prominence
+
+        #peak width at half prominence, interpolated between samples and bounded by the bases
+        if width is not None:
+            width_height = peak_height - 0.5 * peak_prominence
+            below = y <= width_height[:, None]
+            i_left = np.where(below & before & (columns[None, :] >= lb[:, None]), columns, lb[:, None]).max(axis=1)
+            i_right = np.where(below & after & (columns[None, :] <= rb[:, None]), columns, rb[:, None]).min(axis=1)
+            r = np.arange(active.size)
+            y_left, y_right = y[r, i_left], y[r, i_right]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                left_ip = i_left + np.where(y_left < width_height, (width_height - y_left) / (y[r, np.minimum(i_left + 1, n_points - 1)] - y_left), 0.)
+                right_ip = i_right - np.where(y_right < width_height, (width_height - y_right) / (y[r, np.maximum(i_right - 1, 0)] - y_right), 0.)
+            passed &= (right_ip - left_ip) >= width
+
+        accepted = active[passed]
+        found[accepted] = True
+        peak[accepted] = p[passed]
+        left_base[accepted] = lb[passed]
+        right_base[accepted] = rb[passed]
+
+        rejected = ~passed
+        candidates[active[rejected], p[rejected]] = False
+        active = active[rejected]
+        active = active[candidates[active].any(axis=1)]
+
+    return found, peak, left_base, right_base
+
+def _integrate_rows(interp_intensity, grid, found, left_base, right_base):
+    '''Trapezoidal integration of every row of an (n_scans, n_grid) array between its own left and right base. Rows without a peak integrate to zero.'''
+    segment_area = _segment_areas(grid, interp_intensity)
+    segments = np.arange(grid.size - 1)[None, :]
+    in_peak = found[:, None] & (segments >= left_base[:, None]) & (segments < right_base[:, None])
+    return np.where(in_peak, segment_area, 0.).sum(axis=1)
+
+def integrate_spectra_multi(directory, mzml_file, target_mzs, search_window, parent_mz, backgrounds=None, plot=False, height=2000, threshold=2000, prominence=100.0, width=10, mode='full', window_margin=None, cancelled=None, store_file=None, n_bootstrap=200, use_results_cache=True, raw_spectrum=False, raw_spectrum_out=None, plot_out=None):
+    '''
+    Integrates the parent and all fragment peaks of an mzml file in a single pass. Returns a list of [average integration, stdev] for each target (in the order given), or False on error.
     
     Parameters:
         directory: Directory containing mzml files.
         mzml_file: Name of mzml file.
-        target_mz: List of target m/z values to find and integrate the peaks.
-        search_window: Window size around the target m/z to limit the search for the peak.
+        target_mzs: List of target m/z values to find and integrate the peaks (e.g., [parent_mz, frag1, frag2, ...]).
+        search_window: Window size around each target m/z to limit the search for the peak.
         parent_mz: m/z of the parent ion used to set the upper limit of the m/z range for the common grid.
-        background: The amount of background fragmentation that you wish to be subtracted from the integration.
-        plot: If True, plots the spectrum with peak detection and integration area highlighted.
+        backgrounds: List of background fragmentation values to be subtracted from the integration of each target. Defaults to zero for all targets.
+        plot: If True, plots the spectrum with peak detection and integration area highlighted (first scan with a valid peak for each target). The inputs of the plots are collected
+            while the file is integrated and rendered once it is done (see workflows.integration_plots), or handed to plot_out.
         height, threshold, prominence, width: scipy peakfind parameters with defaults of 2000, 2000, 100, and 10, respectively.
+        mode: How each scan is interpolated and searched for peaks. One of INTEGRATION_MODES:
+            'full': each scan is interpolated onto the full 0.01 Da grid (0 to parent_mz + 50) and searched for peaks once, for every target.
+            'windowed': only the grid within target_mz +/- (search_window + 2 m/z) is interpolated; integrates less than 'full' if the bases of 'full' lie outside it (noisy baseline).
+            'batched': same as 'windowed', with every scan of the file interpolated and searched at once as a NumPy array.
+            'native': same as 'full', on the raw points of each scan instead of the grid (see _find_peaks_native); peaks close to the threshold can be accepted differently.
+            'averaged': the mean spectrum of the 'windowed' slice is integrated once; the stdev is a bootstrap estimate of its uncertainty (n_bootstrap resamples), not the scan-to-scan spread.
+        window_margin: Optional m/z on each side of a peak within which its bases are searched, in every mode (scipy's wlen), so that the windowed modes match 'full'. None searches the whole spectrum.
+        cancelled: Optional function that returns True once the user has asked to stop. It is checked between scans (between targets in 'batched' mode), and the file returns False when it does.
+        store_file: Optional experiment store (see workflows.experiment_store) that holds the spectra of mzml_file. The scans are sliced straight out of the memory-mapped store instead of being read from the mzml file.
+        n_bootstrap: Number of bootstrap resamples used for the stdev in 'averaged' mode.
+        use_results_cache: If True, the result of every target is stored in the results cache (see workflows.results_cache), keyed by the target and all parameters that affect it.
+            Targets that were integrated before with the same parameters, in the same (unchanged) mzml file, are read from the cache, and only the remaining targets are integrated.
+            When plotting, a cached target is only skipped if its plot file already exists in directory/integration_plots (it is assumed to show the cached result); the targets
+            without a plot, including those where no scan had a valid peak, are integrated again so that their plots are made.
+        raw_spectrum: If True, the average of every scan on the raw data export grid (see workflows.RawData_from_mzml) is computed from the same decoded scans and stored
+            in the results cache, so that the raw data export doesn't have to decode the file again. Requires use_results_cache.
+        raw_spectrum_out: Used internally to pass the averaged raw spectrum back to the results cache: a list that it is appended to.
+        plot_out: Optional list that the inputs of the plots are appended to instead of being rendered here, e.g., to render them in the background with an IntegrationPlotStage.
     '''
 
+    if mode not in INTEGRATION_MODES:
+        print(f'Unknown integration mode "{mode}". Please choose one of: {", ".join(INTEGRATION_MODES)}.')
+        process_events()
+        return False
+
+    if backgrounds is None:
+        backgrounds = [0.0] * len(target_mzs)
+
+    wavelength = float(re.findall(r'\d+',mzml_file.split('Laser')[-1])[-1]) #needed for print statements and plot files
+
+    #called on its own (e.g., by integrate_spectra): collect the plots of the file, then render them once it has been integrated
+    if plot and plot_out is None:
+        plot_out = []
+        results = integrate_spectra_multi(directory, mzml_file, target_mzs, search_window, parent_mz, backgrounds, plot, height, threshold, prominence, width, mode, window_margin, cancelled,
+                                          store_file, n_bootstrap, use_results_cache, raw_spectrum, raw_spectrum_out, plot_out)
+        if results is not False:
+            render_integration_plots(directory, plot_out)
+        return results
+
+    #read what is already known from the results cache, and integrate only the targets that are missing
+    if use_results_cache and (store_file is not None or os.path.exists(os.path.join(directory, mzml_file))):
+        try:
+            results_cache = ResultsCache(directory, mzml_file, store_file)
+        except Exception as e:
+            print(f'Error encounter when reading the integration results cache of {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}')
+            process_events()
+            return False
+
+        keys = [integration_key(target_mz, background, search_window, parent_mz, height, threshold, prominence, width, mode, WINDOW_MARGIN if window_margin is None else window_margin, n_bootstrap,
+                                limit_bases=window_margin is not None) for target_mz, background in zip(target_mzs, backgrounds)]
+        missing = [t for t, key in enumerate(keys) if key not in results_cache.entries or (plot and not os.path.exists(plot_file(directory, {'target_mz': target_mzs[t], 'wavelength': wavelength})))]
+        raw_key = raw_spectrum_key(parent_mz, RAW_DATA_STEP)
+        raw_spectra = [] if raw_spectrum and raw_key not in results_cache.entries else None
+
+        if missing or raw_spectra is not None:
+            integrated = integrate_spectra_multi(directory, mzml_file, [target_mzs[t] for t in missing], search_window, parent_mz, [backgrounds[t] for t in missing], plot, height, threshold, prominence, width,
+                                                 mode, window_margin, cancelled, store_file, n_bootstrap, use_results_cache=False, raw_spectrum_out=raw_spectra, plot_out=plot_out)
+            if integrated is False:
+                return False
+
+            for t, result in zip(missing, integrated):
+                results_cache.entries[keys[t]] = [float(value) for value in result]
+            if raw_spectra and raw_spectra[0] is not None:
+                results_cache.entries[raw_key] = [float(value) for value in raw_spectra[0]]
+            results_cache.save()
+
+        return [results_cache.entries[key] for key in keys]
+
     #Initialize variables
-    integrations = []
-    peaks_found = []
-    min_mz = 0.
-    max_mz = parent_mz + 50.  #adding 50 mass units to the parent ion
-    
-    #some counters to control print statements
-    i = j = k = l = m = 0
+    integrations = [[] for _ in target_mzs] #one list of per-scan integrations for each target
+    plotted = [False] * len(target_mzs) #only plot the first valid scan for each target
 
     #define common mz grid for interpolation
-    common_mz_grid = np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / 0.01 + 1)),2) #0.01 Da incremenets for mz grid
+    common_mz_grid = _common_mz_grid(parent_mz)
 
-    with mzml.read(os.path.join(directory, mzml_file)) as spectra:  
+    #with window_margin, the peak bases are searched within window_margin of the peak in every mode, so that the windows of the windowed modes always hold them
+    wlen = _base_wlen(window_margin)
+
+    #in windowed, batched and averaged modes, each target only needs the slice of the common grid around its search window
+    if mode in ('windowed', 'batched', 'averaged'):
+        target_grids = _window_grids(common_mz_grid, target_mzs, search_window, window_margin)
+
+    #decoded m/z and intensity arrays are read from the experiment store if one is given, otherwise from the spectrum cache when the mzml file is unchanged since the last run
+    try:
+        if store_file is not None:
+            mz_all, intensity_all, offsets = ExperimentStore(store_file).file_arrays(mzml_file)
+        else:
+            mz_all, intensity_all, offsets = load_spectra_arrays(os.path.join(directory, mzml_file))
+        intensity_all = intensity_all.astype(float, copy=False) #32-bit intensities (msconvert --inten32) are widened once here rather than in every np.interp call
         
-        wavelength = float(re.findall(r'\d+',mzml_file.split('Laser')[-1])[-1]) #needed for print statements
-        spec_counter = 0
+    except Exception as e:
+        print(f'Error encounter when extracting m/z and intensity arrays from {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}')
+        process_events()
+        return False
 
-        for spectrum in spectra:
+    #the raw data export's averaged spectrum, from the scans that have just been decoded
+    if raw_spectrum_out is not None:
+        raw_spectrum_out.append(mean_raw_spectrum(raw_data_grid(parent_mz), mz_all, intensity_all, offsets))
 
-            #according to stack exchange, these are pre-defined lists from pyteomics              
-            try:
-                mz = spectrum['m/z array']
-                intensity = spectrum['intensity array']
-                
-            except Exception as e:
-                print(f'Error encounter when extract m/z and intensity arrays from spectrum number {spec_counter+1} in {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}')
-                QApplication.processEvents()
+    if not target_mzs:
+        return []
+
+    if mode == 'batched':
+        results = []
+        for target_mz, background, grid in zip(target_mzs, backgrounds, target_grids):
+            if cancelled is not None and cancelled():
                 return False
-            
-            #Check for inconsistent data
-            if len(mz) != len(intensity):
-                print(f'Inconsistent lengths of m/z and intensity arrays in {os.path.basename(mzml_file)}. Analysis will be stopped.')
-                QApplication.processEvents()     
+
+            #interpolate all scans at once, then pick and integrate the peak of every scan with array operations
+            interp_intensity = _interp_scans(grid, mz_all, intensity_all, offsets)
+            found, peak, left_base, right_base = _find_peaks_batched(interp_intensity, grid, target_mz, search_window, height, threshold, prominence, width, wlen)
+            target_integrations = np.maximum(_integrate_rows(interp_intensity, grid, found, left_base, right_base) - np.where(found, background, 0.), 0.)
+            results.append([np.mean(target_integrations) if target_integrations.size else 0, np.std(target_integrations) if target_integrations.size else 0])
+
+            if plot and found.any():
+                row = np.argmax(found)
+                peaks, _ = find_peaks(interp_intensity[row], height=height, threshold=threshold, distance=None, prominence=prominence, width=width, wlen=wlen)
+                plot_out.append(integration_plot(grid, interp_intensity[row], peaks, left_base[row], right_base[row], target_mz, wavelength))
+
+        return results
+
+    if mode == 'averaged':
+        n_scans = len(offsets) - 1
+
+        #bootstrap resamples of the scans, shared by all targets: counts[b, i] is the number of times scan i is drawn in resample b
+        counts = np.random.default_rng(BOOTSTRAP_SEED).multinomial(n_scans, np.full(n_scans, 1. / n_scans), size=n_bootstrap) if n_scans else None
+
+        results = []
+        for target_mz, background, grid in zip(target_mzs, backgrounds, target_grids):
+            if cancelled is not None and cancelled():
                 return False
 
+            if n_scans == 0 or grid.size == 0:
+                results.append([0, 0])
+                continue
+
+            #mean spectrum of all scans, and of every bootstrap resample
+            interp_intensity = _interp_scans(grid, mz_all, intensity_all, offsets)
+            mean_spectrum = interp_intensity.mean(axis=0)
+            bootstrap_spectra = counts @ interp_intensity / n_scans
+
+            #pick and integrate the peak once on the mean spectrum, and again on each resample
+            found, peak, left_base, right_base = _find_peaks_batched(mean_spectrum[None, :], grid, target_mz, search_window, height, threshold, prominence, width, wlen)
+            integration = max(_integrate_rows(mean_spectrum[None, :], grid, found, left_base, right_base)[0] - (background if found[0] else 0.), 0.)
+
+            bootstrap_found, _, bootstrap_left_base, bootstrap_right_base = _find_peaks_batched(bootstrap_spectra, grid, target_mz, search_window, height, threshold, prominence, width, wlen)
+            bootstrap_integrations = np.maximum(_integrate_rows(bootstrap_spectra, grid, bootstrap_found, bootstrap_left_base, bootstrap_right_base) - np.where(bootstrap_found, background, 0.), 0.)
+
+            results.append([integration, np.std(bootstrap_integrations)])
+
+            if plot and found[0]:
+                peaks, _ = find_peaks(mean_spectrum, height=height, threshold=threshold, distance=None, prominence=prominence, width=width, wlen=wlen)
+                plot_out.append(integration_plot(grid, mean_spectrum, peaks, left_base[0], right_base[0], target_mz, wavelength))
+
+        return results
+
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        if cancelled is not None and cancelled():
+            return False
+
+        mz = mz_all[start:stop]
+        intensity = intensity_all[start:stop]
+
+        #Check for inconsistent data
+        if len(mz) != len(intensity):
+            print(f'Inconsistent lengths of m/z and intensity arrays in {os.path.basename(mzml_file)}. Analysis will be stopped.')
+            process_events()     
+            return False
+
+        if mode == 'full':
             #Interpolate intensity onto the common m/z grid, adding zeros for any extrapolation
+            grid = common_mz_grid
             interp_intensity = np.interp(common_mz_grid, mz, intensity, left = 0, right = 0)
 
-            #scipy peak finder
-            peaks, properties = find_peaks(interp_intensity, height=2000, threshold=2000, distance=None, prominence=100.0, width=10)
-            peak_mz = common_mz_grid[peaks]
-
-            #Filter peaks within the specified search window around the target m/z
-            valid_peaks = [(index, peak_mz[index]) for index, peak in enumerate(peak_mz) if (target_mz - search_window) <= peak <= (target_mz + search_window)]
-
-            if valid_peaks:
-                if len(valid_peaks) > 1:
-                    #Find the peak with the highest intensity among valid peaks
-                    highest_intensity_peak = max(valid_peaks, key=lambda x: interp_intensity[peaks[x[0]]])
-                    valid_peaks = [highest_intensity_peak]  #Update valid_peaks to only include the closest peak
-                    
-                    #only print once per fragment/mzml file combo
-                    if i == 0:
-                        #print(f'Multiple valid peaks found for {target_mz} in the UVPD spectrum at {wavelength}nm. Selecting peak at m/z = {highest_intensity_peak[1]}, which has the highest intensity.')
-                        i +=1
+            #scipy peak finder - run once per scan, and shared by all targets
+            peaks, properties = find_peaks(interp_intensity, height=height, threshold=threshold, distance=None, prominence=prominence, width=width, wlen=wlen)
+
+        elif mode == 'native':
+            #the raw points within the range of the common grid take the place of the grid and the interpolated intensity
+            stop = np.searchsorted(mz, common_mz_grid[-1], side='right')
+            grid, interp_intensity = mz[:stop], intensity[:stop]
+            peaks, properties = _find_peaks_native(grid, interp_intensity, height, threshold, prominence, width, window_margin) if grid.size >= 3 else (np.empty(0, dtype=int), {})
+
+        for t, (target_mz, background) in enumerate(zip(target_mzs, backgrounds)):
+
+            if mode == 'windowed':
+                grid = target_grids[t]
+                if grid.size == 0:
+                    integrations[t].append(0.0)
+                    continue
                 
-                else:
-                    if j == 0:
-                        #print(f"Peak found at m/z = {valid_peaks[0][1]} for target m/z = {target_mz}")
-                        j+=1
-
-                idx, _ = valid_peaks[0]  #'idx' is the index within 'peaks', so it's valid for accessing 'properties'
-
-                if 'left_bases' in properties and 'right_bases' in properties:
-                    left_base = properties['left_bases'][idx]
-                    right_base = properties['right_bases'][idx]
-                    
-                    #Integrate the peak using the trapezoidal rule
-                    peak_mz_range = common_mz_grid[left_base:right_base + 1]
-                    peak_intensity_range = interp_intensity[left_base:right_base + 1]
-                    integration = np.trapz(peak_intensity_range, x=peak_mz_range) - background
-                    if integration < 0:
-                        if k == 0:
-                            #print(f'Negative integration (value: {np.round(integration, 4)}) encountered for {target_mz} in the UVPD spectrum of {wavelength}nm.\nCheck your background data. Integratiions will continue for the mz, assigning values of zero for any negatives encountered.')
-                            k += 1
-                        integration = 0.0 #if total integration is not discernable from background and yields a negative number, assign an integration of zero.
-                        
-                    integrations.append(integration)
-
-                    if plot and l == 0:
-                        #Plotting the integration and peak detection only for 1 scan
-                        plt.figure(figsize=(10, 5))
-                        plt.plot(common_mz_grid, interp_intensity, label='Interpolated Intensity')
-                        plt.plot(peak_mz_range, peak_intensity_range, 'r-', label='Integration Range')
-                        plt.scatter(common_mz_grid[peaks], interp_intensity[peaks], color='orange', s=50, zorder=3, label='Detected Peaks')
-                        plt.fill_between(peak_mz_range, peak_intensity_range, color='red', alpha=0.3)
-                        plt.title(f'Peak Integration for Target m/z {target_mz} at {wavelength}nm')
-                        plt.xlabel('m/z')
-                        plt.ylabel('Intensity')
-                        plt.legend()
-                        #plt.show()
-
-                        #Set x-axis limits to only show +/- 2.0 from target_mz
-                        xlim_left = target_mz - 2.0
-                        xlim_right = target_mz + 2.0
-                        plt.xlim(xlim_left, xlim_right)
-                        
-                        #determine the maximum intensity within the x-axis range
-                        xlims = (common_mz_grid >= xlim_left) & (common_mz_grid <= xlim_right)
-                        max_intensity = np.max(interp_intensity[xlims])
-                        plt.ylim(0, max_intensity)  #set y-axis to go from 0 to the max intensity found
-
-                        #save plot to external file
-                        plt.savefig(os.path.join(directory, 'integration_plots', f'mz{np.round(target_mz, 0)}_{wavelength}nm.png'))
-                        plt.close()
-                        l += 1
+                interp_intensity = _interp_window(grid, mz, intensity)
+                peaks, properties = find_peaks(interp_intensity, height=height, threshold=threshold, distance=None, prominence=prominence, width=width, wlen=wlen)
+
+            result = _integrate_target(grid, interp_intensity, peaks, properties, target_mz, search_window, background)
 
             #if no peak is found, append an integration of zero to the integration list.
-            else:
-                if m == 0:
-                    #print(f'No valid peak found within {search_window} Da of target m/z = {target_mz} in the UVPD spectrum at {wavelength}nm.')
-                    m += 1
-                integrations.append(0.0)
+            if result is None:
+                integrations[t].append(0.0)
+                continue
+
+            integration, left_base, right_base = result
+            integrations[t].append(integration)
+
+            if plot and not plotted[t]:
+                plot_out.append(integration_plot(grid, interp_intensity, peaks, left_base, right_base, target_mz, wavelength))
+                plotted[t] = True
+
+    return [[np.mean(target_integrations) if target_integrations else 0, np.std(target_integrations) if target_integrations else 0] for target_integrations in integrations]
+
+def integrate_mzml_files(directory, mzml_files, target_mzs, search_window, parent_mz, backgrounds=None, plot=False, height=2000, threshold=2000, prominence=100.0, width=10, mode='full', n_workers=1, reporter=None, store_file=None, raw_spectrum=False, window_margin=None):
+    '''
+    Runs integrate_spectra_multi on every mzml file in mzml_files. Returns a list with the integration results of each file, in the same order as mzml_files, or False if any file fails.
+    With n_workers > 1, the files are distributed over a pool of worker processes. Each file is integrated independently, so the results are identical to processing them one after another.
+    reporter: Optional workflows.reporting.Reporter that is sent progress after every file and is polled for cancellation. When cancelled, files that have not started
+        are dropped and False is returned. In serial mode the current file stops at the next scan; worker processes finish the file they are on in the background.
+    plot: If True, the plots of each file are rendered by an IntegrationPlotStage (see workflows.integration_plots) in background processes while the next files are integrated,
+        so plotting doesn't hold up the integration. Once every file has been integrated, the plots that are still being rendered are waited for.
+    See integrate_spectra_multi for the remaining parameters.
+    '''
+    integration_args = (target_mzs, search_window, parent_mz, backgrounds, plot, height, threshold, prominence, width, mode)
+    integration_kwargs = {'store_file': store_file, 'raw_spectrum': raw_spectrum, 'window_margin': window_margin}
+
+    if reporter is not None:
+        reporter.progress(0, len(mzml_files), 'Integrating mzML files')
+
+    plot_stage = IntegrationPlotStage(directory, n_workers) if plot else None
+    try:
+        results = _integrate_files(directory, mzml_files, integration_args, integration_kwargs, n_workers, reporter, plot_stage)
+
+        #the plots of the last files may still be rendering
+        if results and plot_stage is not None and not plot_stage.finish(reporter):
+            return False
+        return results
+
+    finally:
+        if plot_stage is not None:
+            plot_stage.stop()
+
+def _integrate_and_collect_plots(directory, mzml_file, *integration_args, **integration_kwargs):
+    '''integrate_spectra_multi that returns the inputs of the file's plots along with its results, so that they can be rendered by an IntegrationPlotStage'''
+    plots = []
+    return integrate_spectra_multi(directory, mzml_file, *integration_args, plot_out=plots, **integration_kwargs), plots
+
+def _integrate_files(directory, mzml_files, integration_args, integration_kwargs, n_workers, reporter, plot_stage):
+    '''The integration loop of integrate_mzml_files. The plots of every file that has been integrated are handed to plot_stage, if there is one.'''
+    results = [None] * len(mzml_files)
+    stage = 'Integrating mzML files'
+
+    #process files one after another on the calling thread
+    if n_workers <= 1 or len(mzml_files) <= 1:
+        cancelled = reporter.cancelled if reporter is not None else None
+
+        for i, mzml_file in enumerate(mzml_files):
+            mzml_runstart = time.time()
+            results[i], plots = _integrate_and_collect_plots(directory, mzml_file, *integration_args, cancelled=cancelled, **integration_kwargs)
+
+            if cancelled is not None and cancelled():
+                print('Integration cancelled by user.')
+                process_events()
+                return False
+
+            if not results[i]:
+                print(f'Integration of the mass spectra in {mzml_file} failed. Analysis will be stopped.')
+                process_events()
+                return False
+
+            print(f'Integration of {mzml_file} has completed in {np.round((time.time() - mzml_runstart),2)} seconds ({i+1}/{len(mzml_files)}).')
+            process_events()
+
+            if plot_stage is not None:
+                plot_stage.submit(plots)
+
+            if reporter is not None:
+                reporter.progress(i + 1, len(mzml_files), stage)
+
+        return results
+
+    #process files in parallel. Results are gathered by index so that they stay in the order of mzml_files regardless of which worker finishes first.
+    n_workers = min(int(n_workers), len(mzml_files))
+    print(f'Integrating {len(mzml_files)} mzML files using {n_workers} worker processes...')
+    process_events()
+
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+    cancelled = False
+    try:
+        futures = {executor.submit(_integrate_and_collect_plots, directory, mzml_file, *integration_args, **integration_kwargs): i for i, mzml_file in enumerate(mzml_files)}
+        pending = set(futures)
+        files_done = 0
+
+        #wait with a timeout (rather than as_completed) so that a cancel request is noticed while long files are still running
+        while pending:
+            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+
+            if reporter is not None and reporter.cancelled():
+                cancelled = True
+                print('Integration cancelled by user. Files that are already being integrated will finish in the background.')
+                process_events()
+                return False
+
+            for future in done:
+                i = futures[future]
+
+                try:
+                    results[i], plots = future.result()
+                except Exception as e:
+                    print(f'Problem encountered when integrating the mass spectra in {mzml_files[i]}:\n{e}')
+                    process_events()
+                    return False
+
+                if not results[i]:
+                    print(f'Integration of the mass spectra in {mzml_files[i]} failed. Analysis will be stopped.')
+                    process_events()
+                    return False
+
+                files_done += 1
+                print(f'Integration of {mzml_files[i]} has completed ({files_done}/{len(mzml_files)}).')
+                process_events()
+
+                if plot_stage is not None:
+                    plot_stage.submit(plots)
+
+                if reporter is not None:
+                    reporter.progress(files_done, len(mzml_files), stage)
+
+    finally:
+        #on failure or cancel, don't start any files that are still queued. A cancelled run doesn't wait for the files that are in progress.
+        executor.shutdown(wait=not cancelled, cancel_futures=True)
+
+    return results
+
+def inspect_integration(directory, mzml_file, target_mz, search_window, parent_mz, background=0.0, height=2000, threshold=2000, prominence=100.0, width=10, mode='full', store_file=None, window_margin=None):
+    '''
+    Integrates one target of one mzml file on demand, e.g., to look at it in the integration inspector of the QTRAP 5500 tab. The spectra are read from the experiment store
+    or the spectrum cache, and nothing else is written to disk: neither the results cache nor a plot file.
+    Returns ([average integration, stdev], plot), where plot holds the inputs of the integration plot of the first scan with a valid peak (see workflows.integration_plots.integration_plot),
+    or None if no scan has one. Returns False on error. See integrate_spectra_multi for the parameters.
+    '''
+    plots = []
+    results = integrate_spectra_multi(directory, mzml_file, [target_mz], search_window, parent_mz, [background], True, height, threshold, prominence, width, mode, window_margin,
+                                      store_file=store_file, use_results_cache=False, plot_out=plots)
+    if results is False:
+        return False
+    return results[0], (plots[0] if plots else None)
+
+#Function to integrate mass spectra within specified bounds using NumPy
+def integrate_spectra(directory, mzml_file, target_mz, search_window, parent_mz, background = 0.0, plot=False, height=2000, threshold=2000, prominence=100.0, width=10):
+    '''
+    Integrates the mass spectra from mzml files around peaks detected near a specified m/z using a common interpolated grid and SciPy's peak detection.
+    Optional plotting to visualize peak detection and integration. Single-target wrapper around integrate_spectra_multi.
+    
+    Parameters:
+        directory: Directory containing mzml files.
+        mzml_file: Name of mzml file.
+        target_mz: Target m/z value to find and integrate the peak.
+        search_window: Window size around the target m/z to limit the search for the peak.
+        parent_mz: m/z of the parent ion used to set the upper limit of the m/z range for the common grid.
+        background: The amount of background fragmentation that you wish to be subtracted from the integration.
+        plot: If True, plots the spectrum with peak detection and integration area highlighted.
+        height, threshold, prominence, width: scipy peakfind parameters with defaults of 2000, 2000, 100, and 10, respectively.
+    '''
+
+    integration_results = integrate_spectra_multi(directory, mzml_file, [target_mz], search_window, parent_mz, [background], plot, height, threshold, prominence, width)
+    
+    if not integration_results:
+        return False
+
+    return integration_results[0]
+
+def benchmark_integration_modes(mzml_directory, target_mzs, search_window, parent_mz, modes=INTEGRATION_MODES, height=2000, threshold=2000, prominence=100.0, width=10):
+    '''Times every integration mode on the mzML files in a directory, and compares the average integration of each target and file with the 'full' mode (interpolation onto the whole 0.01 Da grid)'''
+    mzml_files = sorted(f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')) if os.path.isdir(mzml_directory) else []
+    if not mzml_files:
+        print(f'There are no .mzml files in {mzml_directory} to benchmark. Extract the Example .wiff files first.')
+        return
+
+    #decode every file (and fill the spectrum cache) beforehand, so that only the integration is timed
+    n_scans = sum(len(load_spectra_arrays(os.path.join(mzml_directory, mzml_file))[2]) - 1 for mzml_file in mzml_files)
+    print(f'{len(mzml_files)} mzML files, {n_scans} scans, {len(target_mzs)} targets')
+
+    timings = {}
+    integrations = {}
+    for mode in modes:
+        stime = time.perf_counter()
+        results = [integrate_spectra_multi(mzml_directory, mzml_file, target_mzs, search_window, parent_mz, None, False, height, threshold, prominence, width, mode) for mzml_file in mzml_files]
+        timings[mode] = time.perf_counter() - stime
+        integrations[mode] = np.array(results, dtype=float)[:, :, 0] #(n_files, n_targets) average integrations
 
-            spec_counter += 1
+    reference_mode = 'full' if 'full' in modes else modes[0]
+    reference = integrations[reference_mode]
 
-    avg_integration = np.mean(integrations) if integrations else 0
-    std_dev = np.std(integrations) if integrations else 0
+    for mode in modes:
+        found_by_one = np.count_nonzero((integrations[mode] > 0) != (reference > 0))
+        both = (integrations[mode] > 0) & (reference > 0)
+        relative_difference = np.abs(integrations[mode][both] - reference[both]) / reference[both]
+        accuracy = f'max/median rel. difference {relative_difference.max():.2e}/{np.median(relative_difference):.2e}' if relative_difference.size else 'no peaks to compare'
+        print(f'{mode:>9}: {np.round(timings[mode], 2)}s ({np.round(timings[reference_mode] / max(timings[mode], 1e-9), 1)}x vs {reference_mode}), {accuracy}, peak found by only one mode: {found_by_one}')
 
-    return [avg_integration, std_dev] 
+if __name__ == '__main__':
+    #Usage: python -m workflows.integrate_mzml mzml_directory parent_mz search_window [fragment_mz ...]
+    if len(sys.argv) < 4:
+        print('Usage: python -m workflows.integrate_mzml mzml_directory parent_mz search_window [fragment_mz ...]')
+    else:
+        benchmark_integration_modes(sys.argv[1], [float(mz) for mz in [sys.argv[2]] + sys.argv[4:]], float(sys.argv[3]), float(sys.argv[2]))
@@ -0,0 +1,166 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from workflows.reporting import process_events
+
+#The integration plots show target_mz +/- PLOT_X_RANGE. Only that part of the spectrum is kept for a plot, so the inputs of a plot are a few hundred points.
+PLOT_X_RANGE = 2.0
+
+#Number of plots sent to a rendering process at a time
+PLOT_BATCH_SIZE = 8
+
+def integration_plot(grid, intensity, peaks, left_base, right_base, target_mz, wavelength):
+    '''
+    Collects the inputs of the integration plot of one target: the spectrum (grid, intensity) with its detected peaks (indices into grid), and the integration range
+    between the grid indices left_base and right_base. Returns a dict that render_integration_plots turns into mzml_directory/integration_plots/mz<target>_<wavelength>nm.png.
+    '''
+    shown = np.flatnonzero((grid >= target_mz - PLOT_X_RANGE) & (grid <= target_mz + PLOT_X_RANGE))
+
+    #one point beyond the x-axis range on each side, so that the line runs to the edge of the plot
+    start = max(shown[0] - 1, 0) if shown.size else 0
+    stop = min(shown[-1] + 2, len(grid)) if shown.size else len(grid)
+    peaks = np.asarray(peaks, dtype=int)
+    peaks = peaks[(peaks >= start) & (peaks < stop)] - start
+
+    return {'target_mz': target_mz, 'wavelength': wavelength, 'mz': np.array(grid[start:stop]), 'intensity': np.array(intensity[start:stop]), 'peaks': peaks,
+            'range_mz': np.array(grid[left_base:right_base + 1]), 'range_intensity': np.array(intensity[left_base:right_base + 1]),
+            'max_intensity': float(np.max(intensity[shown])) if shown.size else None}
+
+def plot_file(directory, plot):
+    '''The .png file of an integration plot'''
+    return os.path.join(directory, 'integration_plots', f'mz{np.round(plot["target_mz"], 0)}_{plot["wavelength"]}nm.png')
+
+class IntegrationPlotRenderer:
+    '''
+    Renders integration plots with the Agg backend. The figure and its artists are made once and only their data is replaced for every plot,
+    which is much faster than making a new pyplot figure for each one. pyplot is not used, so rendering never touches the GUI's event loop.
+    figure: Optional matplotlib Figure to draw into instead, e.g., the figure of a canvas embedded in the GUI (see the integration inspector of the QTRAP 5500 tab).
+    '''
+    def __init__(self, figure=None):
+        #imported here since it is only needed when plotting, and it is slow to import in every worker process
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        if figure is None:
+            figure = Figure(figsize=(10, 5))
+            FigureCanvasAgg(figure)
+        self.figure = figure
+        self.axes = self.figure.add_subplot()
+
+        self.spectrum_line, = self.axes.plot([], [], label='Interpolated Intensity')
+        self.range_line, = self.axes.plot([], [], 'r-', label='Integration Range')
+        self.peak_markers = self.axes.scatter([], [], color='orange', s=50, zorder=3, label='Detected Peaks')
+        self.range_fill = self.axes.fill_between([], [], color='red', alpha=0.3)
+        self.axes.set_xlabel('m/z')
+        self.axes.set_ylabel('Intensity')
+        self.axes.legend()
+
+    def render(self, plot, path):
+        '''Draws one plot (see integration_plot) and saves it to path'''
+        self.draw(plot)
+        self.figure.savefig(path)
+
+    def draw(self, plot):
+        '''Replaces the data of the figure with one plot (see integration_plot). The figure isn't redrawn until it is saved or its canvas is drawn.'''
+        target_mz, wavelength = plot['target_mz'], plot['wavelength']
+
+        self.spectrum_line.set_data(plot['mz'], plot['intensity'])
+        self.range_line.set_data(plot['range_mz'], plot['range_intensity'])
+        self.peak_markers.set_offsets(np.column_stack([plot['mz'][plot['peaks']], plot['intensity'][plot['peaks']]]))
+
+        #a filled area can't be given new data, so it is replaced
+        self.range_fill.remove()
+        self.range_fill = self.axes.fill_between(plot['range_mz'], plot['range_intensity'], color='red', alpha=0.3)
+
+        self.axes.set_title(f'Peak Integration for Target m/z {target_mz} at {wavelength}nm')
+
+        #Set x-axis limits to only show +/- 2.0 from target_mz, and the y-axis to go from 0 to the max intensity in that range
+        self.axes.set_xlim(target_mz - PLOT_X_RANGE, target_mz + PLOT_X_RANGE)
+        if plot['max_intensity'] is not None:
+            self.axes.set_ylim(0, plot['max_intensity'])
+
+#one renderer per process, made by the first plot it renders
+_renderer = None
+
+def render_integration_plots(directory, plots):
+    '''Renders a list of integration plots (see integration_plot) to directory/integration_plots in the calling process. Returns the number of plots rendered.'''
+    global _renderer
+    if _renderer is None:
+        _renderer = IntegrationPlotRenderer()
+
+    for plot in plots:
+        _renderer.render(plot, plot_file(directory, plot))
+    return len(plots)
+
+class IntegrationPlotStage:
+    '''
+    Renders integration plots in n_workers background processes while the integration goes on. The integration hands over the inputs of each file's plots
+    with submit() as soon as the file has been integrated, and finish() waits for the plots that are still being rendered once every file has been integrated.
+    A plot that fails to render is reported, but doesn't stop the analysis: the plots are for validation only, and the integration results are unaffected.
+    '''
+    def __init__(self, directory, n_workers=1):
+        self.directory = directory
+        self.executor = ProcessPoolExecutor(max_workers=max(int(n_workers), 1))
+        self.futures = {} #future -> number of plots
+        self.n_rendered = 0
+        self.n_failed = 0
+
+    def submit(self, plots):
+        '''Queues plots for rendering'''
+        for start in range(0, len(plots), PLOT_BATCH_SIZE):
+            batch = plots[start:start + PLOT_BATCH_SIZE]
+            self.futures[self.executor.submit(render_integration_plots, self.directory, batch)] = len(batch)
+
+    def _collect(self, future):
+        n_plots = self.futures.pop(future)
+        try:
+            self.n_rendered += future.result()
+        except Exception as e:
+            self.n_failed += n_plots
+            print(f'Problem encountered when rendering {n_plots} integration plots:\n{e}\nThe integration results are not affected.')
+            process_events()
+
+    def finish(self, reporter=None):
+        '''Waits for every queued plot to be rendered. Returns False if the reporter cancels before they are, True otherwise.'''
+        stage = 'Rendering integration plots'
+        n_plots = self.n_rendered + self.n_failed + sum(self.futures.values())
+        last_progress = None
+        try:
+            for future in [future for future in self.futures if future.done()]:
+                self._collect(future)
+
+            if self.futures:
+                print(f'Integration has completed. Waiting for {sum(self.futures.values())} of {n_plots} integration plots to be rendered...')
+                process_events()
+
+            while self.futures:
+                #only when a plot has been rendered since the last update, so the log isn't repeated on every poll
+                progress = self.n_rendered + self.n_failed
+                if reporter is not None and progress != last_progress:
+                    reporter.progress(progress, n_plots, stage, unit='plots')
+                    last_progress = progress
+
+                done, _ = wait(list(self.futures), timeout=0.25, return_when=FIRST_COMPLETED)
+
+                if reporter is not None and reporter.cancelled():
+                    print('Rendering of the integration plots cancelled by user.')
+                    process_events()
+                    return False
+
+                for future in done:
+                    self._collect(future)
+
+            if reporter is not None:
+                reporter.progress(n_plots, n_plots, stage, unit='plots')
+
+            print(f'{self.n_rendered} integration plots have been written to {os.path.join(self.directory, "integration_plots")}.')
+            process_events()
+            return True
+
+        finally:
+            self.stop()
+
+    def stop(self):
+        '''Drops the plots that haven't started rendering, without waiting for the ones that have'''
+        self.executor.shutdown(wait=False, cancel_futures=True)
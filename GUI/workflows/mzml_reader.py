@@ -0,0 +1,165 @@
+import os, sys, time, base64, zlib
+import numpy as np
+from lxml import etree
+
+#PSI-MS controlled vocabulary accessions needed to decode a binaryDataArray
+BINARY_DTYPES = {
+    'MS:1000521': np.dtype('<f4'), #32-bit float
+    'MS:1000523': np.dtype('<f8'), #64-bit float
+    'MS:1000519': np.dtype('<i4'), #32-bit integer
+    'MS:1000522': np.dtype('<i8'), #64-bit integer
+}
+ZLIB_COMPRESSION = 'MS:1000574'
+NUMPRESS_COMPRESSIONS = ('MS:1002312', 'MS:1002313', 'MS:1002314', 'MS:1002746', 'MS:1002747', 'MS:1002748') #linear, pic, slof (+ zlib variants)
+MZ_ARRAY = 'MS:1000514'
+INTENSITY_ARRAY = 'MS:1000515'
+SCAN_START_TIME = 'MS:1000016'
+UNIT_SECONDS = 'UO:0000010'
+
+class UnsupportedEncodingError(ValueError):
+    '''Raised when a binary array uses an encoding that the streaming reader does not decode (e.g., MS-Numpress)'''
+
+def _local_name(tag):
+    '''Strips the namespace from an lxml tag. Comments and processing instructions (whose tags are not strings) return an empty string.'''
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
+
+def _accessions(element, param_groups):
+    '''Returns the cvParam accessions of an element, including those pulled in through referenceableParamGroupRefs'''
+    accessions = []
+    for child in element:
+        name = _local_name(child.tag)
+        if name == 'cvParam':
+            accessions.append(child.get('accession'))
+        elif name == 'referenceableParamGroupRef':
+            accessions.extend(param_groups.get(child.get('ref'), []))
+    return accessions
+
+def _decode_binary_array(binary_data_array, param_groups):
+    '''Decodes a single binaryDataArray element. Returns (array type accession, decoded NumPy array) in the array's native dtype.'''
+    dtype = None
+    compressed = False
+    array_type = None
+
+    for accession in _accessions(binary_data_array, param_groups):
+        if accession in BINARY_DTYPES:
+            dtype = BINARY_DTYPES[accession]
+        elif accession == ZLIB_COMPRESSION:
+            compressed = True
+        elif accession in NUMPRESS_COMPRESSIONS:
+            raise UnsupportedEncodingError('MS-Numpress compressed arrays are not supported by the streaming reader.')
+        elif accession in (MZ_ARRAY, INTENSITY_ARRAY):
+            array_type = accession
+
+    if array_type is None:
+        return None, None
+
+    if dtype is None:
+        raise UnsupportedEncodingError('A binary data array does not declare its precision.')
+
+    binary_text = None
+    for child in binary_data_array:
+        if _local_name(child.tag) == 'binary':
+            binary_text = child.text
+            break
+
+    if not binary_text:
+        return array_type, np.empty(0, dtype=dtype)
+
+    raw = base64.b64decode(binary_text)
+    if compressed:
+        raw = zlib.decompress(raw)
+
+    return array_type, np.frombuffer(raw, dtype=dtype)
+
+def _retention_time(spectrum, param_groups):
+    '''Returns the scan start time of a spectrum in minutes, or None if it is not given'''
+    for scan in spectrum.iter('{*}scan'):
+        for child in scan:
+            if _local_name(child.tag) == 'cvParam' and child.get('accession') == SCAN_START_TIME:
+                rt = float(child.get('value'))
+                return rt / 60. if child.get('unitAccession') == UNIT_SECONDS else rt
+    return None
+
+def iter_mzml(mzml_path):
+    '''
+    Streams an mzML file and yields (scan index, retention time in minutes, m/z array, intensity array) for every spectrum.
+    Only the m/z and intensity binary arrays are decoded; all other cvParams are skipped. Each spectrum element is cleared once it has been
+    decoded, so memory use does not grow with the number of scans in the file. m/z arrays are returned as float64, intensity arrays in the
+    precision they were written with (e.g., float32 when msconvert was run with --inten32).
+    '''
+    param_groups = {} #referenceableParamGroup id -> list of accessions
+
+    context = etree.iterparse(mzml_path, events=('end',), tag=('{*}referenceableParamGroup', '{*}spectrum'), huge_tree=True)
+
+    for _, element in context:
+
+        if _local_name(element.tag) == 'referenceableParamGroup':
+            param_groups[element.get('id')] = [child.get('accession') for child in element if _local_name(child.tag) == 'cvParam']
+            continue
+
+        mz = intensity = None
+        for binary_data_array in element.iter('{*}binaryDataArray'):
+            array_type, array = _decode_binary_array(binary_data_array, param_groups)
+            if array_type == MZ_ARRAY:
+                mz = array.astype(float, copy=False)
+            elif array_type == INTENSITY_ARRAY:
+                intensity = array
+
+        scan_index = int(element.get('index', -1))
+        if mz is None or intensity is None:
+            raise ValueError(f'Spectrum number {scan_index+1} in {os.path.basename(mzml_path)} does not contain both an m/z and an intensity array.')
+
+        retention_time = _retention_time(element, param_groups)
+
+        #free the decoded element and any siblings that have already been processed so that memory stays flat
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+        yield scan_index, retention_time, mz, intensity
+
+    del context
+
+def benchmark_readers(mzml_directory):
+    '''Times the streaming reader against pyteomics.mzml.read on every mzML file in a directory and checks that both return identical arrays'''
+    import pyteomics.mzml as mzml
+
+    mzml_files = sorted(f for f in os.listdir(mzml_directory) if f.lower().endswith('.mzml')) if os.path.isdir(mzml_directory) else []
+    if not mzml_files:
+        print(f'There are no .mzml files in {mzml_directory} to benchmark. Extract the Example .wiff files first.')
+        return
+
+    pyteomics_time = streaming_time = 0.
+    n_scans = 0
+    mismatches = 0
+
+    for mzml_file in mzml_files:
+        mzml_path = os.path.join(mzml_directory, mzml_file)
+
+        stime = time.perf_counter()
+        with mzml.read(mzml_path) as spectra:
+            reference = [(spectrum['m/z array'], spectrum['intensity array']) for spectrum in spectra]
+        pyteomics_time += time.perf_counter() - stime
+
+        stime = time.perf_counter()
+        streamed = [(mz, intensity) for _, _, mz, intensity in iter_mzml(mzml_path)]
+        streaming_time += time.perf_counter() - stime
+
+        n_scans += len(reference)
+        if len(reference) != len(streamed):
+            mismatches += 1
+            continue
+        for (ref_mz, ref_int), (mz, intensity) in zip(reference, streamed):
+            if not (np.array_equal(ref_mz, mz) and np.array_equal(ref_int, intensity)):
+                mismatches += 1
+                break
+
+    print(f'{len(mzml_files)} mzML files, {n_scans} scans')
+    print(f'pyteomics.mzml.read: {np.round(pyteomics_time, 2)}s')
+    print(f'streaming reader:    {np.round(streaming_time, 2)}s ({np.round(pyteomics_time / max(streaming_time, 1e-9), 1)}x faster)')
+    print(f'Files with mismatched arrays: {mismatches}')
+
+if __name__ == '__main__':
+    #Usage: python -m workflows.mzml_reader [mzml_directory]. Defaults to the extracted Example sweep.
+    default_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), 'Example', 'mzml_directory')
+    benchmark_readers(sys.argv[1] if len(sys.argv) > 1 else default_directory)
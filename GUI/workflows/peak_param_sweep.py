@@ -0,0 +1,172 @@
+import os, itertools, time, traceback
+import numpy as np
+import pandas as pd
+
+from workflows.integrate_mzml import INTEGRATION_MODES, _common_mz_grid, _base_wlen, _window_grids, _interp_scans, _find_peaks_batched, _integrate_rows, integrate_spectra_multi
+from workflows.experiment_store import ExperimentStore
+from workflows.reporting import process_events
+from workflows.spectrum_cache import load_spectra_arrays
+
+#scipy peak finder parameters that can be swept, in the order they are combined
+SWEEP_PARAMETERS = ('height', 'threshold', 'prominence', 'width')
+
+#Integration modes whose results the vectorized sweep reproduces on the interpolated windows. 'full' only does so with window_margin, which keeps its peak bases inside the windows.
+SHARED_INTERPOLATION_MODES = ('windowed', 'batched')
+
+def parse_sweep_values(text, var_name):
+    '''Parses a comma-separated list of values for one peak finder parameter (e.g., "1000, 2000, 5000"). Returns a sorted list of unique floats, or False if an entry is non-numeric or negative.'''
+    values = []
+    for entry in text.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        try:
+            value = float(entry)
+        except ValueError:
+            print(f'The sweep values for the {var_name} contain a non-numeric entry: {entry}.')
+            process_events()
+            return False
+
+        if value < 0:
+            print(f'The sweep values for the {var_name} contain a negative value ({entry}), which is impossible.')
+            process_events()
+            return False
+
+        values.append(value)
+
+    if not values:
+        print(f'No sweep values were given for the {var_name}.')
+        process_events()
+        return False
+
+    return sorted(set(values))
+
+def sweep_peak_parameters(directory, mzml_files, target_mzs, search_window, parent_mz, backgrounds, sweep_values, window_margin=None, reporter=None, store_file=None, mode='full'):
+    '''
+    Integrates the parent and fragment peaks of every mzml file for every combination of peak finder parameters in sweep_values, in the integration mode of the analysis.
+    In the SHARED_INTERPOLATION_MODES (and 'full' with window_margin), each file is decoded (or read from the spectrum cache) and interpolated onto the window around each target only once;
+    every setting is then evaluated against the same interpolated array with the vectorized peak finder used by the 'batched' integration mode, so the results of
+    each setting are the same as a run in that mode with those parameters (see integrate_spectra_multi).
+    In the other modes, every setting is integrated by integrate_spectra_multi instead. This is slower, since only the decoding of the files is shared by the settings.
+
+    Parameters:
+        directory: Directory containing mzml files.
+        mzml_files: List of mzml file names.
+        target_mzs: List of target m/z values (e.g., [parent_mz, frag1, frag2, ...]).
+        search_window: Window size around each target m/z to limit the search for the peak.
+        parent_mz: m/z of the parent ion used to set the upper limit of the m/z range for the common grid.
+        backgrounds: List of background fragmentation values to be subtracted from the integration of each target.
+        sweep_values: dict of {'height': [...], 'threshold': [...], 'prominence': [...], 'width': [...]}. Every combination of the values is evaluated.
+        window_margin: Optional m/z on each side of a peak within which its bases are searched, as in integrate_spectra_multi. None searches the whole spectrum.
+        reporter: Optional workflows.reporting.Reporter that receives progress after every file and is polled for cancellation.
+        store_file: Optional experiment store (see workflows.experiment_store) that the spectra are read from instead of the mzml files.
+        mode: Integration mode (one of INTEGRATION_MODES) that the settings are evaluated in.
+
+    Returns (settings, means, stdevs), where settings is a list of (height, threshold, prominence, width) tuples and means/stdevs are
+    (n_settings, n_files, n_targets) arrays of the average integration over all scans and its stdev. Returns False on error or cancel.
+    '''
+    if mode not in INTEGRATION_MODES:
+        print(f'Unknown integration mode "{mode}". Please choose one of: {", ".join(INTEGRATION_MODES)}.')
+        process_events()
+        return False
+
+    settings = list(itertools.product(*(sweep_values[parameter] for parameter in SWEEP_PARAMETERS)))
+    means = np.zeros((len(settings), len(mzml_files), len(target_mzs)))
+    stdevs = np.zeros_like(means)
+
+    target_grids = _window_grids(_common_mz_grid(parent_mz), target_mzs, search_window, window_margin)
+    wlen = _base_wlen(window_margin)
+    stage = f'Sweeping {len(settings)} peak finder settings'
+
+    if reporter is not None:
+        reporter.progress(0, len(mzml_files), stage)
+
+    for k, mzml_file in enumerate(mzml_files):
+        mzml_runstart = time.time()
+
+        #every setting is a regular integration of the file (the decoded spectra are shared through the spectrum cache or the experiment store)
+        if mode not in SHARED_INTERPOLATION_MODES and not (mode == 'full' and window_margin is not None):
+            if not _sweep_file_integrated(directory, mzml_file, target_mzs, search_window, parent_mz, backgrounds, settings, window_margin, mode, means[:, k], stdevs[:, k], reporter, store_file):
+                return False
+
+        else:
+            try:
+                if store_file is not None:
+                    mz_all, intensity_all, offsets = ExperimentStore(store_file).file_arrays(mzml_file)
+                else:
+                    mz_all, intensity_all, offsets = load_spectra_arrays(os.path.join(directory, mzml_file))
+                intensity_all = intensity_all.astype(float, copy=False) #32-bit intensities (msconvert --inten32) are widened once here rather than in every np.interp call
+
+            except Exception as e:
+                print(f'Error encounter when extracting m/z and intensity arrays from {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}')
+                process_events()
+                return False
+
+            for t, (target_mz, background, grid) in enumerate(zip(target_mzs, backgrounds, target_grids)):
+
+                #the interpolation is shared by every setting, only the peak finding and integration are repeated
+                interp_intensity = _interp_scans(grid, mz_all, intensity_all, offsets)
+
+                for s, (height, threshold, prominence, width) in enumerate(settings):
+                    if reporter is not None and reporter.cancelled():
+                        print('Parameter sweep cancelled by user.')
+                        process_events()
+                        return False
+
+                    found, peak, left_base, right_base = _find_peaks_batched(interp_intensity, grid, target_mz, search_window, height, threshold, prominence, width, wlen)
+                    integrations = np.maximum(_integrate_rows(interp_intensity, grid, found, left_base, right_base) - np.where(found, background, 0.), 0.)
+
+                    if integrations.size:
+                        means[s, k, t] = np.mean(integrations)
+                        stdevs[s, k, t] = np.std(integrations)
+
+        print(f'{mzml_file} has been evaluated for {len(settings)} peak finder settings in {np.round((time.time() - mzml_runstart),2)} seconds ({k+1}/{len(mzml_files)}).')
+        process_events()
+
+        if reporter is not None:
+            reporter.progress(k + 1, len(mzml_files), stage)
+
+    return settings, means, stdevs
+
+def _sweep_file_integrated(directory, mzml_file, target_mzs, search_window, parent_mz, backgrounds, settings, window_margin, mode, means, stdevs, reporter, store_file):
+    '''Sweep of one mzml file in a mode that isn't one of the SHARED_INTERPOLATION_MODES: integrates the file with integrate_spectra_multi for every setting and fills means and stdevs ((n_settings, n_targets) arrays). Returns False on error or cancel.'''
+    for s, (height, threshold, prominence, width) in enumerate(settings):
+        if reporter is not None and reporter.cancelled():
+            print('Parameter sweep cancelled by user.')
+            process_events()
+            return False
+
+        results = integrate_spectra_multi(directory, mzml_file, target_mzs, search_window, parent_mz, backgrounds, False, height, threshold, prominence, width, mode, window_margin,
+                                          store_file=store_file, use_results_cache=False)
+        if results is False:
+            return False
+        means[s], stdevs[s] = np.array(results, dtype=float).reshape(len(target_mzs), 2).T
+
+    return True
+
+def sweep_total_PE(settings, wavelengths, means, stdevs, PE_function, laser_power, laser_power_stdev):
+    '''
+    Calculates the total photofragmentation efficiency at every wavelength for every setting returned by sweep_peak_parameters.
+    Target 0 is the parent ion and the remaining targets are the fragments. PE_function is one of the vectorized functions in workflows.calc_PE, and
+    laser_power and laser_power_stdev hold the power of each wavelength (ignored by PE_calc_noNorm_vectorized). Returns a long-format DataFrame with one row per setting and wavelength.
+    '''
+    n_settings, n_wavelengths = means.shape[:2]
+
+    #(n_settings, n_wavelengths) matrices. The stdevs of the fragments are propagated as the square root of the sum of squares.
+    parent, parent_stdev = means[:, :, 0], stdevs[:, :, 0]
+    total_fragment = means[:, :, 1:].sum(axis=2)
+    total_fragment_stdev = np.sqrt(np.square(stdevs[:, :, 1:]).sum(axis=2))
+
+    Total_PE, Total_PE_stdev = PE_function(np.asarray(wavelengths, dtype=float), laser_power, laser_power_stdev, parent, parent_stdev, total_fragment, total_fragment_stdev) #W, P, dP, Par, dPar, Frag, dFrag
+
+    sweep_df = pd.DataFrame(np.repeat(np.asarray(settings, dtype=float).reshape(n_settings, len(SWEEP_PARAMETERS)), n_wavelengths, axis=0), columns=[parameter.capitalize() for parameter in SWEEP_PARAMETERS])
+    sweep_df['Wavelength'] = np.tile(np.asarray(wavelengths, dtype=float), n_settings)
+    sweep_df['Parent integration'] = parent.ravel()
+    sweep_df['Parent integration stdev'] = parent_stdev.ravel()
+    sweep_df['Total fragment integration'] = total_fragment.ravel()
+    sweep_df['Total fragment integration stdev'] = total_fragment_stdev.ravel()
+    sweep_df['Total PE'] = Total_PE.ravel()
+    sweep_df['Total PE stdev'] = Total_PE_stdev.ravel()
+
+    return sweep_df
@@ -1,28 +1,29 @@
 import os
 import traceback
-from PyQt6.QtWidgets import QApplication
+
+from workflows.reporting import process_events
 
 def preprocessing_5500(directory, parent_mz, search_window, frag_list_file, extract_mzml_flag, PowerNorm_flag, power_file, extract_raw_data_flag, plot_flag, height, threshold, prominence, width):
 
     def check_empty_negative_and_non_numeric(entry, var_name):
-        '''A function to check whether values are negative or contain non-numeric characters'''
-        if not entry:
+        '''A function to check whether values are negative or contain non-numeric characters. Zero is a valid value (e.g., a threshold of 0).'''
+        if entry is None or entry == '':
             print(f'The field for the {var_name} is empty!')
-            QApplication.processEvents()
+            process_events()
             return False
 
         try:
             if float(entry) < 0:
                 print(f'The {var_name} has been assigned a negative value, which is impossible.')
-                QApplication.processEvents()
+                process_events()
                 return False
         except ValueError:
             print(f'The field for the {var_name} contains non-numeric characters!')
-            QApplication.processEvents()
+            process_events()
             return False
         except Exception as e:
             print(f'Error parsing the input for {var_name}: {e}\nTraceback: {traceback.format_exc()}\n')
-            QApplication.processEvents()
+            process_events()
             return False
 
         return True
@@ -31,14 +32,14 @@ def preprocessing_5500(directory, parent_mz, search_window, frag_list_file, extr
         '''A function to check whether an entry is empty (like a directory or filepath)'''
         if not entry:
             print(f'The field for the {var_name} is empty!')
-            QApplication.processEvents()
+            process_events()
             return False
         return True
 
     ###Directory###
     if not check_empty_only(directory, 'directory') or not os.path.isdir(directory):
         print(f'The directory provided does not exist!')
-        QApplication.processEvents()
+        process_events()
         return False
 
     ###parent m/z###
@@ -54,7 +55,7 @@ def preprocessing_5500(directory, parent_mz, search_window, frag_list_file, extr
     if PowerNorm_flag:
         if not check_empty_only(power_file, 'power file') or not os.path.isfile(power_file):
             print('The power data file could not be found. Please check that you have specified the directory and file name (with its extension!) properly.')
-            QApplication.processEvents()
+            process_events()
             return False
 
         #Read the CSV and verify its contents are in the right format
@@ -65,7 +66,7 @@ def preprocessing_5500(directory, parent_mz, search_window, frag_list_file, extr
                     line = line.strip().split(',')
                     if len(line) != 3:
                         print(f'This line in the power file {os.path.basename(power_file)}: {line}\ndoes not meet the required format. Each row must only contain three numeric values with the following format:\nWavelength(nm), Laser power, and the StDev of the laser power.')
-                        QApplication.processEvents()
+                        process_events()
                         power_file_checks_passed = False
                         break
 
@@ -75,7 +76,7 @@ def preprocessing_5500(directory, parent_mz, search_window, frag_list_file, extr
     ###Fragments file###
     if not os.path.isfile(frag_list_file):
         print(f'The fragment file {os.path.basename(frag_list_file)} does not exist. Please provide a valid file path, including the directory.')
-        QApplication.processEvents()
+        process_events()
         return False
 
     #Scipy peak finding parameters
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+from workflows.reporting import process_events
+
+#What to do with the wavelengths that fail a quality control check:
+#   flag: keep them and record them in the QC sheet of the output (the default, so that unattended runs don't stop)
+#   ask: ask once, after every wavelength has been checked, whether to continue (and flag them) or abort. Unattended runs answer with the reporter's default (abort).
+#   skip: leave them out of the results and record them in the QC sheet
+#   abort: stop the analysis
+QC_ACTIONS = ('flag', 'ask', 'skip', 'abort')
+QC_COLUMNS = ['Wavelength', 'Check', 'Value', 'Limit', 'Action']
+MIN_PARENT_INTEGRAL = 100000.
+
+def run_qc_checks(wavelengths, integrations, min_parent_integral=MIN_PARENT_INTEGRAL):
+    '''
+    Checks the integrations of every wavelength at once. integrations is the (n_wavelengths, n_targets, 2) array of [average integration, stdev] of the analysis,
+    where target 0 is the parent ion. Returns a DataFrame with one row (QC_COLUMNS) per failed check; the Action column is filled in by apply_qc_policy.
+    Checks:
+        Low parent integration: the parent ion integration is below min_parent_integral (or not a number), e.g., the parent m/z is wrong or the ion signal dropped out.
+    '''
+    parent_integrations = np.asarray(integrations, dtype=float)[:, 0, 0]
+    failed = ~(parent_integrations >= min_parent_integral) #also catches NaN
+
+    flags = pd.DataFrame({'Wavelength': np.asarray(wavelengths, dtype=float)[failed], 'Check': 'Low parent integration', 'Value': parent_integrations[failed],
+                          'Limit': float(min_parent_integral), 'Action': ''}, columns=QC_COLUMNS)
+    return flags
+
+def apply_qc_policy(reporter, flags, wavelengths, qc_action='flag', parent_mz=None):
+    '''
+    Applies qc_action (one of QC_ACTIONS) to the wavelengths flagged by run_qc_checks, and records what was done in the Action column of flags.
+    Returns a boolean array that is True for the wavelengths to keep, or None if the analysis should be aborted.
+    '''
+    keep = np.ones(len(wavelengths), dtype=bool)
+    if flags.empty:
+        return keep
+
+    flagged = sorted(set(flags['Wavelength']))
+    flagged_text = ', '.join(f'{wavelength:g}' for wavelength in flagged)
+    print(f'{len(flagged)} wavelength(s) failed quality control: {flagged_text} nm.')
+    for row in flags.itertuples(index=False):
+        print(f'    {row.Wavelength:g} nm: {row.Check} ({row.Value:.4g} < {row.Limit:.4g})')
+    process_events()
+
+    if qc_action == 'ask':
+        reply = reporter.question('Quality control',
+                                  f'The parent ion integration is low at {len(flagged)} of {len(wavelengths)} wavelengths ({flagged_text} nm). It\'s possible that the parent mz ({parent_mz}) you provided is incorrect. '
+                                  'Would you like to continue the analysis? The wavelengths will be flagged in the QC sheet of the output. Analysis will be aborted if No is selected.')
+        qc_action = 'flag' if reply else 'abort'
+
+    if qc_action == 'abort':
+        print('Analysis aborted by the quality control policy. Please check that the parent mz is correct before re-running the code.')
+        process_events()
+        return None
+
+    flags['Action'] = 'skipped' if qc_action == 'skip' else 'flagged'
+    if qc_action == 'skip':
+        keep = ~np.isin(np.asarray(wavelengths, dtype=float), flagged)
+        print(f'{len(flagged)} wavelength(s) have been left out of the results.')
+        process_events()
+
+    return keep
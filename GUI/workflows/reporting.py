@@ -0,0 +1,85 @@
+import sys, threading, time
+
+def process_events():
+    '''
+    Lets the GUI redraw (e.g., the log window) while a workflow is running. Qt is never imported here: this does nothing unless the GUI has already loaded
+    PyQt6 and created its QApplication, so the workflows also run headless (see uvpd.py).
+    '''
+    qt_widgets = sys.modules.get('PyQt6.QtWidgets')
+    if qt_widgets is not None and qt_widgets.QApplication.instance() is not None:
+        qt_widgets.QApplication.processEvents()
+
+class Reporter:
+    '''
+    Receives progress updates and yes/no questions from the processing pipeline, and tells it when the user has asked to cancel.
+    The base class prints progress to stdout and answers every question with its default. Subclass it and override
+    report_progress and question to route them elsewhere (e.g., the GUI's progress bar and message boxes).
+    '''
+    def __init__(self):
+        self._cancel_event = threading.Event()
+        self._stage = None
+        self._stage_start = None
+        self._stage_files_done = 0
+
+    def start(self):
+        '''Resets the reporter at the start of a run'''
+        self._cancel_event.clear()
+        self._stage = None
+        self._stage_start = None
+        self._stage_files_done = 0
+
+    def progress(self, files_done, n_files, stage, unit='files'):
+        '''Called by the pipeline as files are completed. Works out the throughput (files/s) and estimated time remaining (s) of the current stage, and passes everything on to report_progress.
+        Timing restarts whenever the stage changes, and only the files completed since then count towards the throughput. unit names what is counted if it isn't files (e.g., plots).'''
+        if stage != self._stage:
+            self._stage = stage
+            self._stage_start = time.time()
+            self._stage_files_done = files_done
+
+        elapsed = time.time() - self._stage_start
+        throughput = (files_done - self._stage_files_done) / elapsed if elapsed > 0 else 0.
+        eta = (n_files - files_done) / throughput if throughput > 0 else -1.
+
+        self.report_progress(files_done, n_files, stage, throughput, eta, unit)
+
+    def report_progress(self, files_done, n_files, stage, throughput, eta, unit='files'):
+        '''Override to display progress. eta is -1 while it cannot be estimated yet.'''
+        rate_text = f' ({throughput:.2f} {unit}/s' + (f', ~{int(round(eta))}s remaining)' if eta >= 0 and files_done < n_files else ')') if throughput > 0 else ''
+        print(f'{stage}: {files_done}/{n_files} {unit}{rate_text}')
+
+    def question(self, title, text, default=False):
+        '''Asks the user a yes/no question and returns True for yes. Override to prompt the user; the base class returns the default.'''
+        print(f'{title}\n{text}\nAnswering {"Yes" if default else "No"}.')
+        return default
+
+    def cancel(self):
+        '''Requests that the run stops at the next opportunity. Can be called from any thread.'''
+        self._cancel_event.set()
+
+    def cancelled(self):
+        '''True once cancel() has been called'''
+        return self._cancel_event.is_set()
+
+class TerminalReporter(Reporter):
+    '''
+    Reporter for running the pipeline from a terminal or a script (see uvpd.py). Progress is printed as one line per update. Questions are answered with answer if it is given,
+    asked on the terminal if stdin is interactive, and otherwise answered with their default, so that an unattended run never waits for input.
+    '''
+    def __init__(self, answer=None):
+        super().__init__()
+        self.answer = answer
+
+    def question(self, title, text, default=False):
+        if self.answer is not None:
+            print(f'{title}\n{text}\nAnswering {"Yes" if self.answer else "No"}.')
+            return self.answer
+
+        if not sys.stdin or not sys.stdin.isatty():
+            return super().question(title, text, default)
+
+        while True:
+            reply = input(f'{title}\n{text}\n[y/n] ').strip().lower()
+            if reply in ('y', 'yes'):
+                return True
+            if reply in ('n', 'no'):
+                return False
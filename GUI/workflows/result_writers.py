@@ -0,0 +1,197 @@
+import os, json, traceback
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from workflows.reporting import process_events
+
+#Output formats of the UVPD results, and the extension of their files. Every selected format is written from the same UVPDResults object.
+#   excel: one workbook with a sheet per table, and a chart of the total PE on the Original and Smoothed sheets (the original output of the analysis)
+#   csv, parquet: one file per table, named <basename>_<table><extension>. Parquet requires pyarrow.
+#   npz: one NumPy archive with a structured array per table, read with np.load (no pickling needed)
+#   json: the settings of the analysis, the wavelengths and the files written by the other formats. Always written last.
+RESULT_FORMATS = {'excel': '.xlsx', 'csv': '.csv', 'parquet': '.parquet', 'npz': '.npz', 'json': '.json'}
+RESULT_TABLES = ('Original', 'Smoothed', 'Normalization', 'QC')
+
+class UVPDResults:
+    '''
+    The results of a UVPD analysis, shared by every result writer:
+        original: DataFrame of the PE of every wavelength (Wavelength, Total PE, Total PE stdev, then PE mz <frag> and its stdev for every fragment), sorted by wavelength
+        smoothed: original with every column but the wavelength smoothed by an adjacent average of smoothing_size points
+        normalization: total PE (and stdev) of original and smoothed, divided by their maximum
+        qc: wavelengths that failed quality control (see workflows.qc)
+        metadata: dict of the settings of the analysis, written by the json writer
+    '''
+    def __init__(self, original, smoothing_size, qc, metadata=None):
+        self.original = original
+        self.qc = qc
+        self.metadata = metadata or {}
+
+        # Apply weighted adjacent average smoothing to all columns except 'Wavelength'
+        self.smoothed = original.copy()
+        for column in self.smoothed.columns:
+            if column != 'Wavelength':
+                self.smoothed[column] = self.smoothed[column].rolling(window=int(smoothing_size), min_periods=1, center=True).mean()
+
+        #Normalize data
+        max_pe = original['Total PE'].max()
+        max_pe_smoothed = self.smoothed['Total PE'].max()
+        self.normalization = pd.DataFrame({
+        'Wavelength': original['Wavelength'],
+        'Total PE': original['Total PE'] / max_pe,
+        'Total PE StDev': original['Total PE stdev'] / max_pe,
+        'Smoothed Total PE': self.smoothed['Total PE'] / max_pe_smoothed,
+        'Smoothed Total PE StDev': self.smoothed['Total PE stdev'] / max_pe_smoothed
+        })
+
+    @property
+    def tables(self):
+        '''The tables of the results by name (RESULT_TABLES)'''
+        return dict(zip(RESULT_TABLES, (self.original, self.smoothed, self.normalization, self.qc)))
+
+def result_files(output_base, result_format):
+    '''The files written by one result format for output_base (the output path without an extension)'''
+    extension = RESULT_FORMATS[result_format]
+    if result_format in ('csv', 'parquet'):
+        return [f'{output_base}_{table}{extension}' for table in RESULT_TABLES]
+    return [f'{output_base}{extension}']
+
+def unique_output_base(directory, out_basename, result_formats):
+    '''directory/out_basename, with _1, _2, ... appended until none of the files of result_formats exist, so that existing outputs are never overwritten'''
+    output_base = os.path.join(directory, out_basename)
+    index = 0
+    while any(os.path.exists(path) for result_format in result_formats for path in result_files(output_base, result_format)):
+        index += 1
+        output_base = os.path.join(directory, f'{out_basename}_{index}')
+    return output_base
+
+def write_excel(results, output_base):
+    '''Writes every table to its own sheet of an Excel workbook, with a chart of the total PE on the Original and Smoothed sheets'''
+    output_file, = result_files(output_base, 'excel')
+
+    with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
+        results.original.to_excel(writer, index=False, sheet_name='Original')
+        results.smoothed.to_excel(writer, index=False, sheet_name=f'Smoothed')
+        results.normalization.to_excel(writer, index=False, sheet_name='Normalization')
+        results.qc.to_excel(writer, index=False, sheet_name='QC') #wavelengths that failed quality control (header only if none did)
+
+        #Plot total PE in each worksheet
+        for sheet_name, dataframe in zip(['Original', 'Smoothed'],[results.original, results.smoothed]):
+            worksheet = writer.sheets[sheet_name]
+            workbook = writer.book
+            chart = workbook.add_chart({'type': 'scatter', 'subtype': 'straight_with_markers'})
+            max_row = len(dataframe) + 1
+
+            # Finding the min and max wavelength from the DataFrame
+            min_wavelength = dataframe['Wavelength'].min()
+            max_wavelength = dataframe['Wavelength'].max()
+
+            # Series for Total PE with error bars
+            chart.add_series({
+                'name': f'Total PE {sheet_name}',
+                'categories': f'={sheet_name}!$A$2:$A${max_row}',
+                'values': f'={sheet_name}!$B$2:$B${max_row}',
+                'y_error_bars': {
+                    'type': 'custom',
+                    'plus_values': f'={sheet_name}!$C$2:$C${max_row}',  # Assuming the stdev values for positive error
+                    'minus_values': f'={sheet_name}!$C$2:$C${max_row}',  # Assuming the same stdev values for negative error
+                    'line': {'color': 'black'},
+                    'end_style': 1  # Optional: no cap on the error bars
+                },
+                'line': {'color': 'blue', 'width': 1},
+                'marker': {'type': 'circle', 'size': 4, 'border': {'color': 'black'}, 'fill': {'color': 'black'}}
+            })
+
+            # Set chart title and axis titles
+            chart.set_title({'name': 'Photofragmentation Efficiency'})
+            chart.set_x_axis({'name': 'Wavelength (nm)',
+                'name_font': {'size': 14, 'bold': True},
+                'num_font': {'italic': True},
+                'min': min_wavelength,
+                'max': max_wavelength})
+            chart.set_y_axis({'name': 'Total PE', 'name_font': {'size': 14, 'bold': True}, 'num_font': {'italic': True}})
+
+            # Set style and layout
+            chart.set_style(10)  # Predefined style (1-48 available)
+            chart.set_legend({'position': 'bottom'})
+
+            #add chart to worksheet
+            worksheet.insert_chart('E4', chart)
+
+    return [output_file]
+
+def write_csv(results, output_base):
+    '''Writes every table to its own .csv file'''
+    paths = result_files(output_base, 'csv')
+    for path, table in zip(paths, results.tables.values()):
+        table.to_csv(path, index=False)
+    return paths
+
+def write_parquet(results, output_base):
+    '''Writes every table to its own .parquet file (requires pyarrow)'''
+    paths = result_files(output_base, 'parquet')
+    for path, table in zip(paths, results.tables.values()):
+        table.to_parquet(path, index=False)
+    return paths
+
+def _structured(table):
+    '''A DataFrame as a structured array, with text columns stored as fixed-length strings so that the array can be loaded without pickling'''
+    return np.rec.fromarrays([np.asarray(table[column], dtype=float) if pd.api.types.is_numeric_dtype(table[column]) else np.asarray(table[column]).astype(str) for column in table.columns],
+                             names=list(table.columns)) if len(table.columns) else np.empty(0)
+
+def write_npz(results, output_base):
+    '''Writes every table to a structured array of a single .npz archive'''
+    output_file, = result_files(output_base, 'npz')
+    np.savez(output_file, **{name: _structured(table) for name, table in results.tables.items()})
+    return [output_file]
+
+def _json_value(value):
+    '''NumPy numbers and arrays as plain JSON values'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def write_json(results, output_base, files=()):
+    '''Writes the metadata of the results, with the wavelengths, the wavelengths that failed quality control, and the files written by the other formats'''
+    output_file, = result_files(output_base, 'json')
+    metadata = {'created': datetime.now().isoformat(timespec='seconds'), **results.metadata,
+                'wavelengths': results.original['Wavelength'].tolist(), 'columns': list(results.original.columns),
+                'qc_flags': results.qc.to_dict(orient='records'), 'files': [os.path.basename(path) for path in files]}
+
+    with open(output_file, 'w') as opf:
+        json.dump(metadata, opf, indent=1, default=_json_value)
+    return [output_file]
+
+RESULT_WRITERS = {'excel': write_excel, 'csv': write_csv, 'parquet': write_parquet, 'npz': write_npz, 'json': write_json}
+
+def write_results(results, output_base, result_formats=('excel',)):
+    '''
+    Writes the results in every format of result_formats (see RESULT_FORMATS) to output_base + the extension of the format. The json metadata is written last so that it
+    can list the files written by the other formats. Returns the list of files written, or None if a format could not be written.
+    '''
+    files = []
+    for result_format in sorted(result_formats, key=list(RESULT_FORMATS).index):
+        try:
+            if result_format == 'json':
+                files += write_json(results, output_base, files)
+            else:
+                files += RESULT_WRITERS[result_format](results, output_base)
+
+        except ImportError as e:
+            print(f'The {result_format} output format requires a package that is not installed ({e}). Please install it (pip install pyarrow), or choose another format.')
+            process_events()
+            return
+
+        except PermissionError: #this should never proc because we check for existing files and change the ending index to make sure the file is new, but you never know...
+            print(f'Python is trying to write to the {result_format} output of {os.path.basename(output_base)}, but it is open. Please close it and then rerun the code.')
+            process_events()
+            return
+
+        except Exception as e:
+            print(f'An unexpected exception occured when trying to write the PE data to the {result_format} output of {os.path.basename(output_base)}:\n{e}\nTraceback: {traceback.format_exc()}')
+            process_events()
+            return
+
+    return files
@@ -0,0 +1,87 @@
+import os, json
+
+from workflows.experiment_store import ExperimentStore
+from workflows.reporting import process_events
+from workflows.spectrum_cache import CACHE_DIR_NAME, file_fingerprint, hash_file
+
+#Integration results are written to mzml_directory/.cache as one .json sidecar per mzML file, next to the decoded spectra.
+#Bump the version whenever a change to the integration would change its results, so that stale entries are never reused.
+RESULTS_CACHE_VERSION = 1
+
+def results_cache_path(directory, mzml_file):
+    '''Location of the integration results sidecar for an mzML file'''
+    return os.path.join(os.path.abspath(directory), CACHE_DIR_NAME, f'{mzml_file}.results.json')
+
+def integration_key(target_mz, background, search_window, parent_mz, height, threshold, prominence, width, mode, window_margin, n_bootstrap, limit_bases=False):
+    '''The parameters that determine the integration of one target in one mzML file, as a string that identifies its cache entry.
+    limit_bases (the peak bases are searched within window_margin of the peak) is only added when it is set, so that the entries of earlier runs stay valid.'''
+    key = {'target_mz': target_mz, 'background': background, 'search_window': search_window, 'parent_mz': parent_mz, 'height': height, 'threshold': threshold,
+           'prominence': prominence, 'width': width, 'mode': mode, 'window_margin': window_margin, 'n_bootstrap': n_bootstrap}
+    if limit_bases:
+        key['limit_bases'] = True
+    return json.dumps(key, sort_keys=True)
+
+def raw_spectrum_key(parent_mz, step):
+    '''Identifies the cache entry that holds the average of every scan of the mzML file on the raw data export grid (0 to parent_mz + 50, in steps of step)'''
+    return json.dumps({'raw_spectrum': parent_mz, 'step': step}, sort_keys=True)
+
+class ResultsCache:
+    '''
+    The cached [average integration, stdev] of every target that has been integrated in one mzML file, stored by integration_key, and its averaged raw spectrum (raw_spectrum_key).
+    The entries belong to the contents of the mzML file: they are discarded when the file changes, and kept when it is only copied or touched (same size and content hash).
+    If the mzML file has been deleted and its spectra are read from an experiment store, the file as it was when the store was built is used instead.
+    '''
+    def __init__(self, directory, mzml_file, store_file=None):
+        self.path = results_cache_path(directory, mzml_file)
+        self.mzml_path = os.path.join(directory, mzml_file)
+        self.entries = {}
+
+        if os.path.exists(self.mzml_path):
+            self.fingerprint = file_fingerprint(self.mzml_path, content_hash=False)
+        else:
+            store = ExperimentStore(store_file)
+            self.fingerprint = dict(store.header['fingerprints'][store.mzml_files.index(mzml_file)])
+
+        self._read()
+
+    def _read(self):
+        '''Loads the entries of the sidecar if it still matches the mzML file'''
+        try:
+            with open(self.path, 'r') as opf:
+                cached = json.load(opf)
+        except (OSError, ValueError):
+            return #no sidecar yet, or an unreadable one that is simply rebuilt
+
+        if cached.get('version') != RESULTS_CACHE_VERSION:
+            return
+
+        cached_fingerprint = cached.get('fingerprint', {})
+        unchanged = all(cached_fingerprint.get(key) == self.fingerprint[key] for key in ('size', 'mtime_ns'))
+
+        #the fast (size, mtime) check failed - fall back to the content hash, which needs the mzML file
+        if not unchanged:
+            if cached_fingerprint.get('size') != self.fingerprint['size'] or cached_fingerprint.get('sha256') is None or not os.path.exists(self.mzml_path):
+                return
+            self.fingerprint['sha256'] = hash_file(self.mzml_path)
+            if cached_fingerprint['sha256'] != self.fingerprint['sha256']:
+                return
+
+        self.fingerprint.setdefault('sha256', cached_fingerprint.get('sha256'))
+        self.entries = cached.get('entries', {})
+
+    def save(self):
+        '''Writes the entries to the sidecar. The sidecar is written to a temporary file first so that an interrupted write can never leave a corrupt cache behind.'''
+        if self.fingerprint.get('sha256') is None and os.path.exists(self.mzml_path):
+            self.fingerprint['sha256'] = hash_file(self.mzml_path)
+
+        temp_file = f'{self.path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp_file, 'w') as opf:
+                json.dump({'version': RESULTS_CACHE_VERSION, 'fingerprint': self.fingerprint, 'entries': self.entries}, opf)
+            os.replace(temp_file, self.path)
+
+        #failing to write the cache (e.g., read-only data drive) should never stop the analysis
+        except OSError as e:
+            print(f'Could not write the integration results cache for {os.path.basename(self.mzml_path)} ({e}). The file will be integrated again on the next run.')
+            process_events()
@@ -0,0 +1,137 @@
+import os, json, hashlib
+import numpy as np
+
+from workflows.mzml_reader import iter_mzml, UnsupportedEncodingError
+from workflows.reporting import process_events
+
+#Decoded spectra are written to mzml_directory/.cache as one .npz sidecar per mzML file
+CACHE_DIR_NAME = '.cache'
+CACHE_VERSION = 1
+
+def hash_file(file_path, chunk_size=1 << 20):
+    '''Returns the sha256 hash of a file's contents, read in 1 MB chunks so that large mzML files are never held in memory'''
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as opf:
+        for chunk in iter(lambda: opf.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_fingerprint(file_path, content_hash=True):
+    '''Returns a dict that identifies the current state of a file: absolute path, size, modification time and (optionally) the hash of its contents'''
+    stat = os.stat(file_path)
+    fingerprint = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if content_hash:
+        fingerprint['sha256'] = hash_file(file_path)
+    return fingerprint
+
+def cache_path(mzml_path):
+    '''Location of the decoded-spectrum sidecar for an mzML file'''
+    return os.path.join(os.path.dirname(os.path.abspath(mzml_path)), CACHE_DIR_NAME, f'{os.path.basename(mzml_path)}.npz')
+
+def _parse_mzml_pyteomics(mzml_path):
+    '''Fallback parser for mzML files that use encodings the streaming reader does not decode (e.g., MS-Numpress). Yields (mz, intensity) for every scan.'''
+    import pyteomics.mzml as mzml #imported here since it is only needed for the fallback, and it is slow to import in every worker process
+
+    with mzml.read(mzml_path) as spectra:
+        for spectrum in spectra:
+            yield spectrum['m/z array'], spectrum['intensity array']
+
+def parse_mzml(mzml_path):
+    '''Parses an mzML file and returns the m/z and intensity arrays of every scan concatenated into two flat arrays, plus an array of scan offsets (n_scans + 1) into them'''
+    try:
+        return _concatenate_scans(mzml_path, ((mz, intensity) for _, _, mz, intensity in iter_mzml(mzml_path)))
+
+    except UnsupportedEncodingError:
+        return _concatenate_scans(mzml_path, _parse_mzml_pyteomics(mzml_path))
+
+def _concatenate_scans(mzml_path, scans):
+    '''Packs an iterable of (mz, intensity) scans into flat m/z and intensity arrays plus scan offsets'''
+    mz_arrays = []
+    intensity_arrays = []
+
+    for i, (mz, intensity) in enumerate(scans):
+        if len(mz) != len(intensity):
+            raise ValueError(f'Inconsistent lengths of m/z and intensity arrays in spectrum number {i+1} of {os.path.basename(mzml_path)}.')
+
+        mz_arrays.append(np.asarray(mz, dtype=float))
+        intensity_arrays.append(np.asarray(intensity))
+
+    offsets = np.zeros(len(mz_arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(mz) for mz in mz_arrays])
+
+    mz_concat = np.concatenate(mz_arrays) if mz_arrays else np.empty(0, dtype=float)
+    intensity_concat = np.concatenate(intensity_arrays) if intensity_arrays else np.empty(0, dtype=float)
+
+    return mz_concat, intensity_concat, offsets
+
+def _read_cache(mzml_path, fingerprint):
+    '''Returns the cached (mz, intensity, offsets) arrays for an mzML file if the sidecar exists and still matches the file, otherwise None.
+    A sidecar is valid if the path, size and mtime all match, or if the size and content hash match (i.e., the file was copied or touched but not changed).'''
+    sidecar = cache_path(mzml_path)
+    if not os.path.isfile(sidecar):
+        return None
+
+    try:
+        with np.load(sidecar, allow_pickle=False) as cached:
+            meta = json.loads(str(cached['meta']))
+
+            if meta.get('version') != CACHE_VERSION:
+                return None
+
+            cached_fingerprint = meta['fingerprint']
+            unchanged = all(cached_fingerprint.get(key) == fingerprint[key] for key in ('path', 'size', 'mtime_ns'))
+
+            if not unchanged:
+                if cached_fingerprint.get('size') != fingerprint['size'] or cached_fingerprint.get('sha256') != hash_file(mzml_path):
+                    return None
+
+            arrays = cached['mz'], cached['intensity'], cached['offsets']
+
+    except Exception:
+        #A truncated or otherwise unreadable sidecar is simply rebuilt
+        return None
+
+    #Refresh the stored fingerprint so that the next lookup takes the fast (path, size, mtime) route
+    if not unchanged:
+        _write_cache(mzml_path, file_fingerprint(mzml_path), *arrays)
+
+    return arrays
+
+def _write_cache(mzml_path, fingerprint, mz, intensity, offsets):
+    '''Writes the decoded arrays of an mzML file to its sidecar. The sidecar is written to a temporary file first so that an interrupted write can never leave a corrupt cache behind.'''
+    sidecar = cache_path(mzml_path)
+    temp_file = f'{sidecar}.tmp'
+    meta = json.dumps({'version': CACHE_VERSION, 'fingerprint': fingerprint})
+
+    try:
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        with open(temp_file, 'wb') as opf:
+            np.savez(opf, mz=mz, intensity=intensity, offsets=offsets, meta=np.array(meta))
+        os.replace(temp_file, sidecar)
+
+    #failing to write the cache (e.g., read-only data drive) should never stop the analysis
+    except OSError as e:
+        print(f'Could not write the spectrum cache for {os.path.basename(mzml_path)} ({e}). The file will be re-parsed on the next run.')
+        process_events()
+
+def load_spectra_arrays(mzml_path, use_cache=True):
+    '''Returns the (mz, intensity, offsets) arrays of every scan in an mzML file, where the scan i spans mz[offsets[i]:offsets[i+1]].
+    If use_cache is True, the arrays are read from the .npz sidecar in mzml_directory/.cache when it matches the file, and the sidecar is (re)built after parsing otherwise.'''
+    if not use_cache:
+        return parse_mzml(mzml_path)
+
+    #a content hash is only computed when building the cache, or when the path/size/mtime check fails
+    fingerprint = file_fingerprint(mzml_path, content_hash=False)
+    arrays = _read_cache(mzml_path, fingerprint)
+
+    if arrays is None:
+        arrays = parse_mzml(mzml_path)
+        fingerprint['sha256'] = hash_file(mzml_path)
+        _write_cache(mzml_path, fingerprint, *arrays)
+
+    return arrays
+
+def load_spectra(mzml_path, use_cache=True):
+    '''Returns a list of (mz, intensity) array pairs, one per scan in the mzML file. See load_spectra_arrays for details on caching.'''
+    mz, intensity, offsets = load_spectra_arrays(mzml_path, use_cache)
+    return [(mz[start:stop], intensity[start:stop]) for start, stop in zip(offsets[:-1], offsets[1:])]
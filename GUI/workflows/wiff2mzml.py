@@ -1,54 +1,310 @@
-import os, traceback, subprocess, time
-from PyQt6.QtWidgets import QApplication
+import os, json, traceback, subprocess, threading, shutil, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def convert_wiff_to_mzml(wiff_file, directory, mzml_directory):
-    ''' Function to convert .wiff files to .mzml using msconvert
-    input is .wiff file, directory that contains .wiff files, and directory to output mzml files to'''
-    
-    #check if required files are present
+from workflows.reporting import process_events
+from workflows.spectrum_cache import CACHE_DIR_NAME
+
+#An mzML file is only complete once its root element has been closed. msconvert writes indexed mzML by default.
+MZML_CLOSING_TAGS = (b'</indexedmzML>', b'</mzML>')
+
+#Every .wiff file is recorded in mzml_directory/.cache/conversion.json as soon as its conversion completes, with the mzML files it was converted to,
+#so that an interrupted extraction can be resumed without converting the finished .wiff files again (see convert_wiff_files).
+CONVERSION_CHECKPOINT_NAME = 'conversion.json'
+
+def _check_wiff_files(wiff_file, directory):
+    '''Checks that a .wiff file and its .scan file are both present in the directory'''
     wiff_file_check = os.path.join(directory, wiff_file)
     scan_file_check = f'{os.path.join(directory, wiff_file)}.scan'
-    
+
     if not os.path.exists(wiff_file_check):
         print(f'The corresponding .wiff file is missing from the directory. Please add the following file to the directory, and re-run the code:\n{os.path.basename(wiff_file_check)}\n\n')
-        QApplication.processEvents()
+        process_events()
         return False
 
     if not os.path.exists(scan_file_check):
         print(f'The corresponding .scan file is missing from the directory. Please add the following file to the directory, and re-run the code:\n{os.path.basename(scan_file_check)}\n\n')
-        QApplication.processEvents()
+        process_events()
         return False
 
+    return True
+
+def msconvert_command(wiff_path, output_directory, msconvert_path='msconvert', mz_window=None, zlib=False, intensity_32bit=False):
+    '''
+    Command line used to convert a .wiff file to mzML. Options:
+        mz_window: (low, high) m/z range to keep in every spectrum (msconvert's mzWindow filter). None keeps the full range.
+        zlib: If True, the binary arrays are zlib compressed (lossless).
+        intensity_32bit: If True, intensities are written as 32-bit floats (m/z values stay 64-bit), which halves the size of the intensity arrays.
+    '''
+    command = [msconvert_path, wiff_path, '-o', output_directory, '--mzML']
+    command += ['--mz64', '--inten32'] if intensity_32bit else ['--64']
+
+    if zlib:
+        command.append('--zlib')
+
+    if mz_window is not None:
+        command += ['--filter', f'mzWindow [{mz_window[0]},{mz_window[1]}]']
+
+    return command + ['--verbose']
+
+def mzml_complete(mzml_path):
+    '''True if an mzML file ends with its closing tag, i.e., msconvert has finished writing it'''
     try:
+        with open(mzml_path, 'rb') as opf:
+            opf.seek(0, os.SEEK_END)
+            opf.seek(max(opf.tell() - 256, 0))
+            tail = opf.read().rstrip()
+
+    except OSError:
+        return False
+
+    return tail.endswith(MZML_CLOSING_TAGS)
+
+def wait_for_mzml(mzml_paths, timeout=60., poll_interval=0.2):
+    '''
+    Waits until every mzML file is complete (ends with its closing tag) and its size is unchanged between two polls. This replaces a fixed sleep
+    after msconvert exits - on cloud-synced or network drives the file can take a moment to be flushed. Returns True when all files are ready, False on timeout.
+    '''
+    deadline = time.time() + timeout
+    last_sizes = {}
+
+    while True:
+        sizes = {mzml_path: os.path.getsize(mzml_path) if os.path.exists(mzml_path) else -1 for mzml_path in mzml_paths}
+
+        if all(sizes[mzml_path] >= 0 and sizes[mzml_path] == last_sizes.get(mzml_path) and mzml_complete(mzml_path) for mzml_path in mzml_paths):
+            return True
+
+        if time.time() > deadline:
+            return False
 
-        # Use subprocess.run and capture output for debugging
-        result = subprocess.run(['msconvert', os.path.join(directory, wiff_file), '-o', mzml_directory, '--mzML', '--64', '--verbose'],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        
-        # Print command output for debugging purposes
-        print(f"msconvert stdout:\n{result.stdout}")
-        print(f"msconvert stderr:\n{result.stderr}")
+        last_sizes = sizes
+        time.sleep(poll_interval)
+
+def conversion_checkpoint_path(mzml_directory):
+    '''Location of the record of the .wiff files that have been converted into an mzml_directory'''
+    return os.path.join(mzml_directory, CACHE_DIR_NAME, CONVERSION_CHECKPOINT_NAME)
+
+def _wiff_fingerprint(directory, wiff_file):
+    '''(size, mtime) of a .wiff file and its .scan file'''
+    return [[stat.st_size, stat.st_mtime_ns] for stat in (os.stat(os.path.join(directory, f)) for f in (wiff_file, f'{wiff_file}.scan'))]
+
+class ConversionCheckpoint:
+    '''
+    The .wiff files of a directory that have been converted into its mzml_directory, and the mzML files each one was converted to. A conversion only counts
+    if it was made with the same msconvert options, the .wiff file hasn't changed since, and all of its mzML files are still there and complete.
+    '''
+    def __init__(self, directory, mzml_directory, msconvert_options=None):
+        self.directory = directory
+        self.mzml_directory = mzml_directory
+        self.path = conversion_checkpoint_path(mzml_directory)
+        self.msconvert_options = json.loads(json.dumps(msconvert_options or {})) #same form as when read back (tuples become lists)
+        self.converted = {}
+
+        try:
+            with open(self.path, 'r') as opf:
+                checkpoint = json.load(opf)
+        except (OSError, ValueError):
+            return #no conversion recorded yet
+
+        if checkpoint.get('msconvert_options') == self.msconvert_options:
+            self.converted = checkpoint.get('converted', {})
+
+    def mzml_files(self, wiff_file):
+        '''The mzML files of a .wiff file whose conversion can be reused, or None if it has to be converted (again)'''
+        entry = self.converted.get(wiff_file)
+        if entry is None:
+            return None
+
+        try:
+            if entry['fingerprint'] != _wiff_fingerprint(self.directory, wiff_file):
+                return None
+        except OSError:
+            return None
+
+        if not all(mzml_complete(os.path.join(self.mzml_directory, f)) for f in entry['mzml_files']):
+            return None
+
+        return entry['mzml_files']
+
+    def record(self, wiff_file, mzml_files):
+        '''Records a completed conversion. The record is written to a temporary file first so that an interrupted write never leaves a corrupt checkpoint behind.'''
+        self.converted[wiff_file] = {'fingerprint': _wiff_fingerprint(self.directory, wiff_file), 'mzml_files': list(mzml_files)}
+
+        temp_file = f'{self.path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp_file, 'w') as opf:
+                json.dump({'msconvert_options': self.msconvert_options, 'converted': self.converted}, opf)
+            os.replace(temp_file, self.path)
+
+        #failing to write the checkpoint should never stop the conversion - the .wiff file is just converted again if the extraction is resumed
+        except OSError as e:
+            print(f'Could not record the conversion of {wiff_file} ({e}).')
+            process_events()
+
+    def clear(self):
+        '''Forgets every conversion, e.g., once the mzML files have been deleted'''
+        self.converted = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def _convert_one(wiff_file, directory, mzml_directory, msconvert_path, msconvert_options, ready_timeout, processes, lock, stop_event):
+    '''
+    Runs msconvert on a single .wiff file, printing its output line by line as it arrives. msconvert writes into its own temporary folder inside mzml_directory,
+    and the finished mzML files are moved into mzml_directory once they are complete, so other processes never see a partially written file.
+    Returns the list of mzML files written, or False on error.
+    '''
+    if stop_event.is_set():
+        return False
+
+    temp_directory = os.path.join(mzml_directory, f'.msconvert_{os.path.splitext(wiff_file)[0]}')
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    try:
+        process = subprocess.Popen(msconvert_command(os.path.join(directory, wiff_file), temp_directory, msconvert_path, **msconvert_options),
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+        with lock:
+            processes[wiff_file] = process
+            if stop_event.is_set(): #stopped while msconvert was being launched
+                process.terminate()
+
+        #stream stdout/stderr into the log as it is written
+        for line in process.stdout:
+            line = line.rstrip()
+            if line:
+                print(f'[msconvert {wiff_file}] {line}')
+
+        returncode = process.wait()
+
+        with lock:
+            processes.pop(wiff_file, None)
+
+        if stop_event.is_set():
+            return False
 
         # Check the result and raise an error if the command failed
-        if result.returncode != 0:
-            print(f"msconvert failed with return code {result.returncode}. Check the output above for details.")
+        if returncode != 0:
+            print(f'msconvert failed on {wiff_file} with return code {returncode}. Check the output above for details.')
+            return False
+
+        mzml_files = sorted(f for f in os.listdir(temp_directory) if f.lower().endswith('.mzml'))
+        if not mzml_files:
+            print(f'msconvert did not write any .mzML files for {wiff_file}. Check the output above for details.')
             return False
 
-        time.sleep(2)
+        if not wait_for_mzml([os.path.join(temp_directory, f) for f in mzml_files], timeout=ready_timeout):
+            print(f'The .mzML files converted from {wiff_file} were not completely written within {ready_timeout}s. Analysis will be stopped.')
+            return False
 
-        return True
+        for f in mzml_files:
+            os.replace(os.path.join(temp_directory, f), os.path.join(mzml_directory, f))
+
+        return mzml_files
 
     except FileNotFoundError:
         print("msconvert (Part of proteowizard) could not be found. Did you add the required directories to your system's PATH?\n")
-        QApplication.processEvents()
-        return False
-
-    except subprocess.CalledProcessError as cpe:    
-        print(f'Subprocess error converting {wiff_file} to mzML: {cpe}\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()
         return False
 
-    except Exception as e: 
+    except Exception as e:
         print(f'Unexpected error converting {wiff_file} to mzML: {e}\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()
         return False
+
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+def convert_wiff_files(wiff_files, directory, mzml_directory, max_concurrent=1, msconvert_path='msconvert', reporter=None, ready_timeout=60., on_converted=None, msconvert_options=None, resume=False):
+    '''
+    Converts .wiff files to mzML, running up to max_concurrent msconvert processes at once. Returns the list of mzML files written to mzml_directory, or False on error.
+    Every completed conversion is recorded in the ConversionCheckpoint of the mzml_directory.
+
+    Parameters:
+        wiff_files: List of .wiff file names in directory.
+        directory: Directory containing the .wiff (and .wiff.scan) files.
+        mzml_directory: Directory the mzML files are written to.
+        max_concurrent: Maximum number of msconvert processes that run at the same time.
+        msconvert_path: The msconvert executable. Defaults to the one on the system's PATH.
+        reporter: Optional workflows.reporting.Reporter that receives progress after every .wiff file and is polled for cancellation. Cancelling terminates the running msconvert processes.
+        ready_timeout: Seconds to wait after msconvert exits for its mzML files to be completely written.
+        on_converted: Optional function called with (wiff_file, list of mzML files) on the calling thread as soon as each .wiff file has been converted,
+            e.g., to start processing its mzML files while the remaining .wiff files are still converting. If it returns False, the conversion is stopped and False is returned.
+        msconvert_options: Optional dict of the mz_window, zlib and intensity_32bit options of msconvert_command.
+        resume: If True, the .wiff files that have already been converted with the same options (see ConversionCheckpoint) are not converted again.
+            Their mzML files are returned (and passed to on_converted) as if they had just been converted.
+    '''
+    msconvert_options = msconvert_options or {}
+
+    for wiff_file in wiff_files:
+        if not _check_wiff_files(wiff_file, directory):
+            return False
+
+    checkpoint = ConversionCheckpoint(directory, mzml_directory, msconvert_options)
+    already_converted = {}
+    if resume:
+        already_converted = {wiff_file: checkpoint.mzml_files(wiff_file) for wiff_file in wiff_files}
+        already_converted = {wiff_file: converted for wiff_file, converted in already_converted.items() if converted is not None}
+        if already_converted:
+            print(f'Resuming the extraction: {len(already_converted)} of {len(wiff_files)} .wiff files have already been converted with the same settings and will not be converted again.')
+            process_events()
+
+    stage = 'Converting .wiff files'
+    if reporter is not None:
+        reporter.progress(len(already_converted), len(wiff_files), stage)
+
+    processes = {} #.wiff file -> running msconvert process, so that they can be terminated on error or cancel
+    lock = threading.Lock()
+    stop_event = threading.Event()
+    mzml_files = []
+
+    executor = ThreadPoolExecutor(max_workers=max(int(max_concurrent), 1))
+    try:
+        for wiff_file, converted in already_converted.items():
+            mzml_files.extend(converted)
+            if on_converted is not None and on_converted(wiff_file, converted) is False:
+                return False
+
+        futures = {executor.submit(_convert_one, wiff_file, directory, mzml_directory, msconvert_path, msconvert_options, ready_timeout, processes, lock, stop_event): wiff_file
+                   for wiff_file in wiff_files if wiff_file not in already_converted}
+        pending = set(futures)
+        files_done = len(already_converted)
+
+        while pending:
+            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+
+            if reporter is not None and reporter.cancelled():
+                print('Conversion of the .wiff files cancelled by user.')
+                process_events()
+                return False
+
+            for future in done:
+                wiff_file = futures[future]
+                converted = future.result()
+
+                if not converted:
+                    return False
+
+                checkpoint.record(wiff_file, converted)
+                mzml_files.extend(converted)
+                files_done += 1
+                print(f'{wiff_file} has been successfully extracted to {len(converted)} .mzML files ({files_done}/{len(wiff_files)}).')
+                process_events()
+
+                if reporter is not None:
+                    reporter.progress(files_done, len(wiff_files), stage)
+
+                if on_converted is not None and on_converted(wiff_file, converted) is False:
+                    return False
+
+    finally:
+        #on error or cancel, stop the msconvert processes that are still running and don't start any that are queued
+        with lock:
+            stop_event.set()
+            for process in processes.values():
+                process.terminate()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return mzml_files
+
+def convert_wiff_to_mzml(wiff_file, directory, mzml_directory, msconvert_path='msconvert', msconvert_options=None):
+    ''' Function to convert .wiff files to .mzml using msconvert
+    input is .wiff file, directory that contains .wiff files, and directory to output mzml files to. Returns True on success, False on error.'''
+    return bool(convert_wiff_files([wiff_file], directory, mzml_directory, msconvert_path=msconvert_path, msconvert_options=msconvert_options))